@@ -1,17 +1,51 @@
 #!/usr/bin/env python3
 
-import pprint
+# Analyze the messages in a CSV export of the wireless controllers'
+# syslog (by default, controller-logs.csv: a header row, and then
+# rows whose 2nd column is the timestamp and whose 3rd column is the
+# message).
+#
+# This is a streaming pipeline -- CSV rows -> (timestamp, message) ->
+# classified events -> aggregated counts -- so it runs in constant
+# memory no matter how big the export is.  It prints the summary
+# counts at the end, and can also write every event as a line of JSON
+# (--events).
+#
+# --rogue-hours and --coverage-holes report on the events in a
+# compact, time-sorted index (see EventIndex), optionally limited to a
+# time window (--start / --end).
+#
+# With --jobs N, the file is split into chunks (at line boundaries)
+# that are classified in N worker processes, and the workers' counts
+# are merged; the output is the same as a serial run.
+#
+# With --state FILE, the counts and how far into the file they got
+# are saved, and the next run only analyzes the lines appended since
+# then (see analyze_incremental()).
+
+import argparse
+import array
+import bisect
+import collections
 import csv
-import sys
+import functools
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import pprint
+import random
+import sys
 import re
+import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-logs          = dict()
-mercy_ap_macs = dict()
-rogue_ap_macs = dict()
-types_found   = dict()
+#####################################################################
+
+default_input = 'controller-logs.csv'
+default_chunk_size = 64     # MB
 
 date_re = re.compile('... (...) (\d\d) (\d\d):(\d\d):(\d\d) (\d\d\d\d)')
 months  = [ '',
@@ -27,6 +61,8 @@ months  = [ '',
             'Oct',
             'Nov',
             'Dec' ]
+month_numbers = { name : number
+                  for number, name in enumerate(months) if name }
 
 #####################################################################
 
@@ -41,147 +77,437 @@ load          = re.compile('Load Profile Failed for Base Radio MAC: (..:..:..:..
 
 #####################################################################
 
-def find_coverage(d, msg):
-    m = coverage_hole.match(msg)
-    if not m:
-        return None
+# The classification rules: a message that matches a rule's regex
+# (at the beginning of the message) is an event of the rule's type,
+# with the regex's groups as the event's fields (a field name of None
+# skips that group).  The first rule that matches wins, so more
+# specific rules go first.
+Rule = collections.namedtuple('Rule', ['type', 'regex', 'fields'])
+
+default_rules = [
+    Rule('coverage hole',      coverage_hole,   ('client', 'ap', 'ap_name')),
+    Rule('rogue AP detected',  rogue_detect,    ('rogue', 'ap')),
+    Rule('rogue AP not heard', rogue_not_heard, ('rogue', 'ap')),
+    Rule('rogue AP removed',   rogue_removed,   ('rogue', 'ap')),
+    Rule('profile updated',    profile,         ('profile', 'action', 'ap')),
+    Rule('RF manager updated', rf_manager,      ('setting', 'ap')),
+    Rule('attack',             attack,          ('ap', 'attack_type', 'attacker')),
+]
+
+unknown_type = 'Unknown'
+
+# Rules from a JSON file: a list of {"type": ..., "pattern": ...,
+# "fields": [...]} objects.  The patterns are combined into one regex
+# (see Classifier), so they can't use numbered backreferences.
+def load_rules(filename):
+    with open(filename) as f:
+        specs = json.load(f)
+
+    rules = list()
+    for spec in specs:
+        regex = re.compile(spec['pattern'])
+        fields = tuple(spec.get('fields', []))
+        if len(fields) != regex.groups:
+            raise ValueError("Rule '{t}' has {f} fields but {g} groups"
+                             .format(t=spec['type'], f=len(fields),
+                                     g=regex.groups))
+        rules.append(Rule(spec['type'], regex, fields))
+
+    return rules
+
+#---------------------------------------------------------------
+
+# Classify messages against a list of rules in a single regex match:
+# all the rules' regexes are compiled into one alternation, each
+# alternative wrapped in a group.  The alternatives are tried in
+# order, so the first rule that matches wins, just like trying the
+# rules one at a time -- but the regex engine does it in one pass,
+# instead of a Python loop doing a match() per rule (most messages
+# are "Unknown", i.e., after failing every rule).
+#
+# The wrapper group closes last, so m.lastindex tells which
+# alternative matched; its own groups follow it.
+class Classifier:
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        alternatives = list()
+        self.by_index = dict()
+        index = 1
+        for rule in self.rules:
+            alternatives.append('(' + rule.regex.pattern + ')')
+            fields = [ (field, index + 1 + i)
+                       for i, field in enumerate(rule.fields)
+                       if field is not None ]
+            self.by_index[index] = (rule.type, fields)
+            index += 1 + rule.regex.groups
+
+        self.regex = re.compile('|'.join(alternatives))
+
+    def classify(self, msg):
+        m = self.regex.match(msg)
+        if not m:
+            return { 'type' : unknown_type }
 
-    item = {
-        'type' : 'coverage hole',
-        'client' : m.group(1),
-        'ap' : m.group(2),
-    }
-    mercy_ap_macs[m.group(2)] = m.group(3)
+        type, fields = self.by_index[m.lastindex]
+        item = { 'type' : type }
+        for field, group in fields:
+            item[field] = m.group(group)
 
-    return item
+        return item
+
+default_classifier = Classifier(default_rules)
 
-def find_rogue(d, msg):
-    item = None
-    if item is None:
-        item = find_rogue_detect(d, msg)
-    if item is None:
-        item = find_rogue_not_heard(d, msg)
-    if item is None:
-        item = find_rogue_removed(d, msg)
+def classify(d, msg, classifier=default_classifier):
+    item = classifier.classify(msg)
+    item['timestamp'] = d
+    item['msg'] = msg
 
     return item
 
-def find_rogue_removed(d, msg):
-    m = rogue_removed.match(msg)
-    if not m:
-        return None
+#####################################################################
 
-    item = {
-        'type' : 'rogue AP removed',
-        'rogue' : m.group(1),
-        'ap' : m.group(2),
+# The aggregated counts:
+#
+# types_found:   number of events of each type
+# mercy_ap_macs: our APs' names, by MAC (from the coverage hole
+#                messages)
+# rogue_ap_macs: for each of our APs, how many times a rogue AP was
+#                detected / removed / not heard by it
+class Summary:
+    rogue_counters = {
+        'rogue AP detected'  : 'detected',
+        'rogue AP removed'   : 'removed',
+        'rogue AP not heard' : 'not heard',
     }
 
-    rap = m.group(2)
-    if rap not in rogue_ap_macs:
-        rogue_ap_macs[rap] = {
-            'detected' : 0,
-            'removed' : 0,
-            'not heard' : 0,
+    def __init__(self):
+        self.types_found   = dict()
+        self.mercy_ap_macs = dict()
+        self.rogue_ap_macs = dict()
+
+    def add(self, item):
+        t = item['type']
+        if t not in self.types_found:
+            self.types_found[t] = 0
+        self.types_found[t] = self.types_found[t] + 1
+
+        if t == 'coverage hole':
+            self.mercy_ap_macs[item['ap']] = item['ap_name']
+
+        counter = self.rogue_counters.get(t)
+        if counter:
+            rap = item['ap']
+            if rap not in self.rogue_ap_macs:
+                self.rogue_ap_macs[rap] = {
+                    'detected' : 0,
+                    'removed' : 0,
+                    'not heard' : 0,
+                }
+            self.rogue_ap_macs[rap][counter] = self.rogue_ap_macs[rap][counter] + 1
+
+    # Add in the counts from another Summary of the messages *after*
+    # this one's (so the AP names from the later messages win, like
+    # they would in a serial run).
+    def merge(self, other):
+        for t, count in other.types_found.items():
+            self.types_found[t] = self.types_found.get(t, 0) + count
+
+        self.mercy_ap_macs.update(other.mercy_ap_macs)
+
+        for rap, counters in other.rogue_ap_macs.items():
+            if rap not in self.rogue_ap_macs:
+                self.rogue_ap_macs[rap] = dict(counters)
+                continue
+            for counter, count in counters.items():
+                self.rogue_ap_macs[rap][counter] = self.rogue_ap_macs[rap][counter] + count
+
+    # To / from JSON-able dicts, for the --state file
+    def as_dict(self):
+        return {
+            'types_found'   : self.types_found,
+            'mercy_ap_macs' : self.mercy_ap_macs,
+            'rogue_ap_macs' : self.rogue_ap_macs,
         }
-    rogue_ap_macs[rap]['removed'] = rogue_ap_macs[rap]['removed'] + 1
 
-    return item
+    @classmethod
+    def from_dict(cls, d):
+        summary = cls()
+        summary.types_found   = d['types_found']
+        summary.mercy_ap_macs = d['mercy_ap_macs']
+        summary.rogue_ap_macs = d['rogue_ap_macs']
 
-def find_rogue_not_heard(d, msg):
-    m = rogue_not_heard.match(msg)
-    if not m:
-        return None
+        return summary
 
-    item = {
-        'type' : 'rogue AP not heard',
-        'rogue' : m.group(1),
-        'msg' : m.group(2),
-    }
+    def print(self, file=sys.stdout):
+        pp = pprint.PrettyPrinter(stream=file)
+        pp.pprint(self.mercy_ap_macs)
+        pp.pprint(self.rogue_ap_macs)
+        pp.pprint(self.types_found)
 
-    rap = m.group(2)
-    if rap not in rogue_ap_macs:
-        rogue_ap_macs[rap] = {
-            'detected' : 0,
-            'removed' : 0,
-            'not heard' : 0,
-        }
-    rogue_ap_macs[rap]['not heard'] = rogue_ap_macs[rap]['not heard'] + 1
+#####################################################################
 
-    return item
+# Strings (event types, MACs) numbered in order of first appearance
+class Names:
+    def __init__(self):
+        self.names = list()
+        self.ids   = dict()
+
+    def id(self, name):
+        if name is None:
+            return -1
+
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+
+        return i
+
+# A compact, time-sorted index of the events, in parallel typed
+# arrays (about 17 bytes per event):
+#
+# times: seconds since the epoch (see datetime_epoch())
+# types: event type id (in self.type_names), one byte each, so that
+#        the type filters run on the raw bytes (see type_mask())
+# aps:   our AP's MAC id (in self.macs; -1 for none)
+# peers: the other MAC's id: the rogue AP, attacker, or client
+#
+# Events are added in file order; finish() sorts them by time if they
+# weren't already (it must be called before querying).  Then a time
+# window is a binary search, and the queries count over array slices.
+class EventIndex:
+    peer_fields = [ 'rogue', 'attacker', 'client' ]
+
+    # The type ids have to fit in a byte (there's one type per rule)
+    max_types = 256
+
+    def __init__(self):
+        self.times  = array.array('q')
+        self.types  = array.array('B')
+        self.aps    = array.array('i')
+        self.peers  = array.array('i')
+
+        self.type_names = Names()
+        self.macs       = Names()
+        self.sorted     = True
+
+    def add(self, item):
+        t = datetime_epoch(item['timestamp'])
+        if self.times and t < self.times[-1]:
+            self.sorted = False
+
+        peer = None
+        for field in self.peer_fields:
+            if field in item:
+                peer = item[field]
+                break
+
+        type_id = self.type_names.id(item['type'])
+        if type_id >= self.max_types:
+            raise ValueError("Too many event types for EventIndex (max {n})"
+                             .format(n=self.max_types))
+
+        self.times.append(t)
+        self.types.append(type_id)
+        self.aps.append(self.macs.id(item.get('ap')))
+        self.peers.append(self.macs.id(peer))
+
+    # Append another index's events (which come after this one's in
+    # the file), renumbering its types and MACs to this index's ids
+    def merge(self, other):
+        if other.times and self.times and other.times[0] < self.times[-1]:
+            self.sorted = False
+        self.sorted = self.sorted and other.sorted
+
+        type_ids = [ self.type_names.id(name) for name in other.type_names.names ]
+        if len(self.type_names.names) > self.max_types:
+            raise ValueError("Too many event types for EventIndex (max {n})"
+                             .format(n=self.max_types))
+        mac_ids  = [ self.macs.id(name) for name in other.macs.names ]
+        # So that -1 (no MAC) maps to itself
+        mac_ids.append(-1)
+
+        self.times.extend(other.times)
+        # The types are renumbered in bulk, with bytes.translate()
+        table = bytes(type_ids + [ 0 ] * (self.max_types - len(type_ids)))
+        self.types.frombytes(other.types.tobytes().translate(table))
+        self.aps.extend([ mac_ids[i] for i in other.aps ])
+        self.peers.extend([ mac_ids[i] for i in other.peers ])
+
+    def finish(self):
+        if self.sorted:
+            return
+
+        # A stable sort, so events with the same time stay in file order
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        for name in [ 'times', 'types', 'aps', 'peers' ]:
+            column = getattr(self, name)
+            setattr(self, name, array.array(column.typecode,
+                                            [ column[i] for i in order ]))
+        self.sorted = True
+
+    #---------------------------------------------------------------
+
+    # The slice of events from start up to (not including) end, in
+    # seconds since the epoch (None for no limit)
+    def window(self, start=None, end=None):
+        lo = 0 if start is None else bisect.bisect_left(self.times, start)
+        hi = len(self.times) if end is None else bisect.bisect_left(self.times, end)
+
+        return lo, max(lo, hi)
+
+    # Which of the events in the slice are of the given type: bytes of
+    # 1 / 0, made in one bytes.translate() over the slice's type ids
+    # (no Python loop per event).  itertools.compress() takes it as is.
+    def type_mask(self, type, lo, hi):
+        table = bytearray(self.max_types)
+        code  = self.type_names.ids.get(type)
+        if code is not None:
+            table[code] = 1
+        return self.types[lo:hi].tobytes().translate(table)
+
+    def count(self, type, start=None, end=None):
+        lo, hi = self.window(start, end)
+        code   = self.type_names.ids.get(type)
+        if code is None:
+            return 0
+        return self.types[lo:hi].tobytes().count(code)
+
+    # Number of events of a type per (AP MAC, hour), with the hour as
+    # seconds since the epoch
+    def count_by_ap_hour(self, type, start=None, end=None):
+        lo, hi = self.window(start, end)
+        mask   = self.type_mask(type, lo, hi)
+        aps    = itertools.compress(self.aps[lo:hi], mask)
+        hours  = map(lambda t: t - t % 3600,
+                     itertools.compress(self.times[lo:hi], mask))
+        counts = collections.Counter(zip(aps, hours))
+
+        names = self.macs.names
+        return { (names[ap], hour) : count
+                 for (ap, hour), count in counts.items() }
+
+    # The events of a type, as (time, AP MAC, other MAC) tuples
+    def events(self, type, start=None, end=None):
+        lo, hi = self.window(start, end)
+        mask   = self.type_mask(type, lo, hi)
+
+        names = self.macs.names
+        def _name(i):
+            return names[i] if i >= 0 else None
+
+        return [ (t, _name(ap), _name(peer))
+                 for t, ap, peer in itertools.compress(zip(self.times[lo:hi],
+                                                           self.aps[lo:hi],
+                                                           self.peers[lo:hi]),
+                                                       mask) ]
 
-def find_rogue_detect(d, msg):
-    m = rogue_detect.match(msg)
+#####################################################################
+
+# Timestamp format: Sun Sep 16 18:50:34 2018
+#
+# Returns None if the value isn't a valid timestamp.
+def parse_timestamp_fields(value):
+    m = date_re.match(value)
     if not m:
         return None
 
-    item = {
-        'type' : 'rogue AP detected',
-        'rogue' : m.group(1),
-        'ap' : m.group(2),
-    }
+    mon_name, day, hour, min, sec, year = m.groups()
+    mon = month_numbers.get(mon_name)
+    if mon is None:
+        return None
 
-    rap = m.group(2)
-    if rap not in rogue_ap_macs:
-        rogue_ap_macs[rap] = {
-            'detected' : 0,
-            'removed' : 0,
-            'not heard' : 0,
-        }
-    rogue_ap_macs[rap]['detected'] = rogue_ap_macs[rap]['detected'] + 1
+    return int(year), mon, int(day), int(hour), int(min), int(sec)
 
-    return item
+def parse_timestamp(value):
+    fields = parse_timestamp_fields(value)
+    if fields is None:
+        return None
 
-def find_profile(d, msg):
-    m = profile.match(msg)
-    if not m:
+    try:
+        return datetime(*fields)
+    except ValueError:
         return None
 
-    item = {
-        'type' : 'profile updated',
-        'profile' : m.group(1),
-        'action' : m.group(2),
-        'ap' : m.group(3),
-    }
+# Seconds since the epoch, taking the timestamp as UTC (the logs'
+# timestamps have no timezone; this is for ordering and bucketing).
+epoch_start = datetime(1970, 1, 1)
+one_second  = timedelta(seconds=1)
+
+def datetime_epoch(d):
+    return (d - epoch_start) // one_second
+
+def epoch_datetime(t):
+    return epoch_start + t * one_second
+
+# Seconds since the epoch of midnight on a day, from the timestamp's
+# month name, day, and year strings (None if there's no such day).
+# Syslog timestamps only span a few days, so this is cached: one
+# datetime per day, not per timestamp.
+@functools.lru_cache(maxsize=1024)
+def day_epoch(mon_name, day, year):
+    mon = month_numbers.get(mon_name)
+    if mon is None:
+        return None
 
-    return item
+    try:
+        return datetime_epoch(datetime(int(year), mon, int(day)))
+    except ValueError:
+        return None
 
-def find_rf_manager(d, msg):
-    m = rf_manager.match(msg)
+# Straight from the matched fields to seconds since the epoch (the
+# day's midnight, plus the time of day), without making a datetime.
+def parse_timestamp_epoch(value):
+    m = date_re.match(value)
     if not m:
         return None
 
-    item = {
-        'type' : 'RF manager updated',
-        'ap' : m.group(1),
-    }
-
-    return item
+    mon_name, day, hour, min, sec, year = m.groups()
+    base = day_epoch(mon_name, day, year)
+    if base is None:
+        return None
 
-def find_attack(d, msg):
-    m = attack.match(msg)
-    if not m:
+    hour = int(hour)
+    min  = int(min)
+    sec  = int(sec)
+    if hour > 23 or min > 59 or sec > 59:
         return None
 
-    item = {
-        'type' : 'attack',
-        'ap' : m.group(1),
-        'attack_type' : m.group(2),
-        'msg' : m.group(3)
-    }
+    return base + hour * 3600 + min * 60 + sec
 
-    return item
+# Syslog has long runs of messages with the same timestamp (and a
+# given second's timestamp doesn't come back once it's passed), so
+# remember the recently parsed timestamps by their raw string.  The
+# cache is just emptied when it fills up, which is cheap and fine for
+# timestamps that are (mostly) in order.
+#
+# With epoch=True, decode() returns seconds since the epoch instead of
+# datetimes.
+class TimestampDecoder:
+    max_cache = 10000
 
-def find_unknown(d, msg):
-    item = {
-        'type' : 'Unknown',
-    }
+    def __init__(self, epoch=False):
+        self.parse = parse_timestamp_epoch if epoch else parse_timestamp
+        self.cache = dict()
 
-    return item
+    def decode(self, value):
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
 
-#####################################################################
+        if len(self.cache) >= self.max_cache:
+            self.cache.clear()
+        result = self.cache[value] = self.parse(value)
 
-with open('controller-logs.csv') as f:
+        return result
+
+#---------------------------------------------------------------
+
+# The pipeline stages
+
+def read_rows(f):
     reader = csv.reader(f)
     first = True
     for row in reader:
@@ -190,59 +516,455 @@ with open('controller-logs.csv') as f:
             first = False
             continue
 
-        # Parse it
+        yield row
 
-        # Timestamp format: Sun Sep 16 18:50:34 2018
-        m = date_re.match(row[1])
-        if not m:
-            continue
+def parse_rows(rows, decoder=None):
+    if decoder is None:
+        decoder = TimestampDecoder()
+    decode = decoder.decode
 
-        mon  = months.index(m.group(1))
-        day  = int(m.group(2))
-        year = int(m.group(6))
+    for row in rows:
+        if len(row) < 3:
+            continue
 
-        hour = int(m.group(3))
-        min  = int(m.group(4))
-        sec  = int(m.group(5))
+        d = decode(row[1])
+        if d is None:
+            continue
 
-        d = datetime(year=year, month=mon, day=day, hour=hour,
-                     minute=min, second=sec)
+        yield d, row[2]
+
+def classify_messages(messages, classifier=default_classifier):
+    for d, msg in messages:
+        yield classify(d, msg, classifier)
+
+def iter_events(f, classifier=default_classifier):
+    return classify_messages(parse_rows(read_rows(f)), classifier)
+
+#---------------------------------------------------------------
+
+def write_event(out, item):
+    event = dict(item)
+    event['timestamp'] = item['timestamp'].isoformat()
+    out.write(json.dumps(event))
+    out.write('\n')
+
+def analyze_rows(rows, summary, events_out=None, classifier=default_classifier,
+                 index=None):
+    for item in classify_messages(parse_rows(rows), classifier):
+        summary.add(item)
+        if events_out is not None:
+            write_event(events_out, item)
+        if index is not None:
+            index.add(item)
+
+    return summary
+
+def analyze(f, summary, events_out=None, classifier=default_classifier,
+            index=None):
+    return analyze_rows(read_rows(f), summary, events_out, classifier, index)
+
+#---------------------------------------------------------------
+
+# Parallel analysis.
+#
+# The file (after the header row) is split into byte ranges of about
+# chunk_size bytes, each ending just after a newline.  This assumes
+# one CSV row per line, which is how the controllers export their
+# logs (no quoted newlines in the messages).  Each worker reads,
+# parses, and classifies its chunk into its own Summary (and JSON
+# events and an EventIndex, if wanted), and the results are merged in
+# file order, so they all come out the same as a serial run.
+#
+# Chunks are much smaller than the file / number of workers, so that
+# a worker's memory use is bounded and the workers stay evenly loaded.
+
+# The chunks of the file from start (default: after the header row)
+# up to end (default: the end of the file)
+def chunk_ranges(filename, chunk_size, start=None, end=None):
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size if end is None else end
+
+        if start is None:
+            # Skip the header row
+            f.readline()
+            start = f.tell()
+
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+
+            yield start, end
+            start = end
+
+# Each worker process gets the classifier once, when it starts, rather
+# than with every chunk
+worker_classifier = None
+
+def init_worker(classifier):
+    global worker_classifier
+    worker_classifier = classifier
+
+# Analyze the rows in a byte range of the file
+def analyze_range(filename, start, end, summary, events_out=None,
+                  classifier=default_classifier, index=None):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    # Decode the same way open_input() does
+    text = io.TextIOWrapper(io.BytesIO(data), newline='', errors='replace')
+
+    return analyze_rows(csv.reader(text), summary, events_out, classifier,
+                        index)
+
+def analyze_chunk(chunk):
+    filename, start, end, want_events, want_index = chunk
+
+    summary    = Summary()
+    events_out = io.StringIO() if want_events else None
+    index      = EventIndex() if want_index else None
+    analyze_range(filename, start, end, summary, events_out,
+                  worker_classifier, index)
+
+    return summary, events_out.getvalue() if want_events else None, index
+
+def analyze_parallel(filename, summary, events_out=None,
+                     classifier=default_classifier, jobs=None,
+                     chunk_size=default_chunk_size * 1024 * 1024,
+                     index=None, start=None, end=None):
+    chunks = [ (filename, chunk_start, chunk_end, events_out is not None,
+                index is not None)
+               for chunk_start, chunk_end in chunk_ranges(filename, chunk_size,
+                                                          start, end) ]
+
+    with multiprocessing.Pool(jobs, initializer=init_worker,
+                              initargs=(classifier,)) as pool:
+        for chunk_summary, events, chunk_index in pool.imap(analyze_chunk,
+                                                            chunks):
+            summary.merge(chunk_summary)
+            if events_out is not None:
+                events_out.write(events)
+            if index is not None:
+                index.merge(chunk_index)
+
+    return summary
+
+#---------------------------------------------------------------
+
+# Incremental analysis.
+#
+# The state file (JSON) has the summary counts, and the byte offset
+# in the input file up to which they were counted: just after the last
+# complete line (a line that's still being written is left for the
+# next run).  The next run analyzes the file from that offset on and
+# adds the counts in, so a log that's appended to only costs the new
+# lines.
+#
+# If the input is a different file than last time, is now shorter
+# than the offset, or the bytes just before the offset have changed,
+# it's not the same log with lines appended (e.g., it's a new export),
+# so the analysis starts over from the beginning.
+#
+# Only the summary is cumulative: --events and the EventIndex reports
+# cover just the new lines.
+
+state_version     = 1
+state_check_bytes = 64
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
 
-        msg = row[2]
+    if state.get('version') != state_version:
+        return None
 
-        # Analyze it
+    return state
+
+# Write to a temporary file and rename it into place, so a crash
+# can't leave a half-written state file
+def write_state(filename, state):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, filename)
+
+# The bytes just before offset, to check that the file hasn't been
+# replaced
+def state_check(f, offset):
+    start = max(0, offset - state_check_bytes)
+    f.seek(start)
+
+    return f.read(offset - start).hex()
+
+# The offset just after the last newline in the file
+def complete_end(f):
+    end = os.fstat(f.fileno()).st_size
+    while end > 0:
+        start = max(0, end - 65536)
+        f.seek(start)
+        block = f.read(end - start)
+        i = block.rfind(b'\n')
+        if i >= 0:
+            return start + i + 1
+        end = start
+
+    return 0
+
+def analyze_incremental(filename, state_filename, summary, events_out=None,
+                        classifier=default_classifier, jobs=1,
+                        chunk_size=default_chunk_size * 1024 * 1024,
+                        index=None):
+    input = os.path.abspath(filename)
+    state = read_state(state_filename)
+
+    with open(filename, 'rb') as f:
+        end   = complete_end(f)
+        start = None
+        if state is not None:
+            offset = state['offset']
+            if (state['input'] == input and offset <= end and
+                state_check(f, offset) == state['check']):
+                summary.merge(Summary.from_dict(state['summary']))
+                # (0: nothing, not even the header, was read last time)
+                start = offset or None
+            else:
+                print("{f} is not the file in {s}; starting over"
+                      .format(f=filename, s=state_filename), file=sys.stderr)
+
+        check = state_check(f, end)
+
+    if jobs > 1:
+        analyze_parallel(filename, summary, events_out, classifier,
+                         jobs=jobs, chunk_size=chunk_size, index=index,
+                         start=start, end=end)
+    else:
+        for chunk_start, chunk_end in chunk_ranges(filename, chunk_size,
+                                                   start, end):
+            analyze_range(filename, chunk_start, chunk_end, summary,
+                          events_out, classifier, index)
+
+    write_state(state_filename, {
+        'version' : state_version,
+        'input'   : input,
+        'offset'  : end,
+        'check'   : check,
+        'summary' : summary.as_dict(),
+    })
+
+    return summary
 
-        item = None
-        if item is None:
-            item = find_coverage(d, msg)
-        if item is None:
-            item = find_rogue(d, msg)
-        if item is None:
-            item = find_profile(d, msg)
-        if item is None:
-            item = find_rf_manager(d, msg)
-        if item is None:
-            item = find_attack(d, msg)
-        if item is None:
-            item = find_unknown(d, msg)
+#####################################################################
 
-        # Save it
+# Fake data, for testing and benchmarking without real controller
+# logs (see benchmark-analyzer.py and fake-syslog-sender.py).
+#
+# Synthetic log messages, in roughly the proportions of a real export
+# (about half of the messages don't match any rule).
+fake_unknown_messages = [
+    'Client Excluded: MACAddress:{client} Base Radio MAC :{ap} Slot: 0 User Name: unknown Ip Address: unknown Reason:802.11 Association failed repeatedly. ReasonCode: 1',
+    'AP Disassociated. Base Radio MAC:{ap}',
+    'Interface no:0(802.11b) with Base Radio MAC: {ap} AP Name: {ap_name} is up',
+    'Authentication failure for user "admin"',
+]
+
+fake_messages = [
+    # cumulative fraction, message
+    (0.05, 'Coverage hole pre alarm for client[{n}] {client} on 802.11a interface of AP {ap} ({ap_name})'),
+    (0.20, 'Rogue AP: {rogue} detected on Base Radio MAC: {ap} Interface no: 0(802.11b) with RSSI: -80 and SNR: 10 and Classification: unclassified'),
+    (0.30, 'Rogue AP : {rogue} removed from Base Radio MAC : {ap} Interface no:1(802.11a)'),
+    (0.35, 'Rogue AP : {rogue} not heard with any of our APs for {seconds} seconds'),
+    (0.40, '{profile} Profile Failed for Base Radio MAC: {ap} and slotNo: 0'),
+    (0.45, 'RF Manager updated {setting} for Base Radio MAC: {ap} and slotNo: 1'),
+    (0.47, 'Warning: Our AP with Base Radio MAC {ap} is under attack ({n}) by {rogue}'),
+]
+
+fake_severities = [ 'Critical', 'Major', 'Minor', 'Info' ]
+
+def fake_mac(prefix, i):
+    return prefix + ':' + ':'.join(['{x:02x}'.format(x=(i >> shift) & 0xff)
+                                    for shift in [24, 16, 8, 0]])
+
+def fake_message(rnd):
+    i = rnd.randrange(40)
+    values = {
+        'n'       : rnd.randrange(1, 10),
+        'client'  : fake_mac('aa:bb', rnd.randrange(5000)),
+        'ap'      : fake_mac('00:11', i),
+        'ap_name' : 'AP-{i:02d}'.format(i=i),
+        'rogue'   : fake_mac('66:55', rnd.randrange(500)),
+        'seconds' : rnd.randrange(1, 6) * 600,
+        'profile' : rnd.choice([ 'Interference', 'Noise', 'Load', 'Coverage' ]),
+        'setting' : rnd.choice([ 'Channel', 'TxPower' ]),
+    }
 
-        t = item['type']
-        if t not in types_found:
-            types_found[t] = 0
-        types_found[t] = types_found[t] + 1
+    r = rnd.random()
+    for fraction, message in fake_messages:
+        if r < fraction:
+            return message.format(**values)
+    return rnd.choice(fake_unknown_messages).format(**values)
+
+# Rows like the controller-logs.csv export: severity, timestamp,
+# message.  About 3 messages a second, and the occasional
+# unparseable timestamp.
+def fake_log_rows(lines, seed=0, start=1537000000):
+    rnd = random.Random(seed)
+    for i in range(lines):
+        timestamp = time.strftime('%a %b %d %H:%M:%S %Y',
+                                  time.gmtime(start + i // 3))
+        if rnd.random() < 0.001:
+            timestamp = 'garbage'
+        yield [ rnd.choice(fake_severities), timestamp, fake_message(rnd) ]
 
-        if d not in logs:
-            logs[d] = list()
+#####################################################################
 
-        item['timestamp'] = d
-        item['msg'] = msg
+def print_rogue_hours(index, summary, start, end, file):
+    counts = index.count_by_ap_hour('rogue AP detected', start, end)
+    print("Rogue AP detections per AP per hour:", file=file)
+    for (ap, hour), count in sorted(counts.items(), key=lambda x: (x[0][1], x[0][0])):
+        print("{hour} {ap} {name} {count}"
+              .format(hour=epoch_datetime(hour).isoformat(), ap=ap,
+                      name=summary.mercy_ap_macs.get(ap, '-'), count=count),
+              file=file)
+
+def print_coverage_holes(index, summary, start, end, file):
+    holes = index.events('coverage hole', start, end)
+    print("Coverage holes:", file=file)
+    for t, ap, client in holes:
+        print("{time} {ap} {name} {client}"
+              .format(time=epoch_datetime(t).isoformat(), ap=ap,
+                      name=summary.mercy_ap_macs.get(ap, '-'), client=client),
+              file=file)
 
-        logs[d].append(item)
+#####################################################################
 
-pp = pprint.PrettyPrinter()
-pp.pprint(logs)
-pp.pprint(mercy_ap_macs)
-pp.pprint(rogue_ap_macs)
-pp.pprint(types_found)
+def parse_time(value):
+    return datetime_epoch(datetime.fromisoformat(value))
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Analyze a CSV export of the wireless controller logs')
+
+    parser.add_argument('input',
+                        nargs='?',
+                        default=default_input,
+                        help='CSV file to analyze ("-" for stdin; default: {d})'
+                        .format(d=default_input))
+    parser.add_argument('--events',
+                        metavar='FILE',
+                        help='Write each event as a line of JSON to this file ("-" for stdout)')
+    parser.add_argument('--rules',
+                        metavar='FILE',
+                        help='JSON file of additional classification rules, tried after the built-in ones')
+    parser.add_argument('--rogue-hours',
+                        action='store_true',
+                        help='Report rogue AP detections per AP per hour')
+    parser.add_argument('--coverage-holes',
+                        action='store_true',
+                        help='List the coverage holes')
+    parser.add_argument('--start',
+                        metavar='TIME',
+                        help='Limit --rogue-hours and --coverage-holes to events at or after this time (e.g., 2018-09-16T08:00)')
+    parser.add_argument('--end',
+                        metavar='TIME',
+                        help='Limit --rogue-hours and --coverage-holes to events before this time')
+    parser.add_argument('--state',
+                        metavar='FILE',
+                        help='Keep the counts in this file, and only analyze the lines added to the input since the last run')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes (0 for one per CPU; default: 1)')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=default_chunk_size,
+                        metavar='MB',
+                        help='Size of the chunks of the file given to each worker with --jobs (default: {d})'
+                        .format(d=default_chunk_size))
+
+    args = parser.parse_args()
+
+    if args.jobs < 0:
+        parser.error("--jobs must be >= 0")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be >= 1")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count()
+    if args.jobs > 1 and args.input == '-':
+        parser.error("--jobs needs an input file, not stdin")
+    if args.state and args.input == '-':
+        parser.error("--state needs an input file, not stdin")
+    for name in [ 'start', 'end' ]:
+        value = getattr(args, name)
+        if value is not None:
+            try:
+                setattr(args, name, parse_time(value))
+            except ValueError:
+                parser.error("Invalid --{name} time: {value}"
+                             .format(name=name, value=value))
+
+    return args
+
+def open_input(filename):
+    if filename == '-':
+        return sys.stdin
+    return open(filename, newline='', errors='replace')
+
+def open_output(filename):
+    if filename is None:
+        return None
+    if filename == '-':
+        return sys.stdout
+    return open(filename, 'w')
+
+def main():
+    args = setup_cli()
+
+    rules = list(default_rules)
+    if args.rules:
+        rules.extend(load_rules(args.rules))
+    classifier = Classifier(rules)
+
+    summary    = Summary()
+    events_out = open_output(args.events)
+    index      = None
+    if args.rogue_hours or args.coverage_holes:
+        index = EventIndex()
+
+    if args.state:
+        analyze_incremental(args.input, args.state, summary, events_out,
+                            classifier, jobs=args.jobs,
+                            chunk_size=args.chunk_size * 1024 * 1024,
+                            index=index)
+    elif args.jobs > 1:
+        analyze_parallel(args.input, summary, events_out, classifier,
+                         jobs=args.jobs,
+                         chunk_size=args.chunk_size * 1024 * 1024,
+                         index=index)
+    else:
+        with open_input(args.input) as f:
+            analyze(f, summary, events_out, classifier, index)
+
+    if events_out is not None and events_out is not sys.stdout:
+        events_out.close()
+
+    # Keep the summary out of the way of the events if they're both
+    # going to stdout
+    out = sys.stderr if events_out is sys.stdout else sys.stdout
+    summary.print(file=out)
+
+    if index is not None:
+        index.finish()
+    if args.rogue_hours:
+        print_rogue_hours(index, summary, args.start, args.end, out)
+    if args.coverage_holes:
+        print_coverage_holes(index, summary, args.start, args.end, out)
+
+if __name__ == "__main__":
+    main()
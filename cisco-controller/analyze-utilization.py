@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+# Wi-Fi utilization analytics over gather-controller-logs.py
+# databases (e.g., a month of daily files, or a --partition
+# database).  The sightings are loaded into NumPy arrays and all the
+# analysis is done in bulk (no Python loops over rows):
+#
+# - Per-AP occupancy: average number of clients on each AP by hour of
+#   the day (from ap_sightings.num_clients)
+# - Peak concurrency by hour: the most clients seen in a single poll,
+#   by hour of the day
+# - 2.4 vs. 5 GHz band split, overall and per AP
+# - Roaming: how many times each client moved to a different AP
+#   between consecutive sightings
+#
+# Example:
+#   ./analyze-utilization.py ~/data/2018-10-*.sqlite3
+#
+# Requires numpy ("pip install numpy").
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+################################################################
+
+default_top      = 10
+# Well under the gatherer's shortest --interval (60 seconds), so that
+# a little jitter between polls doesn't merge two of them into one
+default_poll_gap = 30
+fetch_size       = 100000
+
+bands = [
+    # name, lowest frequency (GHz x 10)
+    ('2.4 GHz', 20),
+    ('5 GHz',   40),
+]
+
+################################################################
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Wi-Fi utilization analytics')
+
+    parser.add_argument('databases',
+                        nargs='+',
+                        metavar='DB',
+                        help='gather-controller-logs.py SQLite3 database(s) to analyze')
+    parser.add_argument('--top',
+                        type=int,
+                        default=default_top,
+                        metavar='N',
+                        help='Show the top N APs / clients in each list (default: {d})'
+                        .format(d=default_top))
+    parser.add_argument('--poll-gap',
+                        type=int,
+                        default=default_poll_gap,
+                        metavar='SECONDS',
+                        help='Sightings (without a poll id, i.e., not --delta) more than this many seconds apart are from different polls (default: {d})'
+                        .format(d=default_poll_gap))
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='Enable extra output for debugging')
+
+    args = parser.parse_args()
+
+    return args
+
+#---------------------------------------------------------------
+
+def setup_logging(args):
+    log = logging.getLogger('AnalyzeUtilization')
+    level = logging.INFO
+    if args.debug:
+        level = logging.DEBUG
+    log.setLevel(level)
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(level)
+
+    format = '%(asctime)s %(levelname)s: %(message)s'
+    formatter = logging.Formatter(format)
+
+    ch.setFormatter(formatter)
+
+    log.addHandler(ch)
+
+    return log
+
+################################################################
+
+# Names of APs / clients across all the databases (the ids in each
+# database's index tables are only good in that database).
+class Names:
+    def __init__(self):
+        self.codes = dict()
+        self.names = list()
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+        return code
+
+# Map a database's index table ids to codes in "names", as an array
+# indexed by id (-1 for ids that aren't there).
+def read_lookup(cur, sql, names):
+    rows   = cur.execute(sql).fetchall()
+    size   = max([ row[0] for row in rows ], default=0) + 1
+    lookup = numpy.full(size, -1, dtype=numpy.int64)
+    for id, name in rows:
+        lookup[id] = names.code(name)
+    return lookup
+
+# Read an all-integer query into a 2D array, a batch at a time (so
+# that we don't have millions of row tuples around at once).
+def read_array(cur, sql, columns):
+    cur.execute(sql)
+    chunks = list()
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            break
+        chunks.append(numpy.array(rows, dtype=numpy.int64))
+    if not chunks:
+        return numpy.empty((0, columns), dtype=numpy.int64)
+    return numpy.concatenate(chunks)
+
+# Read a sightings table into an array: the time, then "fields".
+# Also returns the poll id of each sighting (-1 if it has none).
+#
+# --delta sightings are one row per run of polls in the same state
+# (see gather-controller-logs.py).  The *_series views would expand
+# them to one row per poll, but it's much faster to read the runs
+# and the polls and expand them here.
+def read_sightings(cur, table, heartbeats, fields):
+    # With --partition, the *_all view spans the partitions
+    sql = "SELECT name FROM sqlite_master WHERE type='view' AND name=?"
+    source = table
+    if cur.execute(sql, (table + '_all',)).fetchone():
+        source = table + '_all'
+
+    timestamp = "CAST(strftime('%s', s.timestamp) AS INTEGER)"
+    columns   = [ row[1] for row in cur.execute('PRAGMA table_info({t})'.format(t=table)) ]
+    if 'poll_id' not in columns:
+        plain = read_array(cur, 'SELECT {ts},{fields} FROM {source} s'
+                           .format(ts=timestamp, fields=fields, source=source),
+                           len(fields.split(',')) + 1)
+        return plain, numpy.full(len(plain), -1, dtype=numpy.int64)
+
+    plain = read_array(cur, 'SELECT {ts},{fields} FROM {source} s WHERE s.poll_id IS NULL'
+                       .format(ts=timestamp, fields=fields, source=source),
+                       len(fields.split(',')) + 1)
+    runs  = read_array(cur, 'SELECT s.poll_id,coalesce(s.last_poll_id,h.last_poll_id,s.poll_id),{fields} '
+                       'FROM {source} s LEFT JOIN {hb} h ON h.sighting_id = s.id '
+                       'WHERE s.poll_id IS NOT NULL'
+                       .format(fields=fields, source=source, hb=heartbeats),
+                       len(fields.split(',')) + 2)
+    polls = read_array(cur, "SELECT id,CAST(strftime('%s', timestamp) AS INTEGER) "
+                       "FROM polls ORDER BY id", 2)
+
+    # Each run covers the polls from its first to its last poll id
+    first   = numpy.searchsorted(polls[:, 0], runs[:, 0])
+    lengths = numpy.searchsorted(polls[:, 0], runs[:, 1], side='right') - first
+    offsets = numpy.cumsum(lengths) - lengths
+    index   = (numpy.arange(lengths.sum()) +
+               numpy.repeat(first - offsets, lengths))
+
+    expanded = numpy.repeat(runs[:, 1:], lengths, axis=0)
+    expanded[:, 0] = polls[index, 1]
+
+    poll_ids = numpy.concatenate([ numpy.full(len(plain), -1, dtype=numpy.int64),
+                                   polls[index, 0] ])
+    return numpy.concatenate([ plain, expanded ]), poll_ids
+
+ap_sightings_fields     = 's.ap_index,s.num_clients'
+client_sightings_fields = ('s.client_index,s.ap_index,'
+                           'CAST(round(s.frequency_ghz * 10) AS INTEGER)')
+
+# Load the sightings from all the databases into arrays:
+#
+# ap_sightings:     time, ap, num_clients
+# client_sightings: time, client, ap, frequency (GHz x 10), poll
+#
+# Times are seconds since the epoch; APs and clients are codes in
+# data['aps'] / data['clients'].  Polls are the --delta poll ids,
+# made unique across the databases (-1 for sightings without one).
+def load_sightings(filenames, log):
+    aps     = Names()
+    clients = Names()
+    ap_arrays     = list()
+    client_arrays = list()
+    poll_arrays   = list()
+    poll_offset   = 0
+
+    for filename in filenames:
+        log.debug("Reading database: {db}".format(db=filename))
+        uri = 'file:{f}?mode=ro'.format(f=os.path.abspath(filename))
+        cur = sqlite3.connect(uri, uri=True).cursor()
+
+        ap_lookup     = read_lookup(cur, 'SELECT id,name FROM aps', aps)
+        client_lookup = read_lookup(cur, 'SELECT id,mac FROM clients', clients)
+
+        a, _ = read_sightings(cur, 'ap_sightings', 'ap_heartbeats',
+                              ap_sightings_fields)
+        a[:, 1] = ap_lookup[a[:, 1]]
+        ap_arrays.append(a)
+
+        c, polls = read_sightings(cur, 'client_sightings', 'client_heartbeats',
+                                  client_sightings_fields)
+        c[:, 1] = client_lookup[c[:, 1]]
+        c[:, 2] = ap_lookup[c[:, 2]]
+        client_arrays.append(c)
+
+        polled = polls >= 0
+        if polled.any():
+            polls[polled] += poll_offset
+            poll_offset    = polls.max() + 1
+        poll_arrays.append(polls)
+
+        cur.connection.close()
+
+    a = numpy.concatenate(ap_arrays)
+    c = numpy.concatenate(client_arrays)
+    p = numpy.concatenate(poll_arrays)
+    log.info("Loaded {a} AP sightings and {c} client sightings of {na} APs and {nc} clients"
+             .format(a=len(a), c=len(c), na=len(aps.names), nc=len(clients.names)))
+
+    return {
+        'aps'              : aps.names,
+        'clients'          : clients.names,
+        'ap_sightings'     : {
+            'time'         : a[:, 0],
+            'ap'           : a[:, 1],
+            'num_clients'  : a[:, 2],
+        },
+        'client_sightings' : {
+            'time'         : c[:, 0],
+            'client'       : c[:, 1],
+            'ap'           : c[:, 2],
+            'frequency'    : c[:, 3],
+            'poll'         : p,
+        },
+    }
+
+################################################################
+
+# Local hour of the day (0-23) of each time.  There are only a few
+# hundred distinct hours in a month, so convert each one with
+# localtime() (which gets DST right), not each time.
+def local_hours(times):
+    hours, inverse = numpy.unique(times // 3600, return_inverse=True)
+    local = numpy.array([ time.localtime(h * 3600).tm_hour for h in hours ],
+                        dtype=numpy.int64)
+    return local[inverse]
+
+# Max of "values" for each key in 0..n-1 (-1 where there are none)
+def group_max(keys, values, n):
+    result = numpy.full(n, -1, dtype=values.dtype)
+    if len(keys) == 0:
+        return result
+    order  = numpy.lexsort((values, keys))
+    keys   = keys[order]
+    last   = numpy.flatnonzero(numpy.diff(keys)) + 1
+    last   = numpy.append(last, len(keys)) - 1
+    result[keys[last]] = values[order][last]
+    return result
+
+#---------------------------------------------------------------
+
+# Per-AP occupancy curve: average num_clients on each AP for each
+# hour of the day (NaN where we have no samples), plus overall mean /
+# max per AP.
+def ap_occupancy(data):
+    s     = data['ap_sightings']
+    n     = len(data['aps'])
+    hours = local_hours(s['time'])
+    keys  = s['ap'] * 24 + hours
+
+    sums    = numpy.bincount(keys, weights=s['num_clients'], minlength=n * 24)
+    samples = numpy.bincount(keys, minlength=n * 24)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        curve = (sums / samples).reshape(n, 24)
+        mean  = (numpy.bincount(s['ap'], weights=s['num_clients'], minlength=n) /
+                 numpy.bincount(s['ap'], minlength=n))
+
+    return {
+        'curve' : curve,
+        'mean'  : mean,
+        'max'   : group_max(s['ap'], s['num_clients'], n),
+    }
+
+# Number of clients seen in each poll, in time order.  --delta
+# sightings have a poll id, so they're grouped by that.  The others
+# are grouped into polls by time: a gap of more than poll_gap seconds
+# starts a new poll.  (The sightings of one poll can straddle a few
+# seconds.)
+def poll_concurrency(data, poll_gap):
+    s      = data['client_sightings']
+    polled = s['poll'] >= 0
+
+    _, first, poll_counts = numpy.unique(s['poll'][polled],
+                                         return_index=True,
+                                         return_counts=True)
+    poll_times = s['time'][polled][first]
+
+    times = numpy.sort(s['time'][~polled])
+    if len(times):
+        starts = numpy.concatenate([ [0], numpy.flatnonzero(numpy.diff(times) > poll_gap) + 1 ])
+        counts = numpy.diff(numpy.append(starts, len(times)))
+        times  = times[starts]
+    else:
+        counts = times
+
+    times  = numpy.concatenate([ poll_times, times ])
+    counts = numpy.concatenate([ poll_counts, counts ])
+    order  = numpy.argsort(times, kind='stable')
+    return times[order], counts[order]
+
+# Peak (and average) concurrency for each hour of the day
+def peak_concurrency(data, poll_gap):
+    poll_times, counts = poll_concurrency(data, poll_gap)
+    hours = local_hours(poll_times)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = (numpy.bincount(hours, weights=counts, minlength=24) /
+                numpy.bincount(hours, minlength=24))
+
+    peak_poll = None
+    if len(counts):
+        i = numpy.argmax(counts)
+        peak_poll = (int(poll_times[i]), int(counts[i]))
+
+    return {
+        'polls' : len(counts),
+        'peak'  : group_max(hours, counts, 24),
+        'mean'  : mean,
+        'top'   : peak_poll,
+    }
+
+# Which band each client sighting is on: an index into "bands", or -1
+# if we don't know the frequency.
+def sighting_bands(data):
+    frequency = data['client_sightings']['frequency']
+    lows      = numpy.array([ low for _, low in bands ])
+    band      = numpy.searchsorted(lows, frequency, side='right') - 1
+    band[frequency <= 0] = -1
+    return band
+
+# Band split: sightings and distinct clients per band, and the
+# fraction of each AP's client sightings on each band.
+def band_split(data):
+    s    = data['client_sightings']
+    n    = len(data['aps'])
+    band = sighting_bands(data)
+
+    result = {
+        'sightings' : numpy.array([ numpy.count_nonzero(band == b)
+                                    for b in range(len(bands)) ]),
+        'clients'   : numpy.array([ len(numpy.unique(s['client'][band == b]))
+                                    for b in range(len(bands)) ]),
+        'unknown'   : numpy.count_nonzero(band < 0),
+    }
+
+    known  = band >= 0
+    per_ap = numpy.bincount(s['ap'][known] * len(bands) + band[known],
+                            minlength=n * len(bands)).reshape(n, len(bands))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        result['ap_fraction'] = per_ap / per_ap.sum(axis=1, keepdims=True)
+
+    return result
+
+# Roams per client: the number of times consecutive sightings of a
+# client are on different APs.
+def roaming_counts(data):
+    s     = data['client_sightings']
+    n     = len(data['clients'])
+    order = numpy.lexsort((s['time'], s['client']))
+    c     = s['client'][order]
+    a     = s['ap'][order]
+    roams = (c[1:] == c[:-1]) & (a[1:] != a[:-1])
+    return numpy.bincount(c[1:][roams], minlength=n)
+
+################################################################
+
+def hour_row(values, fmt):
+    return ' '.join([ '  -' if numpy.isnan(v) or v < 0 else fmt.format(v)
+                      for v in values ])
+
+def report(data, args):
+    aps     = data['aps']
+    clients = data['clients']
+    top     = args.top
+
+    print("Hours:            " + ' '.join([ '{h:3d}'.format(h=h) for h in range(24) ]))
+
+    occupancy = ap_occupancy(data)
+    busiest   = numpy.argsort(numpy.nan_to_num(occupancy['mean'], nan=-1))[::-1][:top]
+    print()
+    print("Per-AP occupancy (average clients by hour), top {n} APs by average:"
+          .format(n=top))
+    for ap in busiest:
+        print("  {name:16.16s}".format(name=aps[ap]) +
+              hour_row(occupancy['curve'][ap], '{:3.0f}') +
+              "   avg {m:.1f} max {x}".format(m=occupancy['mean'][ap],
+                                           x=occupancy['max'][ap]))
+
+    concurrency = peak_concurrency(data, args.poll_gap)
+    print()
+    print("Concurrency by hour ({n} polls):".format(n=concurrency['polls']))
+    print("  {name:16.16s}".format(name='peak') +
+          hour_row(concurrency['peak'], '{:3.0f}'))
+    print("  {name:16.16s}".format(name='average') +
+          hour_row(concurrency['mean'], '{:3.0f}'))
+    if concurrency['top']:
+        when, num = concurrency['top']
+        print("  Peak: {num} clients at {when}"
+              .format(num=num, when=time.strftime('%Y-%m-%d %H:%M', time.localtime(when))))
+
+    split = band_split(data)
+    print()
+    print("Band split:")
+    total = split['sightings'].sum()
+    for b, (name, _) in enumerate(bands):
+        print("  {name:8s} {s:10d} sightings ({p:5.1f}%), {c} distinct clients"
+              .format(name=name, s=split['sightings'][b],
+                      p=100 * split['sightings'][b] / total if total else 0,
+                      c=split['clients'][b]))
+    if split['unknown']:
+        print("  unknown  {s:10d} sightings".format(s=split['unknown']))
+    print("  APs with the most 2.4 GHz clients (fraction of sightings):")
+    fraction = numpy.nan_to_num(split['ap_fraction'][:, 0], nan=-1)
+    for ap in numpy.argsort(fraction)[::-1][:top]:
+        if fraction[ap] < 0:
+            break
+        print("    {name:16.16s} {p:5.1f}%".format(name=aps[ap], p=100 * fraction[ap]))
+
+    roams = roaming_counts(data)
+    print()
+    print("Roaming: {r} roams by {c} of {n} clients"
+          .format(r=roams.sum(), c=numpy.count_nonzero(roams), n=len(clients)))
+    for client in numpy.argsort(roams)[::-1][:top]:
+        if roams[client] == 0:
+            break
+        print("  {mac:18s} {r}".format(mac=clients[client], r=roams[client]))
+
+################################################################
+
+def main():
+    args = setup_cli()
+    log  = setup_logging(args)
+
+    if numpy is None:
+        log.error("This script needs numpy (e.g., \"pip install numpy\")")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    data  = load_sightings(args.databases, log)
+    log.info("Loaded in {t:.2f}s".format(t=time.perf_counter() - start))
+
+    start = time.perf_counter()
+    report(data, args)
+    log.info("Analyzed in {t:.2f}s".format(t=time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
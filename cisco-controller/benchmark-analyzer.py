@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Benchmarks for analyze-controller-logs.py, on a synthetic
+# controller log (from analyze-controller-logs.py's fake message
+# generator; no real logs needed).
+#
+# Example:
+#   ./benchmark-analyzer.py classify --lines 1000000
+#   ./benchmark-analyzer.py parallel --lines 1000000 --jobs 4
+#   ./benchmark-analyzer.py timestamps --lines 1000000
+#   ./benchmark-analyzer.py index --lines 1000000
+#
+# --csv FILE also writes the synthetic log to FILE (e.g., to run
+# analyze-controller-logs.py on it).
+
+import argparse
+import calendar
+import csv
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from script_loader import load_analyzer
+
+################################################################
+
+default_lines = 1000000
+
+################################################################
+
+def timed(fn, *args, **kwargs):
+    start  = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+################################################################
+
+def write_fake_csv(a, filename, lines, seed=0):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([ 'Severity', 'Time', 'Message' ])
+        for row in a.fake_log_rows(lines, seed):
+            writer.writerow(row)
+
+################################################################
+
+# The old way: try each rule's regex in turn
+def legacy_classify(a, rules, msg):
+    for rule in rules:
+        m = rule.regex.match(msg)
+        if m:
+            item = { 'type' : rule.type }
+            for field, value in zip(rule.fields, m.groups()):
+                if field is not None:
+                    item[field] = value
+            return item
+
+    return { 'type' : a.unknown_type }
+
+# Time classifying the messages one rule at a time vs. with the
+# combined regex, and check that they agree.
+def bench_classify(a, args, log):
+    messages = [ row[2] for row in a.fake_log_rows(args.lines) ]
+
+    def _legacy():
+        return [ legacy_classify(a, a.default_rules, msg) for msg in messages ]
+
+    def _combined():
+        classifier = a.default_classifier
+        return [ classifier.classify(msg) for msg in messages ]
+
+    legacy, legacy_time     = timed(_legacy)
+    combined, combined_time = timed(_combined)
+    assert legacy == combined
+
+    unknown = sum([ 1 for item in combined if item['type'] == a.unknown_type ])
+    print("classify: {n} messages ({u} unknown): one rule at a time {l:.2f}s, combined regex {c:.2f}s"
+          .format(n=len(messages), u=unknown, l=legacy_time, c=combined_time))
+
+# Time analyzing a CSV file serially vs. in --jobs worker processes,
+# and check that the summaries are the same.
+def bench_parallel(a, args, log):
+    with tempfile.TemporaryDirectory() as dir:
+        filename = os.path.join(dir, 'controller-logs.csv')
+        write_fake_csv(a, filename, args.lines)
+
+        def _serial():
+            with a.open_input(filename) as f:
+                return a.analyze(f, a.Summary())
+
+        def _parallel():
+            return a.analyze_parallel(filename, a.Summary(), jobs=args.jobs,
+                                      chunk_size=args.chunk_size * 1024 * 1024)
+
+        serial, serial_time     = timed(_serial)
+        parallel, parallel_time = timed(_parallel)
+
+    assert serial.types_found == parallel.types_found
+    assert serial.mercy_ap_macs == parallel.mercy_ap_macs
+    assert serial.rogue_ap_macs == parallel.rogue_ap_macs
+
+    print("parallel: {n} lines: serial {s:.2f}s, {j} jobs {p:.2f}s ({x:.1f}x)"
+          .format(n=args.lines, s=serial_time, j=args.jobs,
+                  p=parallel_time, x=serial_time / parallel_time))
+
+# The old way: a regex match, a linear search of the month names, and
+# a new datetime for every row
+def legacy_parse_timestamp(a, value):
+    m = a.date_re.match(value)
+    if not m:
+        return None
+
+    mon  = a.months.index(m.group(1))
+    day  = int(m.group(2))
+    year = int(m.group(6))
+
+    hour = int(m.group(3))
+    min  = int(m.group(4))
+    sec  = int(m.group(5))
+
+    return a.datetime(year=year, month=mon, day=day, hour=hour,
+                      minute=min, second=sec)
+
+# Time parsing the timestamps the old way vs. with TimestampDecoder
+# (datetimes and epoch seconds), and check that they agree.
+def bench_timestamps(a, args, log):
+    values = [ row[1] for row in a.fake_log_rows(args.lines) ]
+
+    def _legacy():
+        return [ legacy_parse_timestamp(a, value) for value in values ]
+
+    def _decoder():
+        decode = a.TimestampDecoder().decode
+        return [ decode(value) for value in values ]
+
+    def _epoch():
+        decode = a.TimestampDecoder(epoch=True).decode
+        return [ decode(value) for value in values ]
+
+    legacy, legacy_time   = timed(_legacy)
+    decoded, decoder_time = timed(_decoder)
+    epochs, epoch_time    = timed(_epoch)
+
+    assert legacy == decoded
+    assert epochs == [ None if d is None else calendar.timegm(d.timetuple())
+                       for d in legacy ]
+
+    print("timestamps: {n} rows ({u} unique): legacy {l:.2f}s, decoder {d:.2f}s, epoch {e:.2f}s"
+          .format(n=len(values), u=len(set(values)), l=legacy_time,
+                  d=decoder_time, e=epoch_time))
+
+    # The cache misses on their own: each unique timestamp parsed once
+    unique = list(dict.fromkeys(values))
+
+    def _datetime_epoch():
+        return [ None if d is None else a.datetime_epoch(d)
+                 for d in map(a.parse_timestamp, unique) ]
+
+    def _direct_epoch():
+        return [ a.parse_timestamp_epoch(value) for value in unique ]
+
+    via_datetime, via_datetime_time = timed(_datetime_epoch)
+    direct, direct_time             = timed(_direct_epoch)
+    assert via_datetime == direct
+
+    print("timestamps: {u} unique: epoch via datetime {v:.2f}s, direct {d:.2f}s"
+          .format(u=len(unique), v=via_datetime_time, d=direct_time))
+
+# Build the old datetime-keyed dict of lists of events
+def legacy_logs(items):
+    logs = dict()
+    for item in items:
+        d = item['timestamp']
+        if d not in logs:
+            logs[d] = list()
+        logs[d].append(item)
+
+    return logs
+
+# Rogue AP detections per AP per hour in a window, from the old dict:
+# look at every event
+def legacy_rogue_hours(logs, start, end):
+    counts = dict()
+    for d, items in logs.items():
+        if not (start <= d < end):
+            continue
+        for item in items:
+            if item['type'] == 'rogue AP detected':
+                key = (item['ap'], d.replace(minute=0, second=0))
+                counts[key] = counts.get(key, 0) + 1
+
+    return counts
+
+def traced(fn):
+    tracemalloc.start()
+    result = fn()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, size
+
+# Memory and query time of the old datetime-keyed dict vs. EventIndex,
+# for the rogue detections per AP per hour in 100 two-hour windows.
+def bench_index(a, args, log):
+    def _items():
+        return a.classify_messages(a.parse_rows(a.fake_log_rows(args.lines)))
+
+    def _index():
+        index = a.EventIndex()
+        for item in _items():
+            index.add(item)
+        index.finish()
+        return index
+
+    logs, logs_size   = traced(lambda: legacy_logs(_items()))
+    index, index_size = traced(_index)
+
+    first   = index.times[0]
+    last    = index.times[-1]
+    windows = [ (t, t + 7200)
+                for t in range(first, max(first + 1, last - 7200),
+                               max(1, (last - first) // 100)) ][:100]
+
+    def _legacy():
+        return [ legacy_rogue_hours(logs, a.epoch_datetime(start),
+                                    a.epoch_datetime(end))
+                 for start, end in windows ]
+
+    def _indexed():
+        return [ index.count_by_ap_hour('rogue AP detected', start, end)
+                 for start, end in windows ]
+
+    legacy, legacy_time   = timed(_legacy)
+    indexed, indexed_time = timed(_indexed)
+
+    for old, new in zip(legacy, indexed):
+        assert old == { (ap, a.epoch_datetime(hour)) : count
+                        for (ap, hour), count in new.items() }
+
+    print("index: {n} events: dict {ls:.1f}MB, index {xs:.1f}MB; {w} window queries: dict {lt:.2f}s, index {xt:.2f}s"
+          .format(n=len(index.times), ls=logs_size / 1e6, xs=index_size / 1e6,
+                  w=len(windows), lt=legacy_time, xt=indexed_time))
+
+#---------------------------------------------------------------
+
+benchmarks = {
+    'classify'   : bench_classify,
+    'parallel'   : bench_parallel,
+    'timestamps' : bench_timestamps,
+    'index'      : bench_index,
+}
+
+################################################################
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Benchmark analyze-controller-logs.py')
+
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        metavar='BENCHMARK',
+                        help='Benchmarks to run (default: all): {names}'
+                        .format(names=', '.join(benchmarks.keys())))
+    parser.add_argument('--lines',
+                        type=int,
+                        default=default_lines,
+                        help='Number of synthetic log lines (default: {d})'
+                        .format(d=default_lines))
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Worker processes for the parallel benchmark (default: one per CPU)')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=16,
+                        metavar='MB',
+                        help='Chunk size for the parallel benchmark (default: 16)')
+    parser.add_argument('--csv',
+                        metavar='FILE',
+                        help='Also write the synthetic log to this CSV file')
+
+    args = parser.parse_args()
+
+    if len(args.benchmarks) == 0:
+        args.benchmarks = list(benchmarks.keys())
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("Unknown benchmark: {name}".format(name=name))
+
+    return args
+
+def main():
+    args = setup_cli()
+
+    log = logging.getLogger('benchmark')
+    log.setLevel(logging.WARNING)
+
+    a = load_analyzer()
+
+    if args.csv:
+        write_fake_csv(a, args.csv, args.lines)
+    for name in args.benchmarks:
+        benchmarks[name](a, args, log)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the hot paths in gather-controller-logs.py.
+# Nothing here talks to a real controller; all the data is synthetic.
+#
+# Example:
+#   ./benchmark-gatherer.py index-tables --sizes 10000 100000 1000000
+#   ./benchmark-gatherer.py sightings --gathered 5000
+#   ./benchmark-gatherer.py parsers --lines 50000
+#   ./benchmark-gatherer.py logging --gathered 5000
+#   ./benchmark-gatherer.py collect --controllers 4 --gathered 2000
+
+import argparse
+import ast
+import logging
+import os
+import re
+import time
+
+from pprint import pformat
+from script_loader import load_gatherer
+
+################################################################
+
+default_sizes = [ 10000, 100000, 1000000 ]
+
+################################################################
+
+def fake_mac(i):
+    return ':'.join(['{x:02x}'.format(x=(i >> shift) & 0xff)
+                     for shift in [40, 32, 24, 16, 8, 0]])
+
+#---------------------------------------------------------------
+
+def timed(fn, *args, **kwargs):
+    start  = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+################################################################
+
+# The original code (before the natural-key indexes): every index
+# table read in full into dicts of rows, and then for each gathered
+# row, a field-by-field linear scan of all the stored rows.  That's
+# O(gathered x stored), so it's only run for the smaller --sizes (see
+# --baseline-max).
+def baseline_db_insert(cur, table_name, field_names, values, log):
+    sql              = 'INSERT INTO {name} ('.format(name=table_name)
+    sql2             = ') VALUES ('
+    first            = True
+    processed_values = list()
+    for fname in field_names:
+        the_value = None
+        if fname == 'controller_id' and 'controller' in values:
+            the_value = values['controller']['db_id']
+        elif fname not in values:
+            continue
+
+        if not first:
+            sql  += ','
+            sql2 += ','
+        sql  += fname
+        if not the_value:
+            the_value = values[fname]
+        sql2 += '?'
+        processed_values.append(the_value)
+
+        first = False
+
+    sql += sql2 + ')'
+
+    log.debug("Executing SQL insert: {sql} / {values}"
+              .format(sql=sql, values=processed_values))
+    cur.execute(sql, processed_values)
+    db_id = cur.lastrowid
+
+    log.info("Added to {name} index table: {sql} / {values}"
+             .format(name=table_name, sql=sql, values=processed_values))
+
+    return db_id
+
+def baseline_read_tables(g, cur, schemas, log):
+    db = dict()
+    for name in g.index_table_keys:
+        sql         = 'PRAGMA table_info({name})'.format(name=name)
+        field_names = [ row[1] for row in cur.execute(sql).fetchall() ]
+
+        rows = dict()
+        for row in cur.execute('SELECT * FROM {table}'.format(table=name)).fetchall():
+            data = dict()
+            for fname in field_names:
+                data[fname] = row[fname]
+            rows[data['id']] = data
+
+        db[name] = {
+            'field_names' : field_names,
+            'rows'        : rows,
+        }
+
+    return db
+
+def baseline_update_index_tables(g, cur, db, controllers, log):
+    def _compare(table_name, gathered_data):
+        table             = db[table_name]
+        table_field_names = table['field_names']
+        for _, gathered_row in gathered_data.items():
+            matched = False
+            for _, table_row in table['rows'].items():
+                matched = True
+                for fname in table_field_names:
+                    if fname not in gathered_row:
+                        continue
+
+                    log.debug("  ==> Comparing {field}: {a} vs. {b}"
+                              .format(field=fname,
+                                      a=gathered_row[fname],
+                                      b=table_row[fname]))
+                    if gathered_row[fname] != table_row[fname]:
+                        matched = False
+                        break
+
+                if matched:
+                    break
+
+            if matched:
+                db_id = table_row['id']
+            else:
+                db_id = baseline_db_insert(cur, table_name,
+                                           table_field_names,
+                                           gathered_row, log)
+            gathered_row['db_id'] = db_id
+        cur.connection.commit()
+
+    _compare('controllers', controllers)
+    for _, controller in controllers.items():
+        for table_name in [ 'wlans', 'aps', 'clients' ]:
+            _compare(table_name, controller[table_name])
+
+#---------------------------------------------------------------
+
+# The natural-key indexes as first added (before the fix that made
+# db_table_read() read plain tuples and db_insert() cache its SQL):
+# hashed lookups, but the keys read as sqlite3.Row objects, and the
+# INSERT statement rebuilt (and an INFO message formatted) for every
+# new row.
+def rows_read_tables(g, cur, schemas, log):
+    db = dict()
+    for name in g.index_table_keys:
+        sql    = ("SELECT id,{fields} FROM {table} ORDER BY id"
+                  .format(table=name,
+                          fields=','.join(g.index_table_keys[name])))
+        getter = g.index_key_getters[name]
+        index  = dict()
+        for row in cur.execute(sql):
+            key = getter(row)
+            if key not in index:
+                index[key] = row['id']
+
+        field_names = [ row[1] for row in
+                        cur.execute('PRAGMA table_info({name})'.format(name=name)) ]
+        db[name] = {
+            'field_names' : field_names,
+            'index'       : index,
+        }
+
+    return db
+
+def rows_update_index_tables(g, cur, db, controllers, log):
+    def _compare(table_name, gathered_data):
+        table = db[table_name]
+        index = table['index']
+        for _, gathered_row in gathered_data.items():
+            key   = g.index_key(table_name, gathered_row)
+            db_id = index.get(key)
+            if db_id is None:
+                db_id = baseline_db_insert(cur, table_name,
+                                           table['field_names'],
+                                           gathered_row, log)
+                index[key] = db_id
+            gathered_row['db_id'] = db_id
+        cur.connection.commit()
+
+    _compare('controllers', controllers)
+    for _, controller in controllers.items():
+        for table_name in [ 'wlans', 'aps', 'clients' ]:
+            _compare(table_name, controller[table_name])
+
+#---------------------------------------------------------------
+
+# Time loading the index tables and then updating them with (and
+# looking up the DB ids of) a run's worth of gathered clients, half
+# of them new, for various numbers of clients already stored in the
+# database.  This is what every run does before it writes any
+# sightings.  Three versions: the original linear scan ('baseline',
+# only up to --baseline-max stored clients), the first natural-key
+# indexes ('rows'), and the current code ('current').
+def bench_index_tables(g, args, log):
+    schemas  = g.db_get_schemas()
+    gathered = args.controllers * args.gathered
+    methods  = [
+        ('baseline',
+         lambda cur, schemas, log: baseline_read_tables(g, cur, schemas, log),
+         lambda cur, db, controllers, log:
+         baseline_update_index_tables(g, cur, db, controllers, log)),
+        ('rows',
+         lambda cur, schemas, log: rows_read_tables(g, cur, schemas, log),
+         lambda cur, db, controllers, log:
+         rows_update_index_tables(g, cur, db, controllers, log)),
+        ('current', g.db_read_tables, g.db_update_index_tables),
+    ]
+
+    for size in args.sizes:
+        results = dict()
+        for name, read_fn, update_fn in methods:
+            if name == 'baseline' and size > args.baseline_max:
+                continue
+
+            cur = g.db_connect(filename=':memory:', log=log)
+            g.db_create_tables(cur=cur, schemas=schemas, log=log)
+            cur.executemany('INSERT INTO clients (mac) VALUES (?)',
+                            [ (fake_mac(i),) for i in range(size) ])
+            cur.connection.commit()
+
+            db, load_time = timed(read_fn, cur=cur, schemas=schemas, log=log)
+
+            # Half of the gathered clients are already in the database,
+            # half are new.
+            first       = max(0, size - gathered // 2)
+            controllers = dict()
+            for c in range(args.controllers):
+                controller = {
+                    'name'    : 'bench-{c}'.format(c=c),
+                    'ip'      : '192.0.2.{c}'.format(c=c + 1),
+                    'wlans'   : dict(),
+                    'aps'     : dict(),
+                }
+                clients = dict()
+                for i in range(args.gathered):
+                    mac = fake_mac(first + c * args.gathered + i)
+                    clients[mac] = { 'mac' : mac, 'controller' : controller }
+                controller['clients'] = clients
+                controllers[controller['name']] = controller
+
+            _, update_time = timed(update_fn, cur=cur, db=db,
+                                   controllers=controllers, log=log)
+
+            # Every gathered client must now have the DB id of its MAC
+            ids = dict(cur.execute('SELECT mac, id FROM clients'))
+            results[name] = sorted([ (client['mac'], client['db_id'])
+                                     for controller in controllers.values()
+                                     for client in controller['clients'].values() ])
+            if any([ ids[mac] != db_id for mac, db_id in results[name] ]):
+                print("index-tables: ERROR: wrong DB ids ({name})"
+                      .format(name=name))
+
+            print("index-tables: {size:>9} stored clients, {name:>8}: load {load:8.3f}s, update with {num} gathered {t:8.4f}s"
+                  .format(size=size, name=name, load=load_time,
+                          num=gathered, t=update_time))
+
+            g.db_disconnect(cur)
+
+        if any([ result != results['current'] for result in results.values() ]):
+            print("index-tables: ERROR: the methods gave different DB ids!")
+
+#---------------------------------------------------------------
+
+# Scale the --fake data up: --aps APs and --gathered clients on each
+# of --controllers controllers.
+def fake_controllers(g, args, log):
+    args.fake_controllers = args.controllers
+    args.fake_aps         = args.aps
+    args.fake_clients     = args.gathered
+    args.fake_churn       = 0
+    args.fake_seed        = 0
+    args.fake_run         = 0
+    args.fake_dump        = None
+
+    return g.gather_data_fake(args, log)
+
+#---------------------------------------------------------------
+
+# Make an in-memory database with the index tables populated for the
+# given controllers.
+def fake_db(g, controllers, log):
+    schemas = g.db_get_schemas()
+    cur     = g.db_connect(filename=':memory:', log=log)
+    g.db_create_tables(cur=cur, schemas=schemas, log=log)
+    db      = g.db_read_tables(cur=cur, schemas=schemas, log=log)
+    g.db_update_index_tables(cur=cur, db=db, controllers=controllers, log=log)
+
+    return cur, db
+
+################################################################
+
+# How the sightings used to be written: one execute() per row, with
+# the SQL string rebuilt and a debug message formatted for every row.
+def legacy_write_sightings(cur, db, controllers, log):
+    for _, controller in controllers.items():
+        for _, gathered_ap in controller['aps'].items():
+            sql = ('INSERT INTO ap_sightings (ap_index,ip,num_clients) ' +
+                   'VALUES (?,?,?)')
+            values = [ gathered_ap['db_id'],
+                       gathered_ap['ip'],
+                       gathered_ap['clients'] ]
+            log.debug("About to insert AP sighting: {sql} / {values}"
+                      .format(sql=sql, values=values))
+            cur.execute(sql, values)
+
+        for _, gathered_client in controller['clients'].items():
+            sql = ('INSERT INTO client_sightings (client_index,ap_index,wlan_index,protocol_802dot11,frequency_ghz) ' +
+                   'VALUES (?,?,?,?,?)')
+            values = [ gathered_client['db_id'],
+                       gathered_client['ap']['db_id'],
+                       gathered_client['wlan']['db_id'],
+                       gathered_client['protocol'],
+                       gathered_client['frequency'] ]
+            log.debug("About to insert client sighting: {sql} / {values}"
+                      .format(sql=sql, values=values))
+            cur.execute(sql, values)
+
+    cur.connection.commit()
+
+def read_sightings(cur):
+    results = list()
+    for table in ['ap_sightings', 'client_sightings']:
+        rows = cur.execute('SELECT * FROM {table} ORDER BY id'
+                           .format(table=table)).fetchall()
+        # Ignore the timestamp; it's set by SQLite at insert time
+        results.append([ tuple(row)[:1] + tuple(row)[2:] for row in rows ])
+
+    return results
+
+# Time writing one run's worth of sightings, the old way and the new
+# way, and make sure that they write the same thing.
+def bench_sightings(g, args, log):
+    controllers = fake_controllers(g, args, log)
+
+    results = dict()
+    for name, fn in [('per-row execute', legacy_write_sightings),
+                     ('executemany', g.db_write_sightings)]:
+        cur, db = fake_db(g, controllers, log)
+        _, t = timed(fn, cur=cur, db=db, controllers=controllers, log=log)
+        results[name] = read_sightings(cur)
+        g.db_disconnect(cur)
+
+        print("sightings: {name:>15}: {aps} APs + {clients} clients on {num} controllers in {t:8.4f}s"
+              .format(name=name, aps=args.aps, clients=args.gathered,
+                      num=len(controllers), t=t))
+
+    if results['per-row execute'] != results['executemany']:
+        print("sightings: ERROR: the two methods wrote different data!")
+
+################################################################
+
+# Pull the sample controller output out of the string literals in the
+# gatherer's parsing functions, and make a table of (about) num_lines
+# lines out of the last table in it: its headings, its row of dashes,
+# and then its data rows over and over.
+def sample_table(filename, function, command, num_lines):
+    with open(filename) as fp:
+        tree = ast.parse(fp.read())
+
+    sample = None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name == function:
+            for stmt in node.body:
+                if (isinstance(stmt, ast.Expr) and
+                    isinstance(stmt.value, ast.Constant) and
+                    command in str(stmt.value.value)):
+                    sample = stmt.value.value
+
+    lines = sample.splitlines()
+    dashes = max([ i for i, line in enumerate(lines)
+                   if line.startswith('----') ])
+    rows = [ line for line in lines[dashes + 1:]
+             if len(line.strip()) > 1 and
+                not line.startswith('--More--') and
+                not line.startswith('Would you like') ]
+
+    table = lines[dashes - 1:dashes + 1]
+    while len(table) < num_lines:
+        table.extend(rows)
+
+    return table[:num_lines]
+
+#---------------------------------------------------------------
+
+# How the AP and client tables used to be parsed: hard-coded column
+# slices, and per-line debug messages (formatted even when debug
+# logging is off).
+def legacy_parse_aps(lines, log):
+    aps    = list()
+    inside = False
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        elif line.startswith('----'):
+            log.debug("Found beginning of first AP table")
+            inside = True
+            continue
+        elif not inside:
+            log.debug("Not an AP: {l}".format(l=line))
+            continue
+
+        log.debug("Parsing AP line: {l}".format(l=line))
+        ap = {
+            'name'          : line[0:17].strip(),
+            'slots'         : int(line[20:24]),
+            'ap_model'      : line[27:46].strip(),
+            'mac'           : line[48:66].strip(),
+            'location'      : line[68:84].strip(),
+            'country'       : line[86:92].strip(),
+            'ip'            : line[95:109].strip(),
+            'clients'       : int(line[112:118]),
+        }
+        log.debug("Got the following AP: {ap}"
+                  .format(ap=pformat(ap)))
+        aps.append(ap)
+
+    return aps
+
+def legacy_parse_clients(lines, log):
+    protocol_re = re.compile(r'(.*)\(([\d\.]+) ')
+
+    clients = list()
+    inside  = False
+    for line in lines:
+        if len(line.strip()) < 2:
+            continue
+        elif line.startswith('----'):
+            log.debug("Found beginning of client table")
+            inside = True
+            continue
+        elif not inside:
+            log.debug("Not a client: {l}".format(l=line))
+            continue
+
+        log.debug("Parsing AP line: {l}".format(l=line))
+        protocol_parts = line[66:82].strip()
+        log.debug("Protocol parts: {p}".format(p=protocol_parts))
+        parts = protocol_re.match(protocol_parts)
+        if parts:
+            protocol  = parts.group(1)
+            frequency = float(parts.group(2))
+        else:
+            protocol  = protocol_parts
+            frequency = '0'
+
+        ap_name = line[18:36].strip()
+        log.debug("AP name: {n}".format(n=ap_name))
+        client = {
+            'mac'       : line[0:17].strip(),
+            'ap_name'   : ap_name,
+            'wlan_id'   : int(line[55:59]),
+            'slot'      : int(line[37:39]),
+            'status'    : line[41:53].strip(),
+            'auth'      : line[61:64].strip(),
+            'protocol'  : protocol,
+            'frequency' : frequency,
+            'port'      : int(line[83:86]),
+            'wired'     : line[88:92].strip(),
+            'pmipv6'    : line[94:99].strip(),
+            'role'      : line[101:116].strip(),
+        }
+        log.debug("Got the following client: {client}"
+                  .format(client=pformat(client)))
+        clients.append(client)
+
+    return clients
+
+# Time parsing the sample AP and client tables from the docstrings,
+# scaled up to --lines lines, with the old hard-coded column slices
+# and with the table specs.
+def bench_parsers(g, args, log):
+    tables = [
+        ('APs', 'iter_aps', 'show ap summary', legacy_parse_aps,
+         g.ap_table_spec),
+        ('clients', 'iter_clients', 'show client summary',
+         legacy_parse_clients, g.client_table_spec),
+    ]
+
+    for name, function, command, legacy_fn, spec in tables:
+        lines = sample_table(g.__file__, function, command, args.lines)
+
+        legacy, legacy_time = timed(legacy_fn, lines, log)
+        new, new_time = timed(lambda: list(g.iter_table(lines, spec, log)))
+
+        print("parsers: {name:>8}: {num} lines: column slices {lt:8.4f}s, table spec {nt:8.4f}s"
+              .format(name=name, num=len(lines), lt=legacy_time,
+                      nt=new_time))
+
+        if legacy != new:
+            print("parsers: ERROR: the two parsers got different results!")
+
+    # Also parse the raw text for the (scaled up) --fake data, and
+    # make sure that we get back what was generated
+    controllers = fake_controllers(g, args, log)
+    for name, fn, spec, field in [('APs', g.fake_ap_summary_lines,
+                                   g.ap_table_spec, 'aps'),
+                                  ('clients', g.fake_client_summary_lines,
+                                   g.client_table_spec, 'clients')]:
+        expected = list()
+        lines    = list()
+        for _, controller in controllers.items():
+            lines.extend(fn(controller))
+            for row in controller[field].values():
+                expected.append(dict([ (key, row[key]) for key in row
+                                       if key not in ['ap', 'wlan', 'controller'] ]))
+
+        parsed, t = timed(lambda: list(g.iter_table(lines, spec, log)))
+        print("parsers: {name:>8}: {num} lines of fake data: table spec {t:8.4f}s"
+              .format(name=name, num=len(lines), t=t))
+
+        if parsed != expected:
+            print("parsers: ERROR: did not parse back the fake data!")
+
+################################################################
+
+# CPU time spent on debug output of the big data structures when debug
+# logging is *off*: the old code always pformat()ed all the gathered
+# data and all the database tables; now they're only rendered (and
+# size-capped) if the message is actually emitted.
+def bench_logging(g, args, log):
+    controllers = fake_controllers(g, args, log)
+    cur, db     = fake_db(g, controllers, log)
+
+    def _eager():
+        log.debug(pformat(controllers))
+        log.debug(pformat(db))
+
+    def _lazy():
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s", g.LazyPformat(controllers))
+            log.debug("%s", g.LazyPformat(db))
+
+    def _rendered():
+        return str(g.LazyPformat(controllers)) + str(g.LazyPformat(db))
+
+    for name, fn in [('eager pformat', _eager),
+                     ('lazy', _lazy),
+                     ('lazy (--debug)', _rendered)]:
+        start = time.process_time()
+        fn()
+        t     = time.process_time() - start
+        print("logging: {name:>15}: {aps} APs + {clients} clients on {num} controllers: {t:8.4f}s CPU"
+              .format(name=name, aps=args.aps, clients=args.gathered,
+                      num=len(controllers), t=t))
+
+    g.db_disconnect(cur)
+
+################################################################
+
+# End-to-end collection from fake-controller.py instances (one per
+# controller, spawned in place of ssh), with realistic response times:
+# serial vs. --parallel, and with paging disabled vs. paginated.
+def bench_collect(g, args, log):
+    dir = os.path.dirname(os.path.abspath(__file__))
+    fake_controllers(g, args, log)
+    controllers = dict()
+    for controller in g.fake_controller_list(args):
+        controllers[controller['name']] = controller
+    g.default_controllers = controllers
+
+    fake = os.path.join(dir, 'fake-controller.py')
+    base = ('{fake} --stdio --controller {{name}} --controllers {c} --aps {a} --clients {n} --run 0 --page-size {p} --login-delay {ld} --command-delay {cd} --page-delay {pd}'
+            .format(fake=fake, c=args.controllers, a=args.aps,
+                    n=args.gathered, p=args.page_size, ld=args.login_delay,
+                    cd=args.command_delay, pd=args.page_delay))
+
+    for paging in ['paging disabled', 'paginated']:
+        for parallel in [1, args.controllers]:
+            gather_args = argparse.Namespace(user='guest', password='guest',
+                                             parallel=parallel,
+                                             ssh_command=base)
+            if paging == 'paginated':
+                gather_args.ssh_command += ' --refuse-paging-config'
+
+            controllers, t = timed(g.gather_data_real, gather_args, log)
+            clients = sum([ len(c['clients'])
+                            for c in controllers.values() ])
+            print("collect: {paging:>15}, --parallel {p}: {clients} clients from {num} controllers in {t:8.3f}s"
+                  .format(paging=paging, p=parallel, clients=clients,
+                          num=len(controllers), t=t))
+
+################################################################
+
+benchmarks = {
+    'index-tables' : bench_index_tables,
+    'sightings'    : bench_sightings,
+    'parsers'      : bench_parsers,
+    'logging'      : bench_logging,
+    'collect'      : bench_collect,
+}
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Benchmark gather-controller-logs.py')
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help='Which benchmarks to run (default: all): {names}'
+                        .format(names=', '.join(benchmarks.keys())))
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=default_sizes,
+                        help='Numbers of stored rows to benchmark against')
+    parser.add_argument('--baseline-max',
+                        type=int,
+                        default=10000,
+                        help='For "index-tables", the largest size to run the (quadratic) original code on (default: 10000)')
+    parser.add_argument('--controllers',
+                        type=int,
+                        default=2,
+                        help='Number of fake controllers')
+    parser.add_argument('--gathered',
+                        type=int,
+                        default=1000,
+                        help='Number of gathered clients per controller')
+    parser.add_argument('--lines',
+                        type=int,
+                        default=50000,
+                        help='Number of lines of controller output to parse')
+    parser.add_argument('--aps',
+                        type=int,
+                        default=50,
+                        help='Number of gathered APs per controller')
+
+    parser.add_argument('--page-size',
+                        type=int,
+                        default=20,
+                        help='For "collect", rows per page from the fake controllers')
+    parser.add_argument('--login-delay',
+                        type=float,
+                        default=0.5,
+                        help='For "collect", fake controller login delay (seconds)')
+    parser.add_argument('--command-delay',
+                        type=float,
+                        default=0.1,
+                        help='For "collect", fake controller per-command delay (seconds)')
+    parser.add_argument('--page-delay',
+                        type=float,
+                        default=0.05,
+                        help='For "collect", fake controller per-page delay (seconds)')
+
+    args = parser.parse_args()
+
+    if len(args.benchmarks) == 0:
+        args.benchmarks = list(benchmarks.keys())
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("Unknown benchmark: {name}".format(name=name))
+
+    return args
+
+def main():
+    args = setup_cli()
+
+    # Keep the gatherer quiet; we only want the timings
+    log = logging.getLogger('benchmark')
+    log.setLevel(logging.WARNING)
+
+    g = load_gatherer()
+    for name in args.benchmarks:
+        benchmarks[name](g, args, log)
+
+if __name__ == "__main__":
+    main()
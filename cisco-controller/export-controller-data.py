@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+# Export the AP and client sightings from one or more
+# gather-controller-logs.py databases (e.g., a day's file, a range of
+# days' files, or a --partition database) to columnar Parquet or
+# Arrow files, for analysis with NumPy / pandas / etc.
+#
+# The sightings are denormalized: instead of index table ids, each
+# row has the controller name, AP name, WLAN SSID, client MAC, etc.
+# These columns are dictionary-encoded (the index tables are the
+# dictionaries), so they don't take much more space than the ids.
+#
+# Example:
+#   ./export-controller-data.py --output /tmp/export ~/data/2018-10-*.sqlite3
+#
+# This writes /tmp/export/ap_sightings.parquet and
+# /tmp/export/client_sightings.parquet.
+#
+# Requires pyarrow ("pip install pyarrow").
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+################################################################
+
+default_batch_size = 100000
+
+file_extensions = {
+    'parquet' : 'parquet',
+    'arrow'   : 'arrow',
+}
+
+################################################################
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Export controller sightings to Parquet / Arrow files')
+
+    parser.add_argument('databases',
+                        nargs='+',
+                        metavar='DB',
+                        help='gather-controller-logs.py SQLite3 database(s) to export')
+    parser.add_argument('--output',
+                        required=True,
+                        metavar='DIR',
+                        help='Directory to write the ap_sightings and client_sightings files to')
+    parser.add_argument('--format',
+                        choices=sorted(file_extensions.keys()),
+                        default='parquet',
+                        help='Output file format (default: parquet)')
+    parser.add_argument('--compression',
+                        default='zstd',
+                        help='Compression codec for Parquet files (default: zstd)')
+
+    parser.add_argument('--start',
+                        help='Only export sightings at or after this time (UTC, like the database timestamps; e.g., "2018-10-18" or "2018-10-18 13:00:00")')
+    parser.add_argument('--end',
+                        help='Only export sightings before this time (UTC)')
+
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=default_batch_size,
+                        help='Number of rows to read and write at a time (default: {d})'
+                        .format(d=default_batch_size))
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='Enable extra output for debugging')
+
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    return args
+
+#---------------------------------------------------------------
+
+def setup_logging(args):
+    log = logging.getLogger('ExportControllerData')
+    level = logging.INFO
+    if args.debug:
+        level = logging.DEBUG
+    log.setLevel(level)
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(level)
+
+    format = '%(asctime)s %(levelname)s: %(message)s'
+    formatter = logging.Formatter(format)
+
+    ch.setFormatter(formatter)
+
+    log.addHandler(ch)
+
+    return log
+
+################################################################
+
+# The database files are only read, so open them read-only (e.g., so
+# that we don't have to be able to write to an archive directory).
+def db_connect(filename, log):
+    log.debug("Connecting to database: {db}".format(db=filename))
+    uri = 'file:{f}?mode=ro'.format(f=os.path.abspath(filename))
+    return sqlite3.connect(uri, uri=True).cursor()
+
+# Newer databases have views that expand --delta sightings to one row
+# per poll, and span --partition partitions.  Older ones just have the
+# sightings table.
+def sightings_source(cur, table):
+    sql = "SELECT name FROM sqlite_master WHERE type='view' AND name=?"
+    if cur.execute(sql, (table + '_series',)).fetchone():
+        return table + '_series'
+    return table
+
+def time_filter(args):
+    clauses = list()
+    params  = list()
+    if args.start:
+        clauses.append('timestamp >= ?')
+        params.append(args.start)
+    if args.end:
+        clauses.append('timestamp < ?')
+        params.append(args.end)
+
+    if not clauses:
+        return '', params
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+################################################################
+
+# A dictionary for a dictionary-encoded column: the distinct values,
+# in the order we first saw them.
+class Dictionary:
+    def __init__(self):
+        self.codes  = dict()
+        self.values = list()
+        self.array  = None
+
+    # NULLs stay NULL, rather than being a dictionary value
+    def code(self, value):
+        if value is None:
+            return None
+
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    # Once all the values are known, the same Arrow array is the
+    # dictionary for every batch (Arrow IPC files can't change
+    # dictionaries between batches).
+    def finish(self):
+        self.array = pyarrow.array(self.values, type=pyarrow.string())
+
+    def encode_codes(self, codes):
+        return pyarrow.DictionaryArray.from_arrays(codes, self.array)
+
+    def encode_values(self, values):
+        codes = pyarrow.compute.index_in(pyarrow.array(values, type=pyarrow.string()),
+                                         value_set=self.array)
+        return self.encode_codes(codes)
+
+dictionary_columns = {
+    'ap_sightings'     : [ 'controller', 'ap_name', 'ap_model', 'location', 'ip' ],
+    'client_sightings' : [ 'controller', 'ap_name', 'ssid', 'client_mac', 'protocol' ],
+}
+
+#---------------------------------------------------------------
+
+# For one database: map its index table ids to dictionary codes.
+# Each lookup is a list indexed by id (None for ids that aren't
+# there), as an Arrow array so that mapping a batch of ids is a single
+# vectorized take().
+def read_lookups(cur, dictionaries, log):
+    controllers = dict()
+    for id, name in cur.execute('SELECT id,name FROM controllers'):
+        controllers[id] = name
+
+    def _lookup(rows):
+        size   = max([ row[0] for row in rows ], default=0) + 1
+        lookup = [ None ] * size
+        for row in rows:
+            lookup[row[0]] = row[1]
+        return pyarrow.array(lookup, type=pyarrow.int32())
+
+    lookups = dict()
+    aps     = cur.execute('SELECT id,name,ap_model,location,controller_id FROM aps').fetchall()
+    for table in [ 'ap_sightings', 'client_sightings' ]:
+        d = dictionaries[table]
+        lookups[(table, 'ap_name')] = _lookup([ (ap[0], d['ap_name'].code(ap[1]))
+                                                 for ap in aps ])
+        lookups[(table, 'controller')] = _lookup([ (ap[0], d['controller'].code(controllers.get(ap[4])))
+                                                    for ap in aps ])
+
+    d = dictionaries['ap_sightings']
+    lookups[('ap_sightings', 'ap_model')] = _lookup([ (ap[0], d['ap_model'].code(ap[2]))
+                                                       for ap in aps ])
+    lookups[('ap_sightings', 'location')] = _lookup([ (ap[0], d['location'].code(ap[3]))
+                                                       for ap in aps ])
+
+    d = dictionaries['client_sightings']
+    rows = cur.execute('SELECT id,ssid FROM wlans').fetchall()
+    lookups[('client_sightings', 'ssid')] = _lookup([ (row[0], d['ssid'].code(row[1]))
+                                                       for row in rows ])
+    rows = cur.execute('SELECT id,mac FROM clients').fetchall()
+    lookups[('client_sightings', 'client_mac')] = _lookup([ (row[0], d['client_mac'].code(row[1]))
+                                                             for row in rows ])
+
+    return lookups
+
+# The columns that aren't from the index tables: collect their
+# distinct values up front.
+def read_distinct_values(cur, sources, args, dictionaries, log):
+    where, params = time_filter(args)
+    for table, column, field in [ ('ap_sightings', 'ip', 'ip'),
+                                  ('client_sightings', 'protocol', 'protocol_802dot11') ]:
+        sql = ('SELECT DISTINCT {field} FROM {source}{where}'
+               .format(field=field, source=sources[table], where=where))
+        log.debug("Executing SQL: {sql}".format(sql=sql))
+        for row in cur.execute(sql, params):
+            dictionaries[table][column].code(row[0])
+
+################################################################
+
+def ap_schema():
+    string = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return pyarrow.schema([
+        ('timestamp',   pyarrow.timestamp('s', tz='UTC')),
+        ('controller',  string),
+        ('ap_name',     string),
+        ('ap_model',    string),
+        ('location',    string),
+        ('ip',          string),
+        ('num_clients', pyarrow.int32()),
+    ])
+
+def client_schema():
+    string = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return pyarrow.schema([
+        ('timestamp',     pyarrow.timestamp('s', tz='UTC')),
+        ('controller',    string),
+        ('ap_name',       string),
+        ('ssid',          string),
+        ('client_mac',    string),
+        ('protocol',      string),
+        ('frequency_ghz', pyarrow.float32()),
+    ])
+
+# SQL to read each kind of sighting, and how to turn a batch of rows
+# (as columns) into an Arrow record batch.
+ap_sightings_sql = ("SELECT CAST(strftime('%s', timestamp) AS INTEGER),"
+                    "ap_index,ip,num_clients FROM {source}{where}")
+
+def ap_batch(columns, lookups, dictionaries, schema):
+    d          = dictionaries['ap_sightings']
+    ap_indexes = pyarrow.array(columns[1], type=pyarrow.int64())
+
+    def _by_ap(name):
+        codes = pyarrow.compute.take(lookups[('ap_sightings', name)], ap_indexes)
+        return d[name].encode_codes(codes)
+
+    arrays = [
+        pyarrow.array(columns[0], type=pyarrow.int64()).cast(schema.field('timestamp').type),
+        _by_ap('controller'),
+        _by_ap('ap_name'),
+        _by_ap('ap_model'),
+        _by_ap('location'),
+        d['ip'].encode_values(columns[2]),
+        pyarrow.array(columns[3], type=pyarrow.int32()),
+    ]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+client_sightings_sql = ("SELECT CAST(strftime('%s', timestamp) AS INTEGER),"
+                        "client_index,ap_index,wlan_index,protocol_802dot11,frequency_ghz "
+                        "FROM {source}{where}")
+
+def client_batch(columns, lookups, dictionaries, schema):
+    d = dictionaries['client_sightings']
+
+    def _by_id(name, ids):
+        codes = pyarrow.compute.take(lookups[('client_sightings', name)],
+                                     pyarrow.array(ids, type=pyarrow.int64()))
+        return d[name].encode_codes(codes)
+
+    ap_indexes = pyarrow.array(columns[2], type=pyarrow.int64())
+    arrays = [
+        pyarrow.array(columns[0], type=pyarrow.int64()).cast(schema.field('timestamp').type),
+        d['controller'].encode_codes(pyarrow.compute.take(lookups[('client_sightings', 'controller')],
+                                                          ap_indexes)),
+        d['ap_name'].encode_codes(pyarrow.compute.take(lookups[('client_sightings', 'ap_name')],
+                                                       ap_indexes)),
+        _by_id('ssid', columns[3]),
+        _by_id('client_mac', columns[1]),
+        d['protocol'].encode_values(columns[4]),
+        pyarrow.array(columns[5], type=pyarrow.float32()),
+    ]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+exports = {
+    'ap_sightings'     : (ap_sightings_sql, ap_schema, ap_batch),
+    'client_sightings' : (client_sightings_sql, client_schema, client_batch),
+}
+
+#---------------------------------------------------------------
+
+def open_writer(filename, schema, args):
+    if args.format == 'parquet':
+        return pyarrow.parquet.ParquetWriter(filename, schema,
+                                             compression=args.compression)
+    return pyarrow.ipc.new_file(filename, schema)
+
+################################################################
+
+def export(args, log):
+    dictionaries = dict()
+    for table, columns in dictionary_columns.items():
+        dictionaries[table] = { column : Dictionary() for column in columns }
+
+    # Pass 1: read the (small) index tables of all the databases, so
+    # that we know all the dictionary values before writing anything.
+    databases = list()
+    for filename in args.databases:
+        cur     = db_connect(filename, log)
+        sources = { table : sightings_source(cur, table) for table in exports }
+        lookups = read_lookups(cur, dictionaries, log)
+        read_distinct_values(cur, sources, args, dictionaries, log)
+        databases.append((filename, cur, sources, lookups))
+
+    for table, columns in dictionaries.items():
+        for name, dictionary in columns.items():
+            dictionary.finish()
+            log.debug("{table}.{name}: {num} distinct values"
+                      .format(table=table, name=name, num=len(dictionary.values)))
+
+    # Pass 2: stream the sightings out, a batch at a time
+    os.makedirs(args.output, exist_ok=True)
+    where, params = time_filter(args)
+    for table, (sql, schema_fn, batch_fn) in exports.items():
+        schema   = schema_fn()
+        filename = os.path.join(args.output,
+                                '{t}.{ext}'.format(t=table,
+                                                   ext=file_extensions[args.format]))
+        writer   = open_writer(filename, schema, args)
+        total    = 0
+        try:
+            for dbname, cur, sources, lookups in databases:
+                query = sql.format(source=sources[table], where=where)
+                log.debug("Executing SQL: {sql}".format(sql=query))
+                cur.execute(query, params)
+                while True:
+                    rows = cur.fetchmany(args.batch_size)
+                    if not rows:
+                        break
+                    batch = batch_fn(list(zip(*rows)), lookups,
+                                     dictionaries, schema)
+                    writer.write_table(pyarrow.Table.from_batches([batch]))
+                    total += len(rows)
+        finally:
+            writer.close()
+
+        log.info("Wrote {num} {table} rows to {f}"
+                 .format(num=total, table=table, f=filename))
+
+    for _, cur, _, _ in databases:
+        cur.connection.close()
+
+################################################################
+
+def main():
+    args = setup_cli()
+    log  = setup_logging(args)
+
+    if pyarrow is None:
+        log.error("This script needs pyarrow (e.g., \"pip install pyarrow\")")
+        sys.exit(1)
+
+    export(args, log)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+# A stand-in for a Cisco wireless controller's CLI, for testing and
+# benchmarking gather-controller-logs.py without a real controller.
+#
+# It presents the "User:" / "Password:" prompts and the
+# "(Cisco Controller) >" prompt, and answers "show wlan summary",
+# "show ap summary", and "show client summary" with paginated output
+# made from gather-controller-logs.py's --fake data generator.  The
+# response times are configurable so that collection can be measured
+# against realistic timing.
+#
+# There are two ways to run it:
+#
+# 1. --stdio: serve a single session on stdin/stdout.  This is how
+#    gather-controller-logs.py uses it, in place of ssh:
+#
+#    ./gather-controller-logs.py \
+#        --ssh-command './fake-controller.py --stdio --controller {name} --clients 2000' ...
+#
+# 2. --listen PORT: serve any number of concurrent sessions over TCP
+#    (e.g., to poke at it by hand with telnet or nc).
+
+import argparse
+import logging
+import os
+import socketserver
+import sys
+import termios
+import time
+import tty
+
+from script_loader import load_gatherer
+
+################################################################
+
+prompt = '(Cisco Controller) >'
+
+incorrect_usage = "Incorrect usage. Use the '?' or <TAB> key to list commands."
+
+ap_more_prompt     = '--More-- or (q)uit'
+client_more_prompt = 'Would you like to display more entries? (y/n) '
+
+################################################################
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Fake Cisco wireless controller CLI')
+
+    parser.add_argument('--stdio',
+                        action='store_true',
+                        help='Serve a single session on stdin/stdout')
+    parser.add_argument('--listen',
+                        type=int,
+                        metavar='PORT',
+                        help='Serve sessions over TCP on this port')
+    parser.add_argument('--address',
+                        default='127.0.0.1',
+                        help='Address to listen on with --listen')
+
+    parser.add_argument('--controller',
+                        help='Name of the controller to pretend to be (default: the first one)')
+    parser.add_argument('--controllers',
+                        type=int,
+                        default=2,
+                        help='Number of fake controllers to generate data for')
+    parser.add_argument('--aps',
+                        type=int,
+                        default=20,
+                        help='Number of APs on each controller')
+    parser.add_argument('--clients',
+                        type=int,
+                        default=200,
+                        help='Number of clients on each controller')
+    parser.add_argument('--churn',
+                        type=float,
+                        default=0,
+                        help='Approximate fraction of clients that change between runs')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed')
+    parser.add_argument('--run',
+                        type=int,
+                        default=None,
+                        help='Run number (default: based on the time; see gather-controller-logs.py --fake-run)')
+
+    parser.add_argument('--page-size',
+                        type=int,
+                        default=20,
+                        help='Number of table rows per page of output (0 = no paging)')
+    parser.add_argument('--refuse-paging-config',
+                        action='store_true',
+                        help='Reject "config paging disabled" (like a controller where we are not allowed to run config commands)')
+
+    parser.add_argument('--login-delay',
+                        type=float,
+                        default=0.5,
+                        help='Seconds to wait before showing the prompt after login')
+    parser.add_argument('--command-delay',
+                        type=float,
+                        default=0.1,
+                        help='Seconds to wait before answering each command')
+    parser.add_argument('--page-delay',
+                        type=float,
+                        default=0.05,
+                        help='Seconds to wait before sending each page of output')
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='Enable extra output for debugging')
+    parser.add_argument('--log-file',
+                        help='Write log output to this file instead of stderr')
+
+    args = parser.parse_args()
+
+    if args.stdio == (args.listen is not None):
+        parser.error("Specify exactly one of --stdio or --listen")
+
+    return args
+
+#---------------------------------------------------------------
+
+def setup_logging(args):
+    log = logging.getLogger('FakeController')
+    level = logging.INFO
+    if args.debug:
+        level = logging.DEBUG
+    elif args.stdio and not args.log_file:
+        # When we're run by pexpect, stderr is part of the session, so
+        # don't say anything unless it's important.
+        level = logging.WARNING
+    log.setLevel(level)
+
+    if args.log_file:
+        ch = logging.FileHandler(args.log_file)
+    else:
+        ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(level)
+
+    format = '%(asctime)s %(levelname)s: %(message)s'
+    formatter = logging.Formatter(format)
+
+    ch.setFormatter(formatter)
+
+    log.addHandler(ch)
+
+    return log
+
+################################################################
+
+# Generate the fake data (with gather-controller-logs.py's generator)
+# and pick out the controller that we're pretending to be.
+def make_controller(g, args, log):
+    fake_args = argparse.Namespace(fake_controllers=args.controllers,
+                                   fake_aps=args.aps,
+                                   fake_clients=args.clients,
+                                   fake_churn=args.churn,
+                                   fake_seed=args.seed,
+                                   fake_run=args.run,
+                                   fake_dump=None,
+                                   interval=g.default_interval)
+    controllers = g.gather_data_fake(fake_args, log)
+
+    if args.controller is None:
+        return list(controllers.values())[0]
+    if args.controller not in controllers:
+        raise ValueError("No such fake controller: {name} (have: {names})"
+                         .format(name=args.controller,
+                                 names=', '.join(controllers.keys())))
+
+    return controllers[args.controller]
+
+################################################################
+
+# One CLI session.  "read" returns the next byte of input (or b'' at
+# EOF), and "write" sends bytes.  Like the real controller, we echo
+# what the user types.
+class Session:
+    def __init__(self, read, write, g, controller, args, log):
+        self.read       = read
+        self.write      = write
+        self.g          = g
+        self.controller = controller
+        self.args       = args
+        self.log        = log
+        self.paging     = args.page_size > 0
+        self.last       = None
+
+    def send(self, text):
+        self.write(text.replace('\n', '\r\n').encode('utf-8'))
+
+    # Read a line of input.  A "\r\n" pair counts as one line ending.
+    def readline(self, echo=True):
+        line = ''
+        while True:
+            c = self.read()
+            if c == b'':
+                return None
+
+            c = c.decode('utf-8', errors='replace')
+            if c == '\n' and self.last == '\r':
+                self.last = c
+                continue
+            self.last = c
+
+            if c in '\r\n':
+                if echo:
+                    self.send('\n')
+                return line
+
+            if echo:
+                self.send(c)
+            line += c
+
+    # Read a single keystroke (no Enter needed), e.g., for "(y/n)"
+    def readchar(self):
+        while True:
+            c = self.read()
+            if c == b'':
+                return None
+
+            c = c.decode('utf-8', errors='replace')
+            self.last = c
+            if c in '\r\n':
+                continue
+            self.send(c + '\n')
+            return c
+
+    #-----------------------------------------------------------
+
+    # Send the table lines, pausing for the pagination prompt every
+    # --page-size rows (after the table headings), like the real
+    # controller does.
+    def send_paginated(self, lines, more_prompt, more_is_keystroke):
+        page_size = self.args.page_size
+        if not self.paging:
+            page_size = 0
+
+        rows   = 0
+        inside = False
+        page   = list()
+        for line in lines:
+            page.append(line)
+            if line.startswith('----'):
+                inside = True
+                continue
+            elif not inside:
+                continue
+
+            rows += 1
+            if page_size > 0 and rows % page_size == 0:
+                time.sleep(self.args.page_delay)
+                self.send('\n'.join(page) + '\n\n')
+                page = list()
+
+                if more_is_keystroke:
+                    self.send('\n' + more_prompt)
+                    answer = self.readchar()
+                else:
+                    self.send(more_prompt + '\n')
+                    answer = self.readline(echo=False)
+
+                if answer is None:
+                    return False
+                if answer.lower() in ['q', 'n']:
+                    return True
+
+        time.sleep(self.args.page_delay)
+        self.send('\n'.join(page) + '\n\n')
+        return True
+
+    def command(self, cmd):
+        g = self.g
+        if cmd == '':
+            return True
+
+        time.sleep(self.args.command_delay)
+        if cmd == 'logout':
+            return False
+
+        elif cmd == 'config paging disabled':
+            if self.args.refuse_paging_config:
+                self.send('\n' + incorrect_usage + '\n')
+            else:
+                self.paging = False
+        elif cmd == 'config paging enabled':
+            self.paging = self.args.page_size > 0
+
+        elif cmd == 'show wlan summary':
+            self.send('\n' + '\n'.join(g.fake_wlan_summary_lines(self.controller)) +
+                      '\n\n')
+        elif cmd == 'show ap summary':
+            self.send('\n')
+            if not self.send_paginated(g.fake_ap_summary_lines(self.controller),
+                                       ap_more_prompt, False):
+                return False
+        elif cmd == 'show client summary':
+            self.send('\n')
+            if not self.send_paginated(g.fake_client_summary_lines(self.controller),
+                                       client_more_prompt, True):
+                return False
+
+        else:
+            self.send('\n' + incorrect_usage + '\n')
+
+        return True
+
+    def run(self):
+        self.send('\n(Cisco Controller)\nUser: ')
+        user = self.readline()
+        if user is None:
+            return
+        self.send('Password:')
+        if self.readline(echo=False) is None:
+            return
+        self.send('\n')
+
+        self.log.info("Login from '{user}' to fake controller '{name}'"
+                      .format(user=user, name=self.controller['name']))
+        time.sleep(self.args.login_delay)
+
+        while True:
+            self.send(prompt)
+            cmd = self.readline()
+            if cmd is None:
+                break
+
+            cmd = cmd.strip()
+            self.log.debug("Command: {cmd}".format(cmd=cmd))
+            if not self.command(cmd):
+                break
+
+        self.log.info("Logout from fake controller '{name}'"
+                      .format(name=self.controller['name']))
+
+################################################################
+
+def serve_stdio(g, controller, args, log):
+    fd_in  = sys.stdin.fileno()
+    fd_out = sys.stdout.fileno()
+
+    # We do our own echoing and line editing (and need to see single
+    # keystrokes), so put the terminal (if any) in raw mode.
+    old = None
+    if os.isatty(fd_in):
+        old = termios.tcgetattr(fd_in)
+        tty.setraw(fd_in)
+
+    try:
+        session = Session(lambda: os.read(fd_in, 1),
+                          lambda data: os.write(fd_out, data),
+                          g, controller, args, log)
+        session.run()
+    finally:
+        if old is not None:
+            termios.tcsetattr(fd_in, termios.TCSADRAIN, old)
+
+#---------------------------------------------------------------
+
+def serve_tcp(g, controller, args, log):
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            session = Session(lambda: self.request.recv(1),
+                              self.request.sendall,
+                              g, controller, args, log)
+            session.run()
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((args.address, args.listen),
+                                         Handler) as server:
+        log.info("Fake controller '{name}' listening on {a}:{p}"
+                 .format(name=controller['name'], a=args.address,
+                         p=args.listen))
+        server.serve_forever()
+
+################################################################
+
+def main():
+    args = setup_cli()
+    log  = setup_logging(args)
+
+    g          = load_gatherer()
+    controller = make_controller(g, args, log)
+
+    if args.stdio:
+        serve_stdio(g, controller, args, log)
+    else:
+        serve_tcp(g, controller, args, log)
+
+if __name__ == "__main__":
+    main()
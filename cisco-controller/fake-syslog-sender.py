@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Send synthetic wireless controller syslog messages (made from
+# analyze-controller-logs.py's fake message generator), for testing
+# and benchmarking syslog-receiver.py without a real controller.
+#
+# For example, 100000 messages at 5000 a second over UDP:
+#
+#   ./fake-syslog-sender.py --count 100000 --rate 5000
+#
+# or as fast as possible over TCP:
+#
+#   ./fake-syslog-sender.py --count 100000 --rate 0 --tcp
+
+import argparse
+import logging
+import random
+import socket
+import sys
+import time
+
+from script_loader import load_analyzer
+
+################################################################
+
+default_port  = 5514
+default_count = 10000
+default_rate  = 1000
+
+# How often to send a burst of messages, at a given --rate
+tick = 0.01
+
+# <PRI>: facility local0, severity notice
+default_priority = 16 * 8 + 5
+
+fake_tasks = [ 'apfRogueTask_1', 'apfMsConnTask_0', 'spamApTask4',
+               'rrmLogTask', 'Dot1x_NW_MsgTask_2' ]
+
+################################################################
+
+def setup_cli():
+    parser = argparse.ArgumentParser(description='Send fake wireless controller syslog messages')
+
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help='Host to send to (default: 127.0.0.1)')
+    parser.add_argument('--port',
+                        type=int,
+                        default=default_port,
+                        help='Port to send to (default: {d})'
+                        .format(d=default_port))
+    parser.add_argument('--tcp',
+                        action='store_true',
+                        help='Send over TCP instead of UDP')
+    parser.add_argument('--newlines',
+                        action='store_true',
+                        help='With --tcp, frame the messages with newlines instead of octet counting')
+
+    parser.add_argument('--count',
+                        type=int,
+                        default=default_count,
+                        help='Number of messages to send (default: {d})'
+                        .format(d=default_count))
+    parser.add_argument('--rate',
+                        type=int,
+                        default=default_rate,
+                        help='Messages per second (0 = as fast as possible; default: {d})'
+                        .format(d=default_rate))
+    parser.add_argument('--controller',
+                        default='WLC-1',
+                        help='Controller name in the messages')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed')
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='Enable extra output for debugging')
+
+    args = parser.parse_args()
+
+    if args.count < 0:
+        parser.error("--count must be >= 0")
+    if args.rate < 0:
+        parser.error("--rate must be >= 0")
+
+    return args
+
+#---------------------------------------------------------------
+
+def setup_logging(args):
+    log = logging.getLogger('FakeSyslogSender')
+    level = logging.INFO
+    if args.debug:
+        level = logging.DEBUG
+    log.setLevel(level)
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(level)
+
+    format = '%(asctime)s %(levelname)s: %(message)s'
+    formatter = logging.Formatter(format)
+
+    ch.setFormatter(formatter)
+
+    log.addHandler(ch)
+
+    return log
+
+################################################################
+
+# A message with a controller's syslog header (see syslog-receiver.py)
+def fake_syslog_message(a, rnd, controller):
+    now = time.time()
+    timestamp = '{t}.{ms:03d}'.format(t=time.strftime('%b %d %H:%M:%S',
+                                                      time.localtime(now)),
+                                      ms=int(now * 1000) % 1000)
+
+    return ('<{pri}>{controller}: *{task}: {timestamp}: %LOG-5-Q_IND: log.c:{line} {message}'
+            .format(pri=default_priority, controller=controller,
+                    task=rnd.choice(fake_tasks), timestamp=timestamp,
+                    line=rnd.randrange(100, 2000),
+                    message=a.fake_message(rnd)))
+
+def frame(args, data):
+    if not args.tcp:
+        return data
+    if args.newlines:
+        return data + b'\n'
+    return str(len(data)).encode() + b' ' + data
+
+################################################################
+
+def main():
+    args = setup_cli()
+    log  = setup_logging(args)
+
+    a   = load_analyzer()
+    rnd = random.Random(args.seed)
+
+    if args.tcp:
+        sock = socket.create_connection((args.host, args.port))
+        send = sock.sendall
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((args.host, args.port))
+        send = sock.send
+
+    log.info("Sending {n} messages to {h}:{p} over {proto}"
+             .format(n=args.count, h=args.host, p=args.port,
+                     proto='TCP' if args.tcp else 'UDP'))
+
+    # Send in bursts every "tick" seconds, to keep up the rate
+    burst = max(1, int(args.rate * tick)) if args.rate else args.count
+    start = time.monotonic()
+    sent  = 0
+    while sent < args.count:
+        n = min(burst, args.count - sent)
+        for _ in range(n):
+            data = fake_syslog_message(a, rnd, args.controller).encode()
+            send(frame(args, data))
+        sent += n
+
+        if args.rate:
+            delay = start + sent / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    elapsed = time.monotonic() - start
+    sock.close()
+
+    log.info("Sent {n} messages in {t:.2f}s ({r:.0f}/s)"
+             .format(n=sent, t=elapsed, r=sent / elapsed if elapsed else 0))
+
+if __name__ == "__main__":
+    main()
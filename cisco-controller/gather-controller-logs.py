@@ -6,10 +6,17 @@
 #   pip3 install pexpect
 
 import argparse
+import concurrent.futures
 import logging
+import operator
+import os
 import pexpect
+import random
+import signal
 import sqlite3
 import re
+import threading
+import time
 
 from pprint import pprint
 from pprint import pformat
@@ -29,8 +36,32 @@ default_controllers = {
 default_user      = 'guest'
 default_password  = 'password'
 
+# How to get to a controller's CLI.  {user}, {ip}, and {name} are
+# filled in for each controller.
+default_ssh_command = 'ssh {user}@{ip}'
+
 default_sqlite_db = 'database.sqlite3'
 
+# For --daemon mode
+default_interval  = 15 * 60
+min_interval      = 60
+
+# SQLite pragma profiles (see https://www.sqlite.org/pragma.html).
+# WAL + synchronous=NORMAL is much cheaper per commit than the default
+# rollback journal + synchronous=FULL, and can still never corrupt the
+# database (a power cut can only lose the most recent commits).
+# Negative cache_size values are in KiB.
+sqlite_profiles = {
+    'default' : [],
+    'wal'     : [ ('journal_mode', 'WAL'),
+                  ('synchronous',  'NORMAL'),
+                  ('cache_size',   '-16384'),
+                  ('temp_store',   'MEMORY') ],
+    'safe'    : [ ('journal_mode', 'WAL'),
+                  ('synchronous',  'FULL') ],
+}
+default_sqlite_profile = 'wal'
+
 ################################################################
 
 def setup_cli():
@@ -42,19 +73,125 @@ def setup_cli():
                         default=default_password,
                         help='Password for controller login')
 
+    parser.add_argument('--ssh-command',
+                        default=default_ssh_command,
+                        help='Command to connect to a controller\'s CLI; {{user}}, {{ip}}, and {{name}} are replaced (default: "{d}")'
+                        .format(d=default_ssh_command))
+
     parser.add_argument('--db',
                         default=default_sqlite_db,
-                        help='SQLite3 database filename to store results')
+                        help='SQLite3 database filename to store results (strftime() codes such as %%Y-%%m-%%d are expanded)')
+    parser.add_argument('--sqlite-profile',
+                        default=default_sqlite_profile,
+                        choices=sorted(sqlite_profiles.keys()),
+                        help='Set of SQLite3 pragmas to use (default: {p})'
+                        .format(p=default_sqlite_profile))
+    parser.add_argument('--sqlite-pragma',
+                        action='append',
+                        default=list(),
+                        metavar='NAME=VALUE',
+                        help='Additional SQLite3 pragma to set (can be specified multiple times; overrides the profile)')
+
+    parser.add_argument('--delta',
+                        action='store_true',
+                        help='Only write AP / client sightings that changed since the last poll (see the *_sightings_series views)')
+
+    parser.add_argument('--partition',
+                        choices=sorted(partition_formats.keys()),
+                        help='Keep one database (--db), with the sightings in a table per day / week, instead of a database per day')
+    parser.add_argument('--partition-keep',
+                        type=int,
+                        default=default_partition_keep,
+                        metavar='N',
+                        help='With --partition, archive all but the newest N partitions (default: {d})'
+                        .format(d=default_partition_keep))
+    parser.add_argument('--archive-dir',
+                        help='With --partition, where to write archived partitions (default: the same directory as --db)')
+
+    parser.add_argument('--sessions',
+                        action='store_true',
+                        help='After each run, fold the new client sightings into client sessions (see the client_sessions table)')
+    parser.add_argument('--session-gap',
+                        type=int,
+                        metavar='SECONDS',
+                        help='With --sessions, a client not seen for more than this long starts a new session (default: 1.5 x --interval)')
+
+    parser.add_argument('--parallel',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Gather data from up to N controllers at the same time')
+
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='Keep running: stay logged in to the controllers and poll them every --interval seconds')
+    parser.add_argument('--interval',
+                        type=int,
+                        default=default_interval,
+                        help='In --daemon mode, how many seconds between polls (minimum: {m}, default: {d})'
+                        .format(m=min_interval, d=default_interval))
 
     parser.add_argument('--debug',
                         action='store_true',
                         help='Enable extra output for debugging')
     parser.add_argument('--fake',
                         action='store_true',
-                        help='Do not actually try to talk to controllers')
+                        help='Do not actually try to talk to controllers; generate fake data instead')
+    parser.add_argument('--fake-controllers',
+                        type=int,
+                        default=len(default_controllers),
+                        help='With --fake, number of controllers')
+    parser.add_argument('--fake-aps',
+                        type=int,
+                        default=2,
+                        help='With --fake, number of APs per controller')
+    parser.add_argument('--fake-clients',
+                        type=int,
+                        default=2,
+                        help='With --fake, number of clients per controller')
+    parser.add_argument('--fake-churn',
+                        type=float,
+                        default=0,
+                        help='With --fake, approximate fraction of clients that change between runs (0-1)')
+    parser.add_argument('--fake-seed',
+                        type=int,
+                        default=0,
+                        help='With --fake, random seed')
+    parser.add_argument('--fake-run',
+                        type=int,
+                        default=None,
+                        help='With --fake, run number (default: number of --interval periods since the epoch)')
+    parser.add_argument('--fake-dump',
+                        metavar='DIR',
+                        help='With --fake, also write the raw controller output for the fake data to files in DIR')
 
     args = parser.parse_args()
 
+    if args.fake_aps < 1 and args.fake_clients > 0:
+        parser.error("--fake-clients needs at least one AP")
+    if args.fake_churn < 0 or args.fake_churn > 1:
+        parser.error("--fake-churn must be between 0 and 1")
+
+    if args.interval < min_interval:
+        parser.error("--interval must be at least {m} seconds"
+                     .format(m=min_interval))
+
+    # Turn the SQLite profile + any individual pragmas into a single
+    # list of (name, value) tuples
+    args.sqlite_pragmas = list(sqlite_profiles[args.sqlite_profile])
+    for pragma in args.sqlite_pragma:
+        parts = pragma.split('=', 1)
+        if len(parts) != 2 or not parts[0].strip().isidentifier():
+            parser.error("Invalid --sqlite-pragma (must be NAME=VALUE): {p}"
+                         .format(p=pragma))
+        args.sqlite_pragmas.append((parts[0].strip(), parts[1].strip()))
+
+    if args.session_gap is None:
+        args.session_gap = args.interval * 3 // 2
+
+    if args.partition_keep < 1:
+        parser.error("--partition-keep must be at least 1")
+
     return args
 
 #---------------------------------------------------------------
@@ -78,48 +215,310 @@ def setup_logging(args):
 
     return log
 
+#---------------------------------------------------------------
+
+# Debug output of big data structures (e.g., all the gathered data,
+# where every row also has a back-reference to its controller) is
+# expensive.  Passing a LazyPformat as a logging argument, e.g.:
+#
+#   log.debug("All the APs:\n%s", LazyPformat(aps))
+#
+# defers the pformat() until the logging module actually emits the
+# message (i.e., never, unless --debug), and caps how much of the
+# structure gets dumped.
+debug_dump_depth = 4
+debug_dump_items = 20
+debug_dump_chars = 20000
+
+def _trim_for_dump(obj, depth):
+    if isinstance(obj, dict):
+        if depth <= 0:
+            return '{{... {num} items}}'.format(num=len(obj))
+        trimmed = dict()
+        for i, (key, value) in enumerate(obj.items()):
+            if i >= debug_dump_items:
+                trimmed['...'] = '{num} more items'.format(num=len(obj) - i)
+                break
+            trimmed[key] = _trim_for_dump(value, depth - 1)
+        return trimmed
+
+    elif isinstance(obj, (list, tuple)):
+        if depth <= 0:
+            return '[... {num} items]'.format(num=len(obj))
+        trimmed = [ _trim_for_dump(value, depth - 1)
+                    for value in obj[:debug_dump_items] ]
+        if len(obj) > debug_dump_items:
+            trimmed.append('... {num} more items'
+                           .format(num=len(obj) - debug_dump_items))
+        return trimmed
+
+    return obj
+
+class LazyPformat:
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        text = pformat(_trim_for_dump(self.obj, debug_dump_depth))
+        if len(text) > debug_dump_chars:
+            text = text[:debug_dump_chars] + '\n... (truncated)'
+        return text
+
 ################################################################
 
+def connect_to_controller(data, args, log):
+    log.info("Connecting to controller '{name}' at {user}@{ip}..."
+             .format(name=data['name'], user=args.user, ip=data['ip']))
+
+    cmd = (args.ssh_command
+           .format(user=args.user, ip=data['ip'], name=data['name']))
+    child = pexpect.spawn(cmd)
+    log.debug("Waiting for User...")
+    child.expect("User: ")
+    log.debug("Sending username")
+    child.sendline(args.user)
+    log.debug("Waiting for password...")
+    child.expect("Password:")
+    log.debug("Sending password")
+    child.sendline(args.password)
+
+    prompt = "\({name}\) >".format(name=data['prompt_name'])
+    log.debug("Waiting for '{prompt}'...".format(prompt=prompt))
+    child.expect(prompt, timeout=3)
+
+    c = data.copy()
+    c['expect'] = child
+    c['prompt'] = prompt
+
+    disable_paging(c, log)
+
+    return c
+
 def connect_to_controllers(controllers, args, log):
     connections = dict()
     for _, data in controllers.items():
-        log.info("Connecting to controller '{name}' at {user}@{ip}..."
-                 .format(name=data['name'], user=args.user, ip=data['ip']))
-
-        cmd = ('ssh {user}@{ip}'
-               .format(user=args.user, ip=data['ip']))
-        child = pexpect.spawn(cmd)
-        log.debug("Waiting for User...")
-        child.expect("User: ")
-        log.debug("Sending username")
-        child.sendline(args.user)
-        log.debug("Waiting for password...")
-        child.expect("Password:")
-        log.debug("Sending password")
-        child.sendline(args.password)
-
-        prompt = "\({name}\) >".format(name=data['prompt_name'])
-        log.debug("Waiting for '{prompt}'...".format(prompt=prompt))
-        child.expect(prompt, timeout=3)
-
-        c = data.copy()
-        c['expect'] = child
-        c['prompt'] = prompt
-
-        connections[data['name']] = c
+        connections[data['name']] = connect_to_controller(data, args, log)
 
     return connections
 
 #---------------------------------------------------------------
 
+def disconnect_from_controller(data, log):
+    log.info("Disconnecting from controller '{name}' at {ip}..."
+             .format(name=data['name'], ip=data['ip']))
+
+    restore_paging(data, log)
+
+    e = data['expect']
+    e.sendline('logout')
+    e.expect(pexpect.EOF)
+
 def disconnect_from_controllers(controllers, log):
     for _, data in controllers.items():
-        log.info("Disconnecting from controller '{name}' at {ip}..."
-                 .format(name=data['name'], ip=data['ip']))
+        disconnect_from_controller(data, log)
+
+#---------------------------------------------------------------
+
+# Paginated output costs a network round trip (and an expect) per
+# page, so ask the controller to turn off paging for this session.
+# If the controller refuses (e.g., our user isn't allowed to run
+# "config" commands), we just fall back to handling the pagination
+# prompts (see read_paginated()).
+def disable_paging(controller, log):
+    e = controller['expect']
+    e.sendline('config paging disabled')
+    e.expect(controller['prompt'], timeout=5)
+
+    output = e.before.decode('utf-8', errors='replace').lower()
+    if ('incorrect' in output or
+        'denied' in output or
+        'not allowed' in output or
+        'error' in output):
+        log.info("Controller '{name}' refused to disable paging; will handle pagination"
+                 .format(name=controller['name']))
+        controller['paging_disabled'] = False
+    else:
+        log.debug("Disabled paging on controller '{name}'"
+                  .format(name=controller['name']))
+        controller['paging_disabled'] = True
+
+def restore_paging(controller, log):
+    if not controller.get('paging_disabled'):
+        return
 
-        e = data['expect']
-        e.sendline('logout')
-        e.expect(pexpect.EOF)
+    log.debug("Re-enabling paging on controller '{name}'"
+              .format(name=controller['name']))
+    e = controller['expect']
+    e.sendline('config paging enabled')
+    e.expect(controller['prompt'], timeout=5)
+    controller['paging_disabled'] = False
+
+#---------------------------------------------------------------
+
+# Send a command to the controller and yield its output one line at a
+# time.  The output may be paginated: we yield all the lines of each
+# page as soon as it arrives -- before asking for the next page -- so
+# that the caller can parse it without us having to buffer the entire
+# output.  NOTE: the caller must consume all the lines, or the
+# controller will be left waiting at a pagination prompt.
+#
+# If we disabled paging on the controller, the entire output comes
+# back in one expect (so allow more time for it).  We still look for
+# the pagination prompt, just in case.
+def read_paginated(controller, command, more_re, more_reply, log):
+    timeout = 5
+    if controller.get('paging_disabled'):
+        timeout = 60
+
+    e = controller['expect']
+    e.sendline(command)
+
+    while True:
+        i = e.expect([more_re, controller['prompt']], timeout=timeout)
+        for line in e.before.splitlines():
+            yield line.decode('utf-8')
+
+        if i == 0:
+            log.debug("Got 'More' -- requesting more...")
+            if more_reply is None:
+                e.sendline('')
+            else:
+                e.send(more_reply)
+        elif i == 1:
+            log.debug("Got end of '{cmd}' output".format(cmd=command))
+            break
+
+#---------------------------------------------------------------
+
+# The Cisco controller prints its tables in fixed-width columns, with
+# a row of dashes under the column headings, e.g.:
+#
+# MAC Address       AP Name           Slot Status        WLAN ...
+# ----------------- ----------------- ---- ------------- ----- ...
+#
+# Rather than hard-coding the column positions (which can change
+# between controller firmware versions), each table is described by
+# a "table spec": a list of (field name, converter) tuples, one per
+# column, in order.  The column positions are read from the row of
+# dashes, and a parser is compiled for them.
+#
+# The field name can also be a tuple of names if the converter
+# returns a tuple of values (i.e., one column holds several fields).
+#
+# NOTE: These field names must match their corresponding index SQL
+# table field names!  Fields that are not in the index SQL tables can
+# be named whatever we want.
+
+def parse_profile_ssid(value):
+    parts = value.split('/')
+    return parts[0].strip(), parts[1].strip()
+
+protocol_re = re.compile(r'(.*)\(([\d\.]+) ')
+
+def parse_protocol(value):
+    value = value.strip()
+    parts = protocol_re.match(value)
+    if parts:
+        return parts.group(1), float(parts.group(2))
+    # frequency_ghz is a float column, so this is what the database
+    # would hand back to us anyway (and --delta compares against that)
+    return value, 0.0
+
+wlan_table_spec = [
+    ('wlan_id',                     int),
+    (('profile_name', 'ssid'),      parse_profile_ssid),
+    ('enabled',                     str.strip),
+    ('interface',                   str.strip),
+]
+
+ap_table_spec = [
+    ('name',                        str.strip),
+    ('slots',                       int),
+    ('ap_model',                    str.strip),
+    ('mac',                         str.strip),
+    ('location',                    str.strip),
+    ('country',                     str.strip),
+    ('ip',                          str.strip),
+    ('clients',                     int),
+]
+
+client_table_spec = [
+    ('mac',                         str.strip),
+    ('ap_name',                     str.strip),
+    ('slot',                        int),
+    ('status',                      str.strip),
+    ('wlan_id',                     int),
+    ('auth',                        str.strip),
+    (('protocol', 'frequency'),     parse_protocol),
+    ('port',                        int),
+    ('wired',                       str.strip),
+    ('pmipv6',                      str.strip),
+    ('role',                        str.strip),
+]
+
+#---------------------------------------------------------------
+
+dashes_re = re.compile('-+')
+
+# Compile a parser for the table described by "spec", given its row of
+# dashes.  Each column runs from the start of its dashes to the start
+# of the next column's dashes (the last column runs to the end of the
+# line), so values that are a little wider than their dashes still
+# parse.
+def compile_table_parser(spec, dashes_line):
+    starts = [ m.start() for m in dashes_re.finditer(dashes_line) ]
+    if len(starts) < len(spec):
+        raise ValueError("Table has {num} columns; expected at least {exp}: {line}"
+                         .format(num=len(starts), exp=len(spec),
+                                 line=dashes_line))
+
+    ends   = starts[1:len(spec)] + [ None ]
+    fields = list()
+    for (name, convert), start, end in zip(spec, starts, ends):
+        fields.append((name, isinstance(name, tuple), convert,
+                       slice(start, end)))
+
+    def _parse(line):
+        record = dict()
+        for name, multiple, convert, columns in fields:
+            value = convert(line[columns])
+            if multiple:
+                record.update(zip(name, value))
+            else:
+                record[name] = value
+        return record
+
+    return _parse
+
+#---------------------------------------------------------------
+
+# Yield a dictionary for each row of the table(s) in the lines.
+# Everything before the first row of dashes is skipped, as are blank
+# (or nearly blank, i.e., shorter than min_length) lines.  If
+# first_table_only is True, everything from the second row of dashes
+# on is skipped, too.  Lines that don't parse (e.g., the text between
+# two tables) are logged and skipped.
+def iter_table(lines, spec, log, min_length=1, first_table_only=False):
+    parse = None
+    done  = False
+    for line in lines:
+        # Keep consuming the lines even after we're done, so that
+        # read_paginated() gets to the prompt.
+        if done or len(line.strip()) < min_length:
+            continue
+        elif line.startswith('----'):
+            if parse is not None and first_table_only:
+                done = True
+                continue
+            parse = compile_table_parser(spec, line)
+            continue
+        elif parse is None:
+            continue
+
+        try:
+            yield parse(line)
+        except (ValueError, IndexError) as e:
+            log.debug("Skipping unparseable line: %s (%s)", line, e)
 
 #---------------------------------------------------------------
 
@@ -160,50 +559,16 @@ WLAN ID  WLAN Profile Name / SSID               Status    Interface Name
     e.sendline('show wlan summary')
     e.expect(controller['prompt'], timeout=5)
 
-    lines  = e.before.splitlines()
-    inside = False
-    for line in lines:
-        line = line.decode('utf-8').strip()
-
-        if len(line) == 0:
-            # Skip blank lines
-            continue
-        elif line.startswith('----'):
-            log.debug("Found beginning of WLAN IDs")
-            inside = True
-            continue
-        elif not inside:
-            log.debug("Not a WLAN ID: {l}".format(l=line))
-            continue
-
-        # If we're here, then we're inside the listing of WLAN IDs.
-        # Parse out the individual fields.
-        log.debug("Parsing WLAN ID line: {l}".format(l=line))
-
-        # Columns aren't sexy, but the Cisco interface is fixed
-        # columns, so this is guaranteed to work.
-        # NOTE: These dictionary key names must match their
-        # corresponding index SQL table field names!
-        parts = line[9:45].split("/")
-        wid = {
-            'controller'      : controller,
-
-            'wlan_id'         : int(line[0:6]),
-            'profile_name'    : parts[0].strip(),
-            'ssid'            : parts[1].strip(),
-            'enabled'         : line[48:55].strip(),
-            'interface'       : line[58:77].strip(),
-        }
-        log.debug("Got the following WLAN ID: {wid}"
-                  .format(wid=pformat(wid)))
-
+    lines = [ line.decode('utf-8') for line in e.before.splitlines() ]
+    for wid in iter_table(lines, wlan_table_spec, log):
+        wid['controller'] = controller
         wlans[wid['wlan_id']] = wid
 
     return wlans
 
 #---------------------------------------------------------------
 
-def gather_aps(controller, log):
+def iter_aps(controller, log):
     # show ap summary
     '''
 (Cisco Controller) >show ap summary
@@ -255,78 +620,30 @@ AP-Dance             2     AIR-CAP1602I-A-K9     b0:aa:77:26:15:9f   Dance Class
 AP-President         2     AIR-CAP1602I-A-K9     78:ba:f9:e6:c6:43  2nd floor confer  US       192.168.81.240   1
 
 '''
+    # The list may be paginated; read_paginated() handles that, and
+    # gives us the lines as each page arrives.
+    #
+    # NOTE: The output shows *2* tables.  We only want to read the
+    # first one.
+    lines = read_paginated(controller, 'show ap summary',
+                           '--More-- or \(q\)uit', None, log)
+    for ap in iter_table(lines, ap_table_spec, log, first_table_only=True):
+        ap['controller'] = controller
+        yield ap
+
+def gather_aps(controller, log):
     log.info("Querying APs on controller '{name}' ({ip})..."
              .format(name=controller['name'], ip=controller['ip']))
 
-    e = controller['expect']
-    e.sendline('show ap summary')
-
-    # The list may be paginated; make sure to handle that.
-    lines = list()
-    while True:
-        i = e.expect(['--More-- or \(q\)uit', controller['prompt']],
-                     timeout=5)
-        lines.extend(e.before.splitlines())
-
-        if i == 0:
-            log.debug("Got 'More' -- requesting more...")
-            e.sendline('')
-        elif i == 1:
-            log.debug("Got end of AP list")
-            break
-
-    # Ok, we have all the lines now
-    aps     = dict()
-    inside  = False
-    for line in lines:
-        line = line.decode('utf-8')
-
-        # NOTE: The output shows *2* tables.  We only want to read the first one.
-
-        if len(line.strip()) == 0:
-            # Skip blank lines
-            continue
-        elif line.startswith('----'):
-            log.debug("Found beginning of first AP table")
-            inside = True
-            continue
-        elif not inside:
-            log.debug("Not an AP: {l}".format(l=line))
-            continue
-
-        # If we're here, we've passed the initial "AP Name..." header
-        # line and we're not a blank line. Parse out the individual
-        # fields.
-        log.debug("Parsing AP line: {l}".format(l=line))
-
-        # Columns aren't sexy, but the Cisco interface is fixed
-        # columns, so this is guaranteed to work.
-        # NOTE: These dictionary key names must match their
-        # corresponding index SQL table field names!
-        ap = {
-            'name'          : line[0:17].strip(),
-            'slots'         : int(line[20:24]),
-            'ap_model'      : line[27:46].strip(),
-            'mac'           : line[48:66].strip(),
-            'location'      : line[68:84].strip(),
-            'country'       : line[86:92].strip(),
-
-            # These fields are not in the index SQL table (and that's
-            # ok), so they can be named whatever we want.
-            'controller'    : controller,
-            'ip'            : line[95:109].strip(),
-            'clients'       : int(line[112:118]),
-        }
-        log.debug("Got the following AP: {ap}"
-                  .format(ap=pformat(ap)))
-
+    aps = dict()
+    for ap in iter_aps(controller, log):
         aps[ap['name']] = ap
 
     return aps
 
 #---------------------------------------------------------------
 
-def gather_clients(controller, log):
+def iter_clients(controller, log):
     # show client ap <-- shows clients on a specific AP
     '''
 (Cisco Controller) >show client ap 802.11b AP1
@@ -373,240 +690,394 @@ Would you like to display more entries? (y/n) y
 48:a1:95:a7:1a:b4 AP-Gym             2   Associated     3    Yes  802.11ac(5 GHz)  13   N/A   No     Local
 
 '''
+    # The list may be paginated; read_paginated() handles that, and
+    # gives us the lines as each page arrives (i.e., we yield the
+    # clients on each page before we ask for the next page).
+    lines = read_paginated(controller, 'show client summary',
+                           'Would you like to display more entries\? \(y/n\) ',
+                           'y', log)
+    aps   = controller['aps']
+    wlans = controller['wlans']
+    # Skip blank (and nearly blank, e.g., the echoed "y" answer to
+    # the pagination prompt) lines
+    for client in iter_table(lines, client_table_spec, log, min_length=2):
+        # These are references into other dictionaries
+        client['ap']   = aps[client['ap_name']]
+        client['wlan'] = wlans[client['wlan_id']]
+        yield client
+
+# NOTE: The clients are still collected into a dict here (as are the
+# APs in gather_aps()); they are not streamed into the DB writer.
+# The controllers are gathered in parallel threads before the DB is
+# even opened, and the index tables and sightings are then written
+# a whole controller at a time (and a client that roamed between
+# controllers is de-duplicated by MAC).  Only the raw page buffering
+# is gone: each page is parsed as it arrives.
+def gather_clients(controller, log):
     log.info("Querying clients on controller '{name}' ({ip})..."
              .format(name=controller['name'], ip=controller['ip']))
-    log.debug("All the APs we found on this controller:\n{aps}"
-              .format(aps=pformat(controller['aps'])))
+    log.debug("All the APs we found on this controller:\n%s",
+              LazyPformat(controller['aps']))
 
-    e = controller['expect']
-    e.sendline('show client summary')
+    clients = dict()
+    for client in iter_clients(controller, log):
+        clients[client['mac']] = client
 
-    # The list may be paginated; make sure to handle that.
-    lines = list()
-    while True:
-        i = e.expect(['Would you like to display more entries\? \(y/n\) ', controller['prompt']],
-                     timeout=5)
-        lines.extend(e.before.splitlines())
+    return clients
 
-        if i == 0:
-            log.debug("Got 'More' -- requesting more...")
-            e.send('y')
-        elif i == 1:
-            log.debug("Got end of client list")
-            break
+################################################################
 
-    protocol_re = re.compile('(.*)\(([\d\.]+) ')
+# --fake mode: a synthetic workload generator, so that the rest of the
+# pipeline (DB, index tables, parsers) can be exercised and load tested
+# without any controllers.
+#
+# Everything is derived from --fake-seed and the "run number" (by
+# default, the number of --interval periods since the epoch, so
+# consecutive cron runs / daemon polls are consecutive runs).  Each
+# controller has --fake-clients client "slots"; every 1/--fake-churn
+# runs, each slot gets a new client (i.e., a new MAC on a new AP),
+# with the slots staggered so that about --fake-churn of the clients
+# change between consecutive runs.
+#
+# The random numbers come from random.Random, seeded from --fake-seed
+# (like the analyzer's fake_log_rows()), so they're repeatable:
+# everything that doesn't change between runs (the APs, and each
+# slot's phase) is drawn in order from one generator, and each
+# client (a slot's generation) gets its own generator, seeded with a
+# string naming it, so that it's the same client in every run it is
+# in.
+
+fake_wlans = [
+    # wlan_id, profile name, SSID, interface
+    (1, 'mercy1',                 'mercy1',       'mercy - internal'),
+    (3, 'MercyStudent',           'MercyStudent', 'mercy - student'),
+    (6, 'Wireless Guest Network', 'Mercy-guest',  'wireless guest'),
+]
+
+fake_ap_models = [ 'AIR-CAP3602I-A-K9', 'AIR-CAP1602I-A-K9',
+                   'AIR-CAP3602E-A-K9' ]
+
+fake_protocols = [
+    # protocol, frequency (GHz)
+    ('802.11ac', 5.0),
+    ('802.11n',  5.0),
+    ('802.11n',  2.4),
+]
+
+def fake_mac(prefix, c, n):
+    return ('{p:02x}:{c:02x}:{a:02x}:{b:02x}:{d:02x}:{e:02x}'
+            .format(p=prefix, c=c & 0xff, a=(n >> 24) & 0xff,
+                    b=(n >> 16) & 0xff, d=(n >> 8) & 0xff, e=n & 0xff))
 
-    # Ok, we have all the lines now
-    clients = dict()
-    inside  = False
-    for line in lines:
-        line = line.decode('utf-8')
+#---------------------------------------------------------------
 
-        if len(line.strip()) < 2:
-            # Skip blank (and nearly blank) lines
-            continue
-        elif line.startswith('----'):
-            log.debug("Found beginning of client table")
-            inside = True
-            continue
-        elif not inside:
-            log.debug("Not a client: {l}".format(l=line))
-            continue
+def fake_controller_list(args):
+    controllers = list()
+    for i, data in enumerate(default_controllers.values()):
+        if i >= args.fake_controllers:
+            break
+        controllers.append(data.copy())
 
-        # If we're here, we've passed the initial "AP Name..." header
-        # line and we're not a blank line. Parse out the individual
-        # fields.
-        log.debug("Parsing AP line: {l}".format(l=line))
-
-        # Columns aren't sexy, but the Cisco interface is fixed
-        # columns, so this is guaranteed to work.
-        protocol_parts = line[66:82].strip()
-        log.debug("Protocol parts: {p}".format(p=protocol_parts))
-        parts = protocol_re.match(protocol_parts)
-        if parts:
-            protocol  = parts.group(1)
-            frequency = float(parts.group(2))
-        else:
-            protocol  = protocol_parts
-            frequency = '0'
-
-        ap_name = line[18:36].strip()
-        wlan_id = int(line[55:59])
-        log.debug("AP name: {n}".format(n=ap_name))
-        # NOTE: These dictionary key names must match their
-        # corresponding index SQL table field names!
-        client = {
-            'mac'       : line[0:17].strip(),
-
-            # These fields are not in the index SQL table (and that's
-            # ok), so they can be named whatever we want.
-            'slot'      : int(line[37:39]),
-            'status'    : line[41:53].strip(),
-            'auth'      : line[61:64].strip(),
-            'protocol'  : protocol,
-            'frequency' : frequency,
-            'port'      : int(line[83:86]),
-            'wired'     : line[88:92],
-            'pmipv6'    : line[94:99].strip(),
-            'role'      : line[101:116].strip(),
-
-            # These are references into other dictionaries
-            'ap'        : controller['aps'][ap_name],
-            'wlan'      : controller['wlans'][wlan_id],
-        }
-        log.debug("Got the following client: {client}"
-                  .format(client=pformat(client)))
+    for i in range(len(controllers), args.fake_controllers):
+        controllers.append({ 'name' : 'FAKE-{i}'.format(i=i + 1),
+                             'prompt_name' : prompt,
+                             'ip' : '192.0.2.{i}'.format(i=i + 1) })
 
-        clients[client['mac']] = client
+    return controllers
 
-    return clients
+def gather_data_fake(args, log):
+    run = args.fake_run
+    if run is None:
+        run = int(time.time() // args.interval)
+
+    lifetime = 0
+    if args.fake_churn > 0:
+        lifetime = max(1, int(round(1 / args.fake_churn)))
+
+    log.info("Generating fake data: run {run}, {c} controllers, {a} APs and {n} clients each"
+             .format(run=run, c=args.fake_controllers, a=args.fake_aps,
+                     n=args.fake_clients))
+
+    seed        = args.fake_seed
+    rnd         = random.Random(seed)
+    controllers = dict()
+    for c, controller in enumerate(fake_controller_list(args)):
+        wlans = dict()
+        for wlan_id, profile_name, ssid, interface in fake_wlans:
+            wlans[wlan_id] = {
+                'wlan_id'      : wlan_id,
+                'profile_name' : profile_name,
+                'ssid'         : ssid,
+                'enabled'      : 'Enabled',
+                'interface'    : interface,
+
+                'controller'   : controller,
+            }
+        controller['wlans'] = wlans
 
-################################################################
+        aps     = dict()
+        ap_list = list()
+        for a in range(args.fake_aps):
+            ap = {
+                'name'       : 'AP-FAKE{a:04d}-{c}'.format(a=a, c=c + 1),
+                'slots'      : rnd.choice([ 2, 3 ]),
+                'ap_model'   : rnd.choice(fake_ap_models),
+                'mac'        : fake_mac(0xa8, c, a),
+                'location'   : 'Room {a}'.format(a=a),
+                'country'    : 'US',
+                'ip'         : '10.{c}.{x}.{y}'.format(c=c, x=a // 250,
+                                                       y=a % 250 + 1),
+                'clients'    : 0,
+
+                'controller' : controller,
+            }
+            aps[ap['name']] = ap
+            ap_list.append(ap)
+        controller['aps'] = aps
 
-def gather_data_fake(args, log):
-    controllers = default_controllers.copy()
+        clients   = dict()
+        wlan_list = list(wlans.values())
+        for slot in range(args.fake_clients):
+            generation = 0
+            if lifetime > 0:
+                phase      = rnd.randrange(lifetime)
+                generation = (run + phase) // lifetime
+
+            crnd     = random.Random('{s}-{c}-{slot}-{g}'
+                                     .format(s=seed, c=c, slot=slot,
+                                             g=generation))
+            ap       = crnd.choice(ap_list)
+            wlan     = crnd.choice(wlan_list)
+            protocol = crnd.choice(fake_protocols)
+            mac      = fake_mac(0x02, c, (generation << 20) + slot)
+            ap['clients'] += 1
+            clients[mac] = {
+                'mac'        : mac,
+                'ap_name'    : ap['name'],
+                'slot'       : 1 if protocol[1] == 5.0 else 0,
+                'status'     : 'Associated',
+                'wlan_id'    : wlan['wlan_id'],
+                'auth'       : 'Yes',
+                'protocol'   : protocol[0],
+                'frequency'  : protocol[1],
+                'port'       : 13,
+                'wired'      : 'N/A',
+                'pmipv6'     : 'No',
+                'role'       : 'Local',
+
+                'ap'         : ap,
+                'wlan'       : wlan,
+                'controller' : controller,
+            }
+        controller['clients'] = clients
 
-    i = 0
-    for _, controller in controllers.items():
-        i = i + 1
-
-        wlan1 = 1 + i
-        wlan2 = 2 + i
-        fake_wlans       = {
-            wlan1: { 'wlan_id' : wlan1,
-                     'profile_name' : 'fake1',
-                     'ssid' : 'fake1',
-                     'enabled' : 'Enabled',
-                     'interface' : 'management',
-
-                     'controller' : controller,
-            },
-            wlan2: { 'wlan_id' : wlan2,
-                     'profile_name' : 'fake2',
-                     'ssid' : 'fake2',
-                     'enabled' : 'Enabled',
-                     'interface' : 'management',
-
-                     'controller' : controller,
-            },
-        }
-        controller['wlans'] = fake_wlans
-
-        ap1 = 'fake_ap1-controller-{i}'.format(i=i)
-        ap2 = 'fake_ap2-controller-{i}'.format(i=i)
-        fake_aps         = {
-            ap1 : { 'name' : ap1,
-                    'slots' : 2,
-                    'ap_model' : 'shiny',
-                    'mac' : '11:22:33:44:55:{x}'.format(x=66+i),
-                    'location' : 'Hallway',
-                    'country' : 'US',
-                    'ip' : '192.168.{i}.{x}'.format(i=i, x=100+i),
-                    'clients' : 13 + 1,
-
-                    'controller' : controller,
-            },
-            ap2 : { 'name' : ap2,
-                    'slots' : 2,
-                    'ap_model' : 'dull',
-                    'mac' : '11:22:33:44:55:{x}'.format(x=77+i),
-                    'location' : 'Room',
-                    'country' : 'US',
-                    'ip' : '192.168.{i}.{x}'.format(i=i, x=101+i),
-                    'clients' : 34 + 1,
-
-                    'controller' : controller,
-            },
-        }
-        controller['aps'] = fake_aps
-
-        mac1 = '22:33:44:55:66:{x}'.format(x=77+i)
-        mac2 = '22:33:44:55:66:{x}'.format(x=88+i)
-
-        fake_clients     = {
-            mac1 : { 'mac' : mac1,
-                     'ap_name' : ap1,
-                     'slot' : 2,
-                     'status' : 'Associated',
-                     'wlan_id' : wlan1,
-                     'auth' : 'Yes',
-                     'protocol' : 'ac',
-                     'frequency' : 5,
-                     'port' : 13,
-                     'wired' : 'N/A',
-                     'pmipv6' : 'No',
-                     'role' : 'Local',
-
-                     'ap' : controller['aps'][ap1],
-                     'wlan' : controller['wlans'][wlan1],
-                     'controller' : controller,
-            },
-            mac2 : { 'mac' : mac2,
-                     'ap_name' : ap2,
-                     'slot' : 2,
-                     'status' : 'Associated',
-                     'wlan_id' : wlan2,
-                     'auth' : 'Yes',
-                     'protocol' : 'n',
-                     'frequency' : 2.4,
-                     'port' : 13,
-                     'wired' : 'N/A',
-                     'pmipv6' : 'No',
-                     'role' : 'Local',
-
-                     'ap' : controller['aps'][ap2],
-                     'wlan' : controller['wlans'][wlan2],
-                     'controller' : controller,
-            },
-        }
-        controller['clients'] = fake_clients
+        controllers[controller['name']] = controller
+
+    if args.fake_dump:
+        fake_dump(controllers, args.fake_dump, log)
 
     return controllers
 
 #---------------------------------------------------------------
 
-def gather_data_real(args, log):
-    controllers = connect_to_controllers(default_controllers, args, log)
+# Render fake data as the raw text that the controller would show for
+# "show wlan summary", "show ap summary", and "show client summary"
+# (without any pagination), so that the parsers can be exercised too.
+# Each column is (heading, width, function to get the value).
+
+fake_wlan_columns = [
+    ('WLAN ID', 7, lambda w: str(w['wlan_id'])),
+    ('WLAN Profile Name / SSID', 37,
+     lambda w: '{p} / {s}'.format(p=w['profile_name'], s=w['ssid'])),
+    ('Status', 8, lambda w: w['enabled']),
+    ('Interface Name', 20, lambda w: w['interface']),
+]
+
+fake_ap_columns = [
+    ('AP Name', 18, lambda a: a['name']),
+    ('Slots', 5, lambda a: str(a['slots'])),
+    ('AP Model', 20, lambda a: a['ap_model']),
+    ('Ethernet MAC', 17, lambda a: a['mac']),
+    ('Location', 16, lambda a: a['location']),
+    ('Country', 7, lambda a: a['country']),
+    ('IP Address', 15, lambda a: a['ip']),
+    ('Clients', 7, lambda a: str(a['clients'])),
+]
+
+fake_client_columns = [
+    ('MAC Address', 17, lambda c: c['mac']),
+    ('AP Name', 17, lambda c: c['ap_name']),
+    ('Slot', 4, lambda c: str(c['slot'])),
+    ('Status', 13, lambda c: c['status']),
+    ('WLAN', 5, lambda c: str(c['wlan_id'])),
+    ('Auth', 4, lambda c: c['auth']),
+    ('Protocol', 16, lambda c: '{p}({f:g} GHz)'.format(p=c['protocol'],
+                                                       f=c['frequency'])),
+    ('Port', 4, lambda c: str(c['port'])),
+    ('Wired', 5, lambda c: c['wired']),
+    ('PMIPV6', 6, lambda c: c['pmipv6']),
+    ('Role', 16, lambda c: c['role']),
+]
+
+def fake_table_lines(columns, rows, sep):
+    lines = [ sep.join([ heading.ljust(width)
+                         for heading, width, _ in columns ]).rstrip(),
+              sep.join([ '-' * width for _, width, _ in columns ]) ]
+    for row in rows:
+        lines.append(sep.join([ fn(row).ljust(width)
+                                for _, width, fn in columns ]).rstrip())
+
+    return lines
+
+def fake_wlan_summary_lines(controller):
+    return (['Number of WLANs.................................. {n}'
+             .format(n=len(controller['wlans'])), ''] +
+            fake_table_lines(fake_wlan_columns,
+                             controller['wlans'].values(), '  '))
+
+def fake_ap_summary_lines(controller):
+    return (['Number of APs.................................... {n}'
+             .format(n=len(controller['aps'])),
+             'Global AP username.............................. user',
+             'Global AP Dot1x username........................ Not Configured',
+             '', ''] +
+            fake_table_lines(fake_ap_columns,
+                             controller['aps'].values(), '  '))
+
+def fake_client_summary_lines(controller):
+    return (['                                                       RLAN/'] +
+            fake_table_lines(fake_client_columns,
+                             controller['clients'].values(), ' '))
+
+fake_commands = {
+    'show wlan summary'   : fake_wlan_summary_lines,
+    'show ap summary'     : fake_ap_summary_lines,
+    'show client summary' : fake_client_summary_lines,
+}
 
-    # For each controller, download a bunch of data.
-    for _, controller in controllers.items():
-        wlans = gather_wlans(controller=controller, log=log)
-        controller['wlans'] = wlans
+def fake_dump(controllers, dirname, log):
+    os.makedirs(dirname, exist_ok=True)
+    for name, controller in controllers.items():
+        for command, fn in fake_commands.items():
+            filename = os.path.join(dirname, '{name}-{cmd}.txt'
+                                    .format(name=name,
+                                            cmd=command.replace(' ', '-')))
+            log.info("Writing fake '{cmd}' output: {f}"
+                     .format(cmd=command, f=filename))
+            with open(filename, 'w') as fp:
+                fp.write('\n'.join(fn(controller)) + '\n')
 
-        aps = gather_aps(controller=controller, log=log)
-        controller['aps'] = aps
+#---------------------------------------------------------------
 
-        clients = gather_clients(controller=controller, log=log)
-        controller['clients'] = clients
+# Download a bunch of data from a single (already logged in)
+# controller.
+def gather_from_controller(controller, log):
+    wlans = gather_wlans(controller=controller, log=log)
+    controller['wlans'] = wlans
+
+    aps = gather_aps(controller=controller, log=log)
+    controller['aps'] = aps
+
+    clients = gather_clients(controller=controller, log=log)
+    controller['clients'] = clients
+
+    return controller
+
+# Log in to a single controller, download a bunch of data from it,
+# and log out.
+def gather_controller(data, args, log):
+    controller = connect_to_controller(data, args, log)
 
-    disconnect_from_controllers(controllers, log)
+    try:
+        gather_from_controller(controller, log)
+        disconnect_from_controller(controller, log)
+    except Exception:
+        controller['expect'].close(force=True)
+        raise
+
+    return controller
+
+#---------------------------------------------------------------
+
+# Run fn(data, args, log) for each controller in default_controllers
+# and return a dictionary of the results, indexed by controller name.
+#
+# Each controller is independent of the others.  If --parallel is
+# more than 1, talk to that many controllers at the same time (most of
+# the time is spent waiting on the network / the controller, so
+# threads are fine).  Either way, if we fail to get data from one
+# controller, log it and keep going with the rest.
+def for_each_controller(fn, args, log):
+    results = dict()
+    if args.parallel > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as executor:
+            for key, data in default_controllers.items():
+                results[key] = executor.submit(fn, data, args, log)
+
+            for key, future in results.items():
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    results[key] = e
+    else:
+        for key, data in default_controllers.items():
+            try:
+                results[key] = fn(data, args, log)
+            except Exception as e:
+                results[key] = e
+
+    # Merge the results in the same order as default_controllers
+    controllers = dict()
+    for key, result in results.items():
+        name = default_controllers[key]['name']
+        if isinstance(result, Exception):
+            # pexpect exceptions have a full dump of the spawn object
+            # after the first line; that's just noise here.
+            msg = str(result).splitlines()[0] if str(result) else ''
+            log.error("Failed to gather data from controller '{name}': {type}: {msg}"
+                      .format(name=name, type=type(result).__name__,
+                              msg=msg))
+            continue
+
+        controllers[name] = result
 
     return controllers
 
 #---------------------------------------------------------------
 
+def gather_data_real(args, log):
+    return for_each_controller(gather_controller, args, log)
+
+#---------------------------------------------------------------
+
 def gather_data(args, log):
     if args.fake:
         controllers = gather_data_fake(args, log)
     else:
         controllers = gather_data_real(args, log)
 
-    log.debug("=================================================")
-    log.debug("All the gathered data")
-    log.debug(pformat(controllers))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("=================================================")
+        log.debug("All the gathered data")
+        log.debug("%s", LazyPformat(controllers))
 
     return controllers
 
 ################################################################
 
-def db_connect(filename, log):
+def db_connect(filename, log, pragmas=None):
     # Use the sqlite3.Row factory so that we can get field names
     log.debug("Connecting to database: {db}".format(db=filename))
     conn             = sqlite3.connect(filename)
     conn.row_factory = sqlite3.Row
     cur              = conn.cursor()
 
+    if pragmas:
+        for name, value in pragmas:
+            sql = 'PRAGMA {name}={value}'.format(name=name, value=value)
+            log.debug("Executing SQL: {sql}".format(sql=sql))
+            cur.execute(sql)
+
     return cur
 
 #---------------------------------------------------------------
@@ -698,6 +1169,116 @@ CREATE TABLE client_sightings (
 
     return schemas
 
+#---------------------------------------------------------------
+
+# Views that expand the sightings in {source} (see migration 2) into
+# one row per entity per poll.
+ap_sightings_series_sql = '''CREATE VIEW ap_sightings_series AS
+SELECT s.id AS sighting_id, s.timestamp AS timestamp,
+       s.ap_index, s.ip, s.num_clients
+  FROM {source} s
+ WHERE s.poll_id IS NULL
+UNION ALL
+SELECT s.id, p.timestamp,
+       s.ap_index, s.ip, s.num_clients
+  FROM {source} s
+  LEFT JOIN ap_heartbeats h ON h.sighting_id = s.id
+  JOIN polls p ON p.id BETWEEN s.poll_id
+                           AND coalesce(s.last_poll_id, h.last_poll_id, s.poll_id)
+ WHERE s.poll_id IS NOT NULL'''
+
+client_sightings_series_sql = '''CREATE VIEW client_sightings_series AS
+SELECT s.id AS sighting_id, s.timestamp AS timestamp,
+       s.client_index, s.ap_index, s.wlan_index,
+       s.protocol_802dot11, s.frequency_ghz
+  FROM {source} s
+ WHERE s.poll_id IS NULL
+UNION ALL
+SELECT s.id, p.timestamp,
+       s.client_index, s.ap_index, s.wlan_index,
+       s.protocol_802dot11, s.frequency_ghz
+  FROM {source} s
+  LEFT JOIN client_heartbeats h ON h.sighting_id = s.id
+  JOIN polls p ON p.id BETWEEN s.poll_id
+                           AND coalesce(s.last_poll_id, h.last_poll_id, s.poll_id)
+ WHERE s.poll_id IS NOT NULL'''
+
+# Schema migrations, applied in order after the tables are created.
+# The database's "PRAGMA user_version" records how many of these have
+# already been applied, so existing databases are upgraded in place.
+# Only ever append to this list!
+def db_get_migrations():
+    migrations = [
+        # 1: Indexes on the natural keys of the index tables (see
+        # index_table_keys), and on the sightings by entity + time
+        [
+            'CREATE INDEX IF NOT EXISTS controllers_key ON controllers (name, ip)',
+            'CREATE INDEX IF NOT EXISTS wlans_key ON wlans (wlan_id, ssid)',
+            'CREATE INDEX IF NOT EXISTS aps_key ON aps (name, ap_model, slots, mac)',
+            'CREATE INDEX IF NOT EXISTS clients_key ON clients (mac)',
+            'CREATE INDEX IF NOT EXISTS ap_sightings_ap_time ON ap_sightings (ap_index, timestamp)',
+            'CREATE INDEX IF NOT EXISTS client_sightings_client_time ON client_sightings (client_index, timestamp)',
+        ],
+
+        # 2: Change-only ("--delta") sightings.  Each run that writes
+        # delta sightings gets a row in the polls table.  A delta
+        # sighting row is the start of a run of polls in which the
+        # entity was seen in the same state: poll_id is the first poll
+        # of the run, and last_poll_id is the last one.  last_poll_id
+        # is filled in when the run ends; while it is still going, the
+        # entity's heartbeat row has the last poll it was seen in.
+        # The *_series views expand both kinds of sightings (one row
+        # per run, or delta) back into one row per entity per poll.
+        [
+            '''CREATE TABLE IF NOT EXISTS polls (
+       id integer primary key autoincrement,
+       timestamp datetime default current_timestamp
+)''',
+            'ALTER TABLE ap_sightings ADD COLUMN poll_id integer',
+            'ALTER TABLE ap_sightings ADD COLUMN last_poll_id integer',
+            'ALTER TABLE client_sightings ADD COLUMN poll_id integer',
+            'ALTER TABLE client_sightings ADD COLUMN last_poll_id integer',
+            '''CREATE TABLE IF NOT EXISTS ap_heartbeats (
+       ap_index integer primary key,
+       sighting_id integer,
+       last_poll_id integer
+)''',
+            '''CREATE TABLE IF NOT EXISTS client_heartbeats (
+       client_index integer primary key,
+       sighting_id integer,
+       last_poll_id integer
+)''',
+            'CREATE INDEX IF NOT EXISTS ap_heartbeats_sighting ON ap_heartbeats (sighting_id)',
+            'CREATE INDEX IF NOT EXISTS client_heartbeats_sighting ON client_heartbeats (sighting_id)',
+            ap_sightings_series_sql.format(source='ap_sightings'),
+            client_sightings_series_sql.format(source='client_sightings'),
+        ],
+
+        # 3: Time-partitioned sightings (--partition).  The partitions
+        # table lists the sightings partitions (see
+        # db_use_partition()), and the *_all views span the sightings
+        # table and all the live partitions (without --partition,
+        # there's just the sightings table).  The *_series views are
+        # rebuilt on top of the *_all views.
+        [
+            '''CREATE TABLE IF NOT EXISTS partitions (
+       name char(16) primary key,
+       timestamp datetime default current_timestamp,
+
+       archived datetime,
+       archive_file text
+)''',
+            'CREATE VIEW IF NOT EXISTS ap_sightings_all AS SELECT * FROM ap_sightings',
+            'CREATE VIEW IF NOT EXISTS client_sightings_all AS SELECT * FROM client_sightings',
+            'DROP VIEW IF EXISTS ap_sightings_series',
+            ap_sightings_series_sql.format(source='ap_sightings_all'),
+            'DROP VIEW IF EXISTS client_sightings_series',
+            client_sightings_series_sql.format(source='client_sightings_all'),
+        ],
+    ]
+
+    return migrations
+
 #===============================================================
 
 # Go through all the schemas.  If the table does not already exist in
@@ -722,10 +1303,61 @@ def db_create_tables(cur, schemas, log):
 
     cur.connection.commit()
 
+    db_migrate(cur, db_get_migrations(), log)
+
+#---------------------------------------------------------------
+
+def db_migrate(cur, migrations, log):
+    version = cur.execute('PRAGMA user_version').fetchone()[0]
+    if version >= len(migrations):
+        log.debug("Database schema is up to date (version {v})"
+                  .format(v=version))
+        return
+
+    with cur.connection:
+        for i in range(version, len(migrations)):
+            log.info("Migrating database schema to version {v}"
+                     .format(v=i + 1))
+            for sql in migrations[i]:
+                log.debug("Executing SQL: {sql}".format(sql=sql))
+                cur.execute(sql)
+
+        # PRAGMA does not take bound parameters
+        cur.execute('PRAGMA user_version={v}'.format(v=len(migrations)))
+
 #===============================================================
 
-# Read any database table, return it in a dictionary indexed by the
-# "id" field.
+# Natural key fields for each index table: two rows with the same
+# values in these fields are the same entity.  The other fields in
+# the index tables are informational only (e.g., an AP's location can
+# be edited on the controller without it becoming a different AP).
+index_table_keys = {
+    'controllers' : ('name', 'ip'),
+    'wlans'       : ('wlan_id', 'ssid'),
+    'aps'         : ('name', 'ap_model', 'slots', 'mac'),
+    'clients'     : ('mac',),
+}
+
+# The append-only sightings tables (which can be partitioned; see
+# db_use_partition())
+sightings_tables = ('ap_sightings', 'client_sightings')
+
+# itemgetter works on both our gathered dictionaries and sqlite3.Row.
+# With a single field (e.g., clients), it returns the bare value
+# instead of a 1-tuple, which keeps the big index maps compact.
+index_key_getters = dict()
+for _name, _fields in index_table_keys.items():
+    index_key_getters[_name] = operator.itemgetter(*_fields)
+
+def index_key(table_name, row):
+    return index_key_getters[table_name](row)
+
+#---------------------------------------------------------------
+
+# Read an index table.  We don't keep the full rows in memory: all we
+# need is a map of natural key -> DB id (so that we don't have to
+# linearly scan the table for every row that we gathered), and the
+# field names (so that we know what to insert).
 def db_table_read(cur, name, log):
     # First, query to get all the field names in this table.
     # a) we know we're using sqlite, so we use an sqlite-specific
@@ -741,48 +1373,71 @@ def db_table_read(cur, name, log):
     for row in result.fetchall():
         field_names.append(row[1])
 
-    # Now that we have the field names, read in the entire table
-    sql    = ("SELECT * FROM {table}".format(table=name))
+    # Now read just the natural key fields of the table, as plain
+    # tuples (sqlite3.Row objects are much slower to make, and this
+    # can be a million clients).
+    #
+    # If there are duplicates in the table (e.g., from older versions
+    # of this script), use the first one -- that's what a linear scan
+    # would have found.  Reading in descending id order means that the
+    # first one is the one that ends up in the dict.
+    fields = index_table_keys[name]
+    sql    = ("SELECT {fields},id FROM {table} ORDER BY id DESC"
+              .format(table=name, fields=','.join(fields)))
     log.debug("Executing SQL: {sql}".format(sql=sql))
-    result = cur.execute(sql)
-    rows   = dict()
-    for row in result.fetchall():
-        data = dict()
-        for fname in field_names:
-            data[fname] = row[fname]
+    tuple_cur = cur.connection.cursor()
+    tuple_cur.row_factory = None
+    rows = tuple_cur.execute(sql)
+    if len(fields) == 1:
+        index = dict(rows)
+    else:
+        index = { row[:-1] : row[-1] for row in rows }
 
-        rows[data['id']] = data
+    log.debug("Read index for table {name}: {num} keys"
+              .format(name=name, num=len(index)))
 
     table = {
         'field_names' : field_names,
-        'rows'        : rows,
+        'index'       : index,
     }
 
     return table
 
 #---------------------------------------------------------------
 
-# Read all the tables, storing each table in a master dictionary
+# Read all the index tables, storing each table in a master
+# dictionary.  The sightings tables are append-only; we only ever
+# write to them, so we don't read them at all (they can get big).
 def db_read_tables(cur, schemas, log):
     db = dict()
 
     for table, _ in schemas.items():
+        if table not in index_table_keys:
+            continue
+
         log.debug("Reading database table: {name}".format(name=table))
         db[table] = db_table_read(cur, table, log)
 
-    log.debug("=================================================")
-    log.debug("Database tables")
-    log.debug(pformat(db))
-    log.debug("=================================================")
+    # Which table to write each kind of sighting to (this changes with
+    # --partition; see db_use_partition())
+    db['sightings_tables'] = { table : table for table in sightings_tables }
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("=================================================")
+        log.debug("Database tables")
+        log.debug("%s", LazyPformat(db))
+        log.debug("=================================================")
 
     return db
 
 #===============================================================
 
+# The INSERT statement for each (table, fields) combination, built
+# once (and so also prepared once, by sqlite3's statement cache)
+db_insert_sql = dict()
+
 def db_insert(cur, table_name, field_names, values, log):
-    sql              = 'INSERT INTO {name} ('.format(name=table_name)
-    sql2             = ') VALUES ('
-    first            = True
+    fields           = list()
     processed_values = list()
     for fname in field_names:
         # Special case: if the field name is 'controller_id', get the
@@ -790,34 +1445,30 @@ def db_insert(cur, table_name, field_names, values, log):
         # don't have the controller's database index values at the
         # beginning of time, but we do have it by the time we go
         # insert these values in the other databases.
-        the_value = None
         if fname == 'controller_id' and 'controller' in values:
-            the_value = values['controller']['db_id']
+            processed_values.append(values['controller']['db_id'])
 
         # If we don't have this field in the values, skip it
-        elif fname not in values:
+        elif fname in values:
+            processed_values.append(values[fname])
+        else:
             continue
 
-        if not first:
-            sql  += ','
-            sql2 += ','
-        sql  += fname
-        if not the_value:
-            the_value = values[fname]
-        sql2 += '?'
-        processed_values.append(the_value)
+        fields.append(fname)
 
-        first = False
+    key = (table_name, tuple(fields))
+    sql = db_insert_sql.get(key)
+    if sql is None:
+        sql = db_insert_sql[key] = ('INSERT INTO {name} ({fields}) VALUES ({marks})'
+                                    .format(name=table_name,
+                                            fields=','.join(fields),
+                                            marks=','.join(['?'] * len(fields))))
 
-    sql += sql2 + ')'
-
-    log.debug("Executing SQL insert: {sql} / {values}"
-              .format(sql=sql, values=processed_values))
     cur.execute(sql, processed_values)
     db_id = cur.lastrowid
 
-    log.info("Added to {name} index table: {sql} / {values}"
-             .format(name=table_name, sql=sql, values=processed_values))
+    log.info("Added to %s index table: %s / %s",
+             table_name, sql, processed_values)
 
     return db_id
 
@@ -827,54 +1478,24 @@ def compare_index_table(cur, db, table_name, gathered_data, log):
     updated           = False
     table             = db[table_name]
     table_field_names = table['field_names']
+    index             = table['index']
 
-    # For every row in the data, see if we can find an exact match in
-    # the database.  If not, insert it.
+    # For every row in the data, see if we can find a match in the
+    # database (by natural key).  If not, insert it.  Either way, the
+    # row gets its DB id ('db_id'), which is what the sightings refer
+    # to.
     for _, gathered_row in gathered_data.items():
-        matched = False
-
-        for _, table_row in table['rows'].items():
-            # If we have any rows, assume that we match, unless proven
-            # otherwise (below).
-            # JMS This is computationally very expensive (probably
-            # because rows point back to the controller...?)
-            #log.debug("Comparing: {a} to {b}"
-            #          .format(a=gathered_row, b=table_row))
-
-            matched = True
-            for fname in table_field_names:
-                # If the DB field is not in the gathered row, skip it
-                # / don't consider it when checking for a match (i.e.,
-                # probably the DB index or timestamp)
-                if fname not in gathered_row:
-                    continue
-
-                log.debug("  ==> Comparing {field}: {a} vs. {b}"
-                          .format(field=fname,
-                                  a=gathered_row[fname],
-                                  b=table_row[fname]))
-                if gathered_row[fname] != table_row[fname]:
-                    matched = False
-                    break
-
-            if matched:
-                break
+        key   = index_key(table_name, gathered_row)
+        db_id = index.get(key)
 
-        db_id = None
-        if matched:
-            # JMS computationally expensive
-            #log.debug("This index item is already in the database: {foo}"
-            #         .format(foo=gathered_row))
-            db_id = table_row['id']
-
-        else:
-            # JMS computationally expensive
-            #log.debug("Need to insert this index item into the database: {foo}"
-            #         .format(foo=gathered_row))
+        if db_id is None:
             db_id = db_insert(cur=cur, table_name=table_name,
                               field_names=table_field_names,
                               values=gathered_row,
                               log=log)
+            # Keep the index in sync so that later rows in this run
+            # (e.g., the same WLAN on another controller) match it.
+            index[key] = db_id
             updated = True
 
         gathered_row['db_id'] = db_id
@@ -906,109 +1527,547 @@ def db_update_index_tables(cur, db, controllers, log):
 
 ################################################################
 
-def compare_ap(gathered_ap, db_ap):
-    if (gathered_ap['name']     == db_ap['name'] and
-        gathered_ap['ap_model'] == db_ap['ap_model'] and
-        gathered_ap['slots']    == db_ap['slots'] and
-        gathered_ap['mac']      == db_ap['mac']):
-        return True
-    return False
-
-def compare_wlan(gathered_wlan, db_wlan):
-    if (gathered_wlan['wlan_id'] == db_wlan['wlan_id'] and
-        gathered_wlan['ssid']    == db_wlan['ssid']):
-        return True
-    return False
-
-def compare_client(gathered_client, db_client):
-    if (gathered_client['mac'] == db_client['mac']):
-        return True
-    return False
-
-#---------------------------------------------------------------
-
-def correlate(db, controllers, log):
-    log.debug("Correlating gathered data to database index values...")
-
-    def _correlate(gathered_data, db_table, compare_fn, log):
-        index_field = 'db_id'
-        for _, gathered_row in gathered_data.items():
-            # If we DB inserted in this run, we already have the DB ID
-            # on the gathered data.
-            if index_field in gathered_row:
-                continue
-
-            gathered_row[index_field] = None
-            for _, db_row in db_table['rows'].items():
-                if compare_fn(gathered_row, db_row):
-                    gathered_row[index_field] = db_row['id']
-                    break
-
-    # Correlate AP, WLAN, and clients to their database index values.
-    # This is done through multiple layers of indirection in the above
-    # embedded function and passing function pointers for the actual
-    # comparisons.  Not for the meek!
-    for _, controller in controllers.items():
-        _correlate(controller['aps'], db['aps'], compare_ap, log)
-        _correlate(controller['wlans'], db['wlans'], compare_wlan, log)
-        _correlate(controller['clients'], db['clients'], compare_client, log)
-
-################################################################
-
 # I could probably write this more generally, but the "index" fields
 # make this propsect a little wonky.  So just leave all the fields /
 # values hard-coded.
+#
+# The SQL is the same for every write to the same table, so that
+# sqlite3's statement cache re-uses the prepared statement, and each
+# controller's sightings are written with a single executemany().
+ap_sightings_sql = ('INSERT INTO {table} (ap_index,ip,num_clients) ' +
+                    'VALUES (?,?,?)')
+
 def write_db_ap_sightings(cur, db, gathered_aps, cname, log):
+    values = list()
     for _, gathered_ap in gathered_aps.items():
-        sql = ('INSERT INTO ap_sightings (ap_index,ip,num_clients) ' +
-               'VALUES (?,?,?)')
-        values = [ gathered_ap['db_id'],
-                   gathered_ap['ip'],
-                   gathered_ap['clients'] ]
-        log.debug("About to insert AP sighting: {sql} / {values}"
-                  .format(sql=sql, values=values))
-        cur.execute(sql, values)
+        values.append((gathered_ap['db_id'],
+                       gathered_ap['ip'],
+                       gathered_ap['clients']))
+    if db.get('delta'):
+        num = write_db_delta_sightings(cur, db, 'ap_sightings', values, log)
+        log.info("Wrote {num} changed AP sightings ({same} unchanged) on {cname}"
+                 .format(num=num, same=len(values) - num, cname=cname))
+        return
+
+    cur.executemany(ap_sightings_sql.format(table=db['sightings_tables']['ap_sightings']),
+                    values)
 
     log.info("Wrote {num} new AP sightings on {cname}"
-             .format(num=len(gathered_aps), cname=cname))
+             .format(num=len(values), cname=cname))
+
+client_sightings_sql = ('INSERT INTO {table} (client_index,ap_index,wlan_index,protocol_802dot11,frequency_ghz) ' +
+                        'VALUES (?,?,?,?,?)')
 
-# I could probably write this more generally, but the "index" fields
-# make this propsect a little wonky.  So just leave all the fields /
-# values hard-coded.
 def write_db_client_sightings(cur, db, gathered_clients, cname, log):
+    values = list()
     for _, gathered_client in gathered_clients.items():
-        sql = ('INSERT INTO client_sightings (client_index,ap_index,wlan_index,protocol_802dot11,frequency_ghz) ' +
-               'VALUES (?,?,?,?,?)')
-        values = [ gathered_client['db_id'],
-                   gathered_client['ap']['db_id'],
-                   gathered_client['wlan']['db_id'],
-                   gathered_client['protocol'],
-                   gathered_client['frequency'] ]
-        log.debug("About to insert client sighting: {sql} / {values}"
-                  .format(sql=sql, values=values))
-        cur.execute(sql, values)
+        values.append((gathered_client['db_id'],
+                       gathered_client['ap']['db_id'],
+                       gathered_client['wlan']['db_id'],
+                       gathered_client['protocol'],
+                       gathered_client['frequency']))
+    if db.get('delta'):
+        num = write_db_delta_sightings(cur, db, 'client_sightings', values, log)
+        log.info("Wrote {num} changed client sightings ({same} unchanged) on {cname}"
+                 .format(num=num, same=len(values) - num, cname=cname))
+        return
+
+    cur.executemany(client_sightings_sql.format(table=db['sightings_tables']['client_sightings']),
+                    values)
 
     log.info("Wrote {num} new client sightings on {cname}"
-             .format(num=len(gathered_clients), cname=cname))
+             .format(num=len(values), cname=cname))
 
-################################################################
+#---------------------------------------------------------------
 
-def main():
-    args = setup_cli()
-    log  = setup_logging(args)
+# For --delta: the heartbeat table, the entity's index field, and the
+# fields that make up its state, for each sightings table.  The
+# write_db_*_sightings() values tuples are (index, state...) in this
+# order.
+delta_sightings = {
+    'ap_sightings'     : ('ap_heartbeats', 'ap_index',
+                          ('ip', 'num_clients')),
+    'client_sightings' : ('client_heartbeats', 'client_index',
+                          ('ap_index', 'wlan_index',
+                           'protocol_802dot11', 'frequency_ghz')),
+}
 
-    # Go gather the data
-    controllers = gather_data(args=args, log=log)
+# Read the current state of every entity that has a heartbeat: its
+# state as of the last poll it was seen in, the sighting row that
+# started that state, and the last poll it was seen in.  This is the
+# same size as the index tables (one row per AP / client), not the
+# sightings tables.
+def db_read_heartbeats(cur, db, log):
+    heartbeats = dict()
+    for table, (hb_table, index_field, state_fields) in delta_sightings.items():
+        sql = ('SELECT h.{index},h.sighting_id,h.last_poll_id,{fields} '
+               'FROM {hb} h JOIN {table} s ON s.id = h.sighting_id'
+               .format(index=index_field, hb=hb_table,
+                       table=db['sightings_tables'][table],
+                       fields=','.join(['s.' + f for f in state_fields])))
+        log.debug("Executing SQL: {sql}".format(sql=sql))
+        entities = dict()
+        for row in cur.execute(sql):
+            row = tuple(row)
+            entities[row[0]] = (row[3:], row[1], row[2])
+        heartbeats[table] = entities
+
+        log.debug("Read {num} heartbeats from {hb}"
+                  .format(num=len(entities), hb=hb_table))
+
+    db['heartbeats']   = heartbeats
+    db['last_poll_id'] = cur.execute('SELECT max(id) FROM polls').fetchone()[0]
+
+# Write the sightings whose state changed since the last poll.
+#
+# An entity continues its current run if it was seen in the previous
+# poll in the same state; then only its heartbeat is bumped.
+# Otherwise (it's new, its state changed, or it wasn't seen in the
+# previous poll), close its old run and start a new one.  Returns the
+# number of sightings written.
+def write_db_delta_sightings(cur, db, table, values, log):
+    hb_table, index_field, state_fields = delta_sightings[table]
+    entities  = db['heartbeats'][table]
+    last_poll = db['last_poll_id']
+    poll_id   = db['poll_id']
+    table     = db['sightings_tables'][table]
+
+    insert_sql = ('INSERT INTO {table} ({index},{fields},poll_id) VALUES ({q})'
+                  .format(table=table, index=index_field,
+                          fields=','.join(state_fields),
+                          q=','.join(['?'] * (len(state_fields) + 2))))
+    close_sql  = ('UPDATE {table} SET last_poll_id=? WHERE id=?'
+                  .format(table=table))
+    start_sql  = ('INSERT OR REPLACE INTO {hb} ({index},sighting_id,last_poll_id) '
+                  'VALUES (?,?,?)'.format(hb=hb_table, index=index_field))
+    bump_sql   = ('UPDATE {hb} SET last_poll_id=? WHERE {index}=?'
+                  .format(hb=hb_table, index=index_field))
+
+    bumps   = list()
+    written = 0
+    for value in values:
+        index  = value[0]
+        state  = value[1:]
+        entity = entities.get(index)
+        if entity is not None:
+            old_state, sighting_id, seen_poll = entity
+            # Already seen in this poll (e.g., a client that roamed
+            # between controllers while we were gathering): the first
+            # sighting wins, just like the index tables.
+            if seen_poll == poll_id:
+                continue
+            if seen_poll == last_poll and old_state == state:
+                entities[index] = (state, sighting_id, poll_id)
+                bumps.append((poll_id, index))
+                continue
+
+            cur.execute(close_sql, (seen_poll, sighting_id))
+
+        cur.execute(insert_sql, value + (poll_id,))
+        sighting_id = cur.lastrowid
+        cur.execute(start_sql, (index, sighting_id, poll_id))
+        entities[index] = (state, sighting_id, poll_id)
+        written += 1
+
+    cur.executemany(bump_sql, bumps)
+
+    return written
+
+#---------------------------------------------------------------
+
+# Write all new sightings of APs and clients in a single transaction
+# (significantly faster than committing each insert).
+def db_write_sightings(cur, db, controllers, log):
+    with cur.connection:
+        if db.get('delta'):
+            cur.execute('INSERT INTO polls DEFAULT VALUES')
+            db['poll_id'] = cur.lastrowid
+
+        for _, controller in controllers.items():
+            write_db_ap_sightings(cur=cur, db=db,
+                                  gathered_aps=controller['aps'],
+                                  cname=controller['name'],
+                                  log=log)
+            write_db_client_sightings(cur=cur, db=db,
+                                      gathered_clients=controller['clients'],
+                                      cname=controller['name'],
+                                      log=log)
+
+    if db.get('delta'):
+        db['last_poll_id'] = db['poll_id']
+
+#===============================================================
+
+# --partition: instead of one database file per day, keep a single
+# database file with the index tables (so that they don't start over
+# every day), and write the sightings to a table per day / week
+# (e.g., client_sightings_2018_10_18 or client_sightings_2018_W42).
+# The *_all and *_sightings_series views span all the live partitions.
+#
+# When there are more than --partition-keep live partitions, the
+# oldest ones are archived: moved out to a standalone database (named
+# after the partition, e.g. 2018-10-18.sqlite3, in --archive-dir),
+# with a copy of the index tables so that it stands on its own, just
+# like the old daily files.  SQLite reuses the space they freed for
+# new partitions, so the main file stays about the same size.
+partition_formats = {
+    'day'  : '%Y-%m-%d',
+    'week' : '%G-W%V',
+}
+
+default_partition_keep = 7
+
+def partition_table(table, partition):
+    return '{table}_{p}'.format(table=table, p=partition.replace('-', '_'))
+
+# Switch to the current partition (creating it, if needed).
+def db_use_partition(cur, db, log):
+    config    = db['partitioning']
+    partition = time.strftime(partition_formats[config['partition']])
+    if db.get('partition') == partition:
+        return
+
+    sql = 'SELECT name FROM partitions WHERE archived IS NULL ORDER BY name'
+    live = [ row['name'] for row in cur.execute(sql) ]
+    if partition not in live:
+        db_create_partition(cur, db, partition, live, log)
+        live.append(partition)
+
+    db['partition'] = partition
+    for table in sightings_tables:
+        db['sightings_tables'][table] = partition_table(table, partition)
+
+    # Archive the oldest partitions (never the current one)
+    old = [ p for p in sorted(live) if p != partition ]
+    num = len(old) - (config['keep'] - 1)
+    if num > 0:
+        for name in old[:num]:
+            db_archive_partition(cur, name, config['archive_dir'], log)
+        db_update_partition_views(cur, log)
+
+def db_create_partition(cur, db, partition, live, log):
+    log.info("Creating sightings partition {p}".format(p=partition))
+
+    # --delta runs don't continue across partitions: close the runs
+    # that are still open in the previous partition, and start over.
+    if live:
+        previous = [ partition_table(table, max(live))
+                     for table in sightings_tables ]
+    else:
+        previous = list(sightings_tables)
+
+    with cur.connection:
+        for table, old_table in zip(sightings_tables, previous):
+            hb_table = delta_sightings[table][0]
+            cur.execute('UPDATE {old} SET last_poll_id='
+                        '(SELECT h.last_poll_id FROM {hb} h WHERE h.sighting_id={old}.id) '
+                        'WHERE poll_id IS NOT NULL AND last_poll_id IS NULL'
+                        .format(old=old_table, hb=hb_table))
+            cur.execute('DELETE FROM {hb}'.format(hb=hb_table))
+
+            # Make the partition just like the sightings table (i.e.,
+            # including the columns added by migrations)
+            sql = ("SELECT sql FROM sqlite_master WHERE type='table' AND name=?")
+            schema = cur.execute(sql, (table,)).fetchone()[0]
+            new_table = partition_table(table, partition)
+            schema = schema.replace('CREATE TABLE ' + table,
+                                    'CREATE TABLE IF NOT EXISTS ' + new_table, 1)
+            log.debug("Executing SQL: {sql}".format(sql=schema))
+            cur.execute(schema)
+            cur.execute('CREATE INDEX IF NOT EXISTS {t}_entity_time ON {t} ({index}, timestamp)'
+                        .format(t=new_table, index=delta_sightings[table][1]))
+
+        cur.execute('INSERT INTO partitions (name) VALUES (?)', (partition,))
+
+    if 'heartbeats' in db:
+        for table in sightings_tables:
+            db['heartbeats'][table] = dict()
+
+    db_update_partition_views(cur, log)
+
+# Point the *_all views at the sightings tables and all the live
+# partitions.
+def db_update_partition_views(cur, log):
+    sql = 'SELECT name FROM partitions WHERE archived IS NULL ORDER BY name'
+    live = [ row['name'] for row in cur.execute(sql) ]
+
+    with cur.connection:
+        for table in sightings_tables:
+            sources = [ table ] + [ partition_table(table, p) for p in live ]
+            selects = [ 'SELECT * FROM {t}'.format(t=t) for t in sources ]
+            cur.execute('DROP VIEW IF EXISTS {table}_all'.format(table=table))
+            cur.execute('CREATE VIEW {table}_all AS {selects}'
+                        .format(table=table,
+                                selects=' UNION ALL '.join(selects)))
+
+# Pick the archive file for a partition, and record it in the
+# partitions table before anything is written to it.  A partition
+# that already has an archive file recorded (but isn't archived yet)
+# was interrupted part of the way through, so finish that file.
+# Otherwise, never write into an existing file (e.g., an old daily
+# file, or another database's archive): its ids mean something else,
+# so its rows would collide with ours.  Use the next free name
+# instead (e.g., 2018-10-18-2.sqlite3).
+def db_archive_filename(cur, partition, archive_dir, log):
+    sql = 'SELECT archive_file FROM partitions WHERE name=?'
+    row = cur.execute(sql, (partition,)).fetchone()
+    if row['archive_file'] is not None:
+        log.info("Resuming interrupted archive of sightings partition {p}"
+                 .format(p=partition))
+        return row['archive_file']
+
+    filename = os.path.join(archive_dir, partition + '.sqlite3')
+    n = 1
+    while os.path.exists(filename):
+        log.warning("Archive file {f} already exists; not writing into it"
+                    .format(f=filename))
+        n += 1
+        filename = os.path.join(archive_dir, '{p}-{n}.sqlite3'
+                                .format(p=partition, n=n))
+
+    with cur.connection:
+        cur.execute('UPDATE partitions SET archive_file=? WHERE name=?',
+                    (filename, partition))
+
+    return filename
+
+def db_archive_partition(cur, partition, archive_dir, log):
+    filename = db_archive_filename(cur, partition, archive_dir, log)
+    log.info("Archiving sightings partition {p} to {f}"
+             .format(p=partition, f=filename))
+
+    # Set up the archive like any other database of ours (with its
+    # own connection, so that the migrations don't land in ours)
+    acur = db_connect(filename=filename, log=log)
+    db_create_tables(cur=acur, schemas=db_get_schemas(), log=log)
+    db_disconnect(acur)
+
+    cur.execute('ATTACH DATABASE ? AS archive', (filename,))
+    try:
+        with cur.connection:
+            # OR IGNORE: so that we can finish our own archive that
+            # was interrupted part of the way through (see
+            # db_archive_filename(); the rows are the same ones)
+            for table in list(index_table_keys.keys()) + ['polls']:
+                cur.execute('INSERT OR IGNORE INTO archive.{t} SELECT * FROM main.{t}'
+                            .format(t=table))
+            for table in sightings_tables:
+                ptable = partition_table(table, partition)
+                cur.execute('INSERT OR IGNORE INTO archive.{t} SELECT * FROM main.{p}'
+                            .format(t=table, p=ptable))
+                cur.execute('DROP TABLE main.{p}'.format(p=ptable))
+            cur.execute('UPDATE partitions SET archived=current_timestamp WHERE name=?',
+                        (partition,))
+    finally:
+        cur.execute('DETACH DATABASE archive')
+
+#===============================================================
+
+# --sessions: fold client sightings into sessions -- a client on one
+# AP from start_time until end_time (seconds since the epoch, UTC),
+# with no gap of more than --session-gap seconds between sightings --
+# in the client_sessions table.  client_sessions_index is an R*Tree
+# over (AP, time), so "who was on this AP between 10:00 and 11:00" is
+# an index lookup instead of a scan.  For example:
+#
+# SELECT c.mac, datetime(s.start_time, 'unixepoch'),
+#        datetime(s.end_time, 'unixepoch')
+#   FROM client_sessions_index i
+#   JOIN client_sessions s ON s.id = i.id
+#   JOIN clients c ON c.id = s.client_index
+#  WHERE i.min_ap <= :ap AND i.max_ap >= :ap
+#    AND i.min_time <= :end AND i.max_time >= :start
+#    AND s.start_time <= :end AND s.end_time >= :start
+#
+# (R*Tree coordinates are 32-bit floats, rounded outward, so the
+# index can return a session that just misses the time range; the
+# last line filters those out.)
+#
+# The sessions are updated incrementally after each run, from the
+# current sightings table (or partition) only.  The watermark is the
+# last sighting id and the last poll id already folded in, so only
+# the new sightings are read: the rows after the last id (by primary
+# key), plus, for --delta, the runs that were still going in a newer
+# poll (open runs, from the heartbeats, and runs closed since; see the
+# last_poll_id index).  A new partition starts from id 0, but from
+# the same last poll id.
+#
+# These tables are only created when --sessions is used (rather than
+# in a migration), since SQLite can be built without R*Tree.
+session_schemas = [
+    '''CREATE TABLE IF NOT EXISTS client_sessions (
+       id integer primary key autoincrement,
 
-    # Connect to the database
-    cur = db_connect(filename=args.db, log=log)
+       client_index integer,
+       ap_index integer,
+
+       start_time integer,
+       end_time integer,
+       sightings integer
+)''',
+    'CREATE INDEX IF NOT EXISTS client_sessions_client ON client_sessions (client_index, start_time)',
+    'CREATE INDEX IF NOT EXISTS client_sessions_end ON client_sessions (end_time)',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS client_sessions_index USING rtree (
+       id,
+       min_ap, max_ap,
+       min_time, max_time
+)''',
+    '''CREATE TABLE IF NOT EXISTS client_sessions_watermark (
+       sightings_table text primary key,
+       last_id integer,
+       last_poll_id integer
+)''',
+    '''CREATE VIEW IF NOT EXISTS client_sessions_named AS
+SELECT s.id AS session_id, c.mac AS mac, a.name AS ap_name,
+       datetime(s.start_time, 'unixepoch') AS start,
+       datetime(s.end_time, 'unixepoch') AS end,
+       s.sightings AS sightings
+  FROM client_sessions s
+  JOIN clients c ON c.id = s.client_index
+  JOIN aps a ON a.id = s.ap_index''',
+]
+
+def db_create_session_tables(cur, log):
+    with cur.connection:
+        for sql in session_schemas:
+            log.debug("Executing SQL: {sql}".format(sql=sql))
+            cur.execute(sql)
+
+# The new client sightings in {table} (see above): (time, client, AP,
+# sighting id, poll id).
+new_sightings_sql = '''WITH s AS (
+SELECT * FROM {table} WHERE id > :last_id
+ UNION
+SELECT * FROM {table} WHERE last_poll_id > :last_poll_id
+ UNION
+SELECT s.* FROM client_heartbeats h JOIN {table} s ON s.id = h.sighting_id
+ WHERE h.last_poll_id > :last_poll_id
+)
+SELECT CAST(strftime('%s', s.timestamp) AS INTEGER) AS t,
+       s.client_index, s.ap_index, s.id, NULL
+  FROM s
+ WHERE s.poll_id IS NULL AND s.id > :last_id
+UNION ALL
+SELECT CAST(strftime('%s', p.timestamp) AS INTEGER) AS t,
+       s.client_index, s.ap_index, s.id, p.id
+  FROM s
+  LEFT JOIN client_heartbeats h ON h.sighting_id = s.id
+  JOIN polls p ON p.id > :last_poll_id
+              AND p.id BETWEEN s.poll_id
+                           AND coalesce(s.last_poll_id, h.last_poll_id, s.poll_id)
+ WHERE s.poll_id IS NOT NULL
+ ORDER BY t'''
+
+def db_update_sessions(cur, db, log):
+    gap   = db['sessions']['gap']
+    table = db['sightings_tables']['client_sightings']
+
+    # The closed runs are found by last_poll_id (see above).  It's
+    # only needed here, so it's made here, for each new partition too.
+    with cur.connection:
+        cur.execute('CREATE INDEX IF NOT EXISTS {t}_last_poll ON {t} (last_poll_id)'
+                    .format(t=table))
+
+    sql = ('SELECT last_id,last_poll_id FROM client_sessions_watermark '
+           'WHERE sightings_table=?')
+    row = cur.execute(sql, (table,)).fetchone()
+    if row:
+        last_id, last_poll_id = row
+    else:
+        last_id      = 0
+        sql          = 'SELECT coalesce(max(last_poll_id), 0) FROM client_sessions_watermark'
+        last_poll_id = cur.execute(sql).fetchone()[0]
+
+    rows = cur.execute(new_sightings_sql.format(table=table),
+                       { 'last_id' : last_id,
+                         'last_poll_id' : last_poll_id }).fetchall()
+    if not rows:
+        log.info("No new client sightings for sessions")
+        return
+
+    # The latest session of each client that could still be going
+    sessions = dict()
+    sql = ('SELECT id,client_index,ap_index,start_time,end_time,sightings '
+           'FROM client_sessions WHERE end_time >= ? ORDER BY end_time')
+    for session in cur.execute(sql, (rows[0][0] - gap,)):
+        sessions[session[1]] = list(session)
+
+    first_id = cur.execute('SELECT coalesce(max(id), 0) + 1 FROM client_sessions').fetchone()[0]
+    next_id  = first_id
+    extended = dict()
+    new      = list()
+    for t, client, ap, sighting_id, poll_id in rows:
+        last_id = max(last_id, sighting_id)
+        if poll_id is not None:
+            last_poll_id = max(last_poll_id, poll_id)
+
+        session = sessions.get(client)
+        if session is not None and session[2] == ap and t - session[4] <= gap:
+            session[4]  = t
+            session[5] += 1
+            if session[0] < first_id:
+                extended[session[0]] = session
+            continue
+
+        session = [ next_id, client, ap, t, t, 1 ]
+        next_id += 1
+        new.append(session)
+        sessions[client] = session
+
+    with cur.connection:
+        cur.executemany('UPDATE client_sessions SET end_time=?, sightings=? WHERE id=?',
+                        [ (s[4], s[5], s[0]) for s in extended.values() ])
+        cur.executemany('UPDATE client_sessions_index SET max_time=? WHERE id=?',
+                        [ (s[4], s[0]) for s in extended.values() ])
+        cur.executemany('INSERT INTO client_sessions '
+                        '(id,client_index,ap_index,start_time,end_time,sightings) '
+                        'VALUES (?,?,?,?,?,?)', new)
+        cur.executemany('INSERT INTO client_sessions_index VALUES (?,?,?,?,?)',
+                        [ (s[0], s[2], s[2], s[3], s[4]) for s in new ])
+        cur.execute('INSERT OR REPLACE INTO client_sessions_watermark '
+                    '(sightings_table,last_id,last_poll_id) VALUES (?,?,?)',
+                    (table, last_id, last_poll_id))
+
+    log.info("Client sessions: {new} new, {ext} extended from {num} new sightings"
+             .format(new=len(new), ext=len(extended), num=len(rows)))
+
+################################################################
 
-    # Create DB tables if they don't exist
+# Open the database (creating / upgrading the tables, if needed) and
+# read the index tables.
+def db_open(filename, args, log):
+    cur     = db_connect(filename=filename, log=log,
+                         pragmas=args.sqlite_pragmas)
     schemas = db_get_schemas()
     db_create_tables(cur=cur, schemas=schemas, log=log)
+    db      = db_read_tables(cur=cur, schemas=schemas, log=log)
+    if args.partition:
+        archive_dir = args.archive_dir
+        if archive_dir is None:
+            archive_dir = os.path.dirname(os.path.abspath(filename))
+        db['partitioning'] = {
+            'partition'   : args.partition,
+            'keep'        : args.partition_keep,
+            'archive_dir' : archive_dir,
+        }
+        db_use_partition(cur=cur, db=db, log=log)
+    if args.delta:
+        db['delta'] = True
+        db_read_heartbeats(cur=cur, db=db, log=log)
+    if args.sessions:
+        db_create_session_tables(cur=cur, log=log)
+        db['sessions'] = {
+            'gap' : args.session_gap,
+        }
 
-    # Read all the existing database tables
-    db = db_read_tables(cur=cur, schemas=schemas, log=log)
+    return cur, db
+
+# Store one run's worth of gathered data in the database.
+def db_store(cur, db, controllers, log):
+    # In a long-running collector, we may have crossed into a new
+    # partition since the last poll
+    if 'partitioning' in db:
+        db_use_partition(cur=cur, db=db, log=log)
 
     # Update the index tables with the data we gathered
     updated = db_update_index_tables(cur=cur, db=db,
@@ -1016,19 +2075,143 @@ def main():
                                      log=log)
 
     # Write all new sightings of APs and clients
-    for _, controller in controllers.items():
-        write_db_ap_sightings(cur=cur, db=db,
-                              gathered_aps=controller['aps'],
-                              cname=controller['name'],
-                              log=log)
-        write_db_client_sightings(cur=cur, db=db,
-                                  gathered_clients=controller['clients'],
-                                  cname=controller['name'],
-                                  log=log)
+    db_write_sightings(cur=cur, db=db, controllers=controllers, log=log)
 
-    # Commit everything that we just insertted (significantly faster
-    # than committing each insert).
-    cur.connection.commit()
+    # Fold the new sightings into client sessions
+    if 'sessions' in db:
+        db_update_sessions(cur=cur, db=db, log=log)
+
+################################################################
+
+# Long-running collector mode: stay logged in to each controller and
+# poll it every --interval seconds.  This saves a Python startup, an
+# SSH handshake, and a login per controller on every poll.
+#
+# If a session dies (e.g., the controller times out idle CLI sessions,
+# or it reboots), we log in again and retry once; if that fails too,
+# we'll try again on the next poll.
+#
+# --db is passed through strftime() on every poll, so a name like
+# "%Y-%m-%d.sqlite3" gives one database file per day, just like the
+# cron job.  The index tables are only read when we switch to a new
+# file; after that, compare_index_table() keeps them in sync.
+def run_daemon(args, log):
+    sessions = dict()
+    stop     = threading.Event()
+
+    def _stop(signum, frame):
+        log.info("Got signal {s}; stopping after this poll".format(s=signum))
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    def _close(name):
+        controller = sessions.pop(name, None)
+        if controller is not None:
+            controller['expect'].close(force=True)
+
+    def _poll(data, args, log):
+        name = data['name']
+        controller = sessions.get(name)
+        if controller is not None and not controller['expect'].isalive():
+            log.warning("Session to controller '{name}' died"
+                        .format(name=name))
+            _close(name)
+            controller = None
+
+        attempt = 1
+        while True:
+            if controller is None:
+                controller = connect_to_controller(data, args, log)
+                sessions[name] = controller
+
+            try:
+                return gather_from_controller(controller, log)
+            except Exception:
+                _close(name)
+                controller = None
+                if attempt > 1:
+                    raise
+
+                log.warning("Lost session to controller '{name}'; reconnecting..."
+                            .format(name=name))
+                attempt += 1
+
+    cur      = None
+    db       = None
+    filename = None
+    next_poll = time.monotonic()
+    while not stop.is_set():
+        if args.fake:
+            controllers = gather_data_fake(args, log)
+        else:
+            controllers = for_each_controller(_poll, args, log)
+
+        # A database error (e.g., "database is locked" while
+        # syslog-receiver.py is writing to the same file) loses this
+        # poll, but not the daemon.  Roll back, and reopen the
+        # database on the next poll: that re-reads the index tables
+        # and heartbeats, which may now be ahead of the database.
+        try:
+            new_filename = time.strftime(args.db)
+            if new_filename != filename:
+                if cur is not None:
+                    db_disconnect(cur)
+                    cur = None
+                log.info("Using database: {db}".format(db=new_filename))
+                filename = new_filename
+                cur, db  = db_open(filename, args, log)
+
+            db_store(cur, db, controllers, log)
+        except sqlite3.Error as e:
+            log.error("Failed to store this poll in {db}: {e}"
+                      .format(db=filename, e=e))
+            if cur is not None:
+                cur.connection.rollback()
+                db_disconnect(cur)
+            cur      = None
+            db       = None
+            filename = None
+
+        # Poll on a fixed cadence.  If we fell behind (e.g., a poll
+        # took longer than the interval), skip ahead rather than
+        # polling back-to-back to catch up.
+        next_poll += args.interval
+        now = time.monotonic()
+        if next_poll < now:
+            next_poll = now
+        stop.wait(next_poll - now)
+
+    for name in list(sessions.keys()):
+        try:
+            disconnect_from_controller(sessions[name], log)
+        except Exception:
+            pass
+        _close(name)
+
+    if cur is not None:
+        db_disconnect(cur)
+
+################################################################
+
+def main():
+    args = setup_cli()
+    log  = setup_logging(args)
+
+    if args.daemon:
+        run_daemon(args, log)
+        return
+
+    # Go gather the data
+    controllers = gather_data(args=args, log=log)
+
+    # Connect to the database, create / upgrade the DB tables if
+    # needed, and read the existing index tables
+    cur, db = db_open(filename=time.strftime(args.db), args=args, log=log)
+
+    # Store everything that we gathered
+    db_store(cur=cur, db=db, controllers=controllers, log=log)
 
     # Close out the database
     db_disconnect(cur)
@@ -0,0 +1,34 @@
+# Load the other scripts in this directory as modules, for the
+# helper scripts (benchmarks, fake controller / syslog sender, syslog
+# receiver) that reuse their code.
+#
+# gather-controller-logs.py and analyze-controller-logs.py are not
+# importable module names (they have dashes in them), so load them by
+# filename.  They're also registered in sys.modules, so that each one
+# is only loaded once, and so that multiprocessing can pickle their
+# functions for (forked) worker processes.
+
+import importlib.util
+import os
+import sys
+
+################################################################
+
+def load_script(filename, name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    dir      = os.path.dirname(os.path.abspath(__file__))
+    filename = os.path.join(dir, filename)
+    spec     = importlib.util.spec_from_file_location(name, filename)
+    module   = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+def load_gatherer():
+    return load_script('gather-controller-logs.py', 'gather_controller_logs')
+
+def load_analyzer():
+    return load_script('analyze-controller-logs.py', 'analyze_controller_logs')
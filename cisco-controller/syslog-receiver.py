@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Receive the wireless controllers' syslog messages directly (instead
+# of from a hand-exported controller-logs.csv), classify each one as
+# it arrives with analyze-controller-logs.py's rules, and store the
+# events in the same SQLite database as gather-controller-logs.py
+# (the syslog_events table).
+#
+# Point the controllers' syslog at this host, e.g.:
+#
+#   ./syslog-receiver.py --db "$HOME/data/current/wifi-data.sqlite3"
+#
+# (a long-lived gatherer database, e.g. one with --partition, in its
+# own directory.  Don't write to $HOME/data/YYYY-MM-DD.sqlite3: those
+# names are the gatherer's daily files / archived partitions, and the
+# every24h job uploads and moves every *.sqlite3 file in $HOME/data.)
+#
+# It listens for syslog over UDP and TCP (both on port 5514 by
+# default, since 514 needs root).  TCP messages can be framed either
+# with octet counting or with newlines (RFC 6587).  For local testing,
+# fake-syslog-sender.py sends synthetic controller messages.
+#
+# The sockets are served by asyncio.  The events are batched up and
+# written with executemany() in a separate thread (the only one that
+# touches the database), so a slow write -- e.g., waiting for the
+# gatherer to finish its transaction -- doesn't stop us from reading
+# the sockets.
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import re
+import signal
+import socket
+import sys
+import time
+
+from script_loader import load_analyzer, load_gatherer
+
+################################################################
+
+default_port           = 5514
+default_batch_size     = 1000
+default_flush_interval = 1.0
+
+# A bigger UDP receive buffer, to ride out bursts
+udp_receive_buffer = 4 * 1024 * 1024
+
+max_tcp_message = 64 * 1024
+
+# The database is shared with the gatherer, so wait this long (in
+# milliseconds) for its transactions before giving up on a write...
+db_busy_timeout = 60 * 1000
+
+# ... and then keep the events and retry, backing off from 1 second
+# up to a minute between tries.  If the database stays unwritable
+# long enough that this many events pile up, the oldest are dropped.
+retry_delay_min    = 1.0
+retry_delay_max    = 60.0
+max_pending_events = 1000000
+
+################################################################
+
+def setup_cli(g):
+    parser = argparse.ArgumentParser(description='Receive and classify wireless controller syslog messages')
+
+    parser.add_argument('--address',
+                        default='0.0.0.0',
+                        help='Address to listen on (default: all)')
+    parser.add_argument('--udp-port',
+                        type=int,
+                        default=default_port,
+                        help='UDP port to listen on (0 = no UDP; default: {d})'
+                        .format(d=default_port))
+    parser.add_argument('--tcp-port',
+                        type=int,
+                        default=default_port,
+                        help='TCP port to listen on (0 = no TCP; default: {d})'
+                        .format(d=default_port))
+
+    parser.add_argument('--db',
+                        default=g.default_sqlite_db,
+                        help='SQLite3 database filename, passed through strftime() (default: {db})'
+                        .format(db=g.default_sqlite_db))
+    parser.add_argument('--sqlite-profile',
+                        default=g.default_sqlite_profile,
+                        choices=sorted(g.sqlite_profiles.keys()),
+                        help='Set of SQLite3 pragmas to use (default: {p})'
+                        .format(p=g.default_sqlite_profile))
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=default_batch_size,
+                        help='Write the events to the database once this many are waiting (default: {d})'
+                        .format(d=default_batch_size))
+    parser.add_argument('--flush-interval',
+                        type=float,
+                        default=default_flush_interval,
+                        help='... or after this many seconds (default: {d})'
+                        .format(d=default_flush_interval))
+
+    parser.add_argument('--rules',
+                        metavar='FILE',
+                        help='JSON file of additional classification rules (see analyze-controller-logs.py)')
+    parser.add_argument('--skip-unknown',
+                        action='store_true',
+                        help='Do not store messages that do not match any rule')
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='Enable extra output for debugging')
+
+    args = parser.parse_args()
+
+    if args.udp_port == 0 and args.tcp_port == 0:
+        parser.error("Need at least one of --udp-port or --tcp-port")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be >= 1")
+    if args.flush_interval <= 0:
+        parser.error("--flush-interval must be > 0")
+
+    return args
+
+#---------------------------------------------------------------
+
+def setup_logging(args):
+    log = logging.getLogger('SyslogReceiver')
+    level = logging.INFO
+    if args.debug:
+        level = logging.DEBUG
+    log.setLevel(level)
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(level)
+
+    format = '%(asctime)s %(levelname)s: %(message)s'
+    formatter = logging.Formatter(format)
+
+    ch.setFormatter(formatter)
+
+    log.addHandler(ch)
+
+    return log
+
+################################################################
+
+# The events table.  It's created on demand (rather than in the
+# gatherer's migrations), since only databases that we write to need
+# it.
+#
+# timestamp: when we received the message (UTC, like the gatherer's
+#            timestamps; the syslog header's time has no year or
+#            timezone)
+# host:      the sender's (i.e., the controller's) IP address
+# type:      the event type (see analyze-controller-logs.py)
+# ap:        our AP's MAC
+# peer:      the other MAC: the rogue AP, attacker, or client
+# fields:    all of the event's fields, as JSON
+# msg:       the whole syslog message
+syslog_schemas = [
+    '''CREATE TABLE IF NOT EXISTS syslog_events (
+       id integer primary key autoincrement,
+       timestamp datetime,
+
+       host char(40),
+
+       type char(32),
+       ap char(20),
+       peer char(20),
+       fields text,
+
+       msg text
+)''',
+    'CREATE INDEX IF NOT EXISTS syslog_events_time ON syslog_events (timestamp)',
+    'CREATE INDEX IF NOT EXISTS syslog_events_ap ON syslog_events (ap, timestamp)',
+]
+
+syslog_events_sql = ('INSERT INTO syslog_events (timestamp,host,type,ap,peer,fields,msg) ' +
+                     'VALUES (?,?,?,?,?,?,?)')
+
+#---------------------------------------------------------------
+
+# The database side.  All of these methods run in the database
+# thread.
+class EventStore:
+    def __init__(self, g, args, log):
+        self.g        = g
+        self.args     = args
+        self.log      = log
+        self.cur      = None
+        self.filename = None
+
+    def open(self, filename):
+        self.close()
+
+        self.log.info("Using database: {db}".format(db=filename))
+        # (busy_timeout first, so that it covers setting the others)
+        pragmas  = ([ ('busy_timeout', db_busy_timeout) ] +
+                    self.g.sqlite_profiles[self.args.sqlite_profile])
+        self.cur = self.g.db_connect(filename=filename, log=self.log,
+                                     pragmas=pragmas)
+        with self.cur.connection:
+            for sql in syslog_schemas:
+                self.log.debug("Executing SQL: {sql}".format(sql=sql))
+                self.cur.execute(sql)
+        self.filename = filename
+
+    def write(self, rows):
+        # Like the gatherer's daemon mode, switch to a new database
+        # file when the strftime()'ed name changes
+        filename = time.strftime(self.args.db)
+        if filename != self.filename:
+            self.open(filename)
+
+        with self.cur.connection:
+            self.cur.executemany(syslog_events_sql, rows)
+
+    def close(self):
+        if self.cur is not None:
+            self.g.db_disconnect(self.cur)
+            self.cur = None
+
+################################################################
+
+# Cisco controllers' syslog messages look like:
+#
+#   <PRI>controller: *task: Sep 16 18:50:34.123: %FACILITY-SEV-MNEMONIC: file.c:1234 message
+#
+# and the message part is what's in controller-logs.csv, and what the
+# classification rules match against.  If we don't recognize the
+# header, we try the rules on everything after the <PRI>.
+wlc_header_re = re.compile(r'(?:<\d{1,3}>)?(?:.*?%[A-Z0-9_]+-\d-[A-Z0-9_]+: (?:[\w.]+\.c:\d+ )?)?')
+
+def syslog_message(text):
+    return text[wlc_header_re.match(text).end():]
+
+#---------------------------------------------------------------
+
+# The event loop side: classify the messages, and hand batches of
+# events to the database thread.
+class Receiver:
+    def __init__(self, a, classifier, store, args, log):
+        self.a          = a
+        self.classifier = classifier
+        self.store      = store
+        self.args       = args
+        self.log        = log
+
+        self.pending    = list()
+        self.full       = asyncio.Event()
+        self.received   = 0
+        self.written    = 0
+        self.dropped    = 0
+
+        self.second     = None
+        self.timestamp  = None
+
+        # The database thread
+        self.executor   = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    # The current time, in the database's timestamp format (only
+    # formatted once a second)
+    def now(self):
+        second = int(time.time())
+        if second != self.second:
+            self.second    = second
+            self.timestamp = time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.gmtime(second))
+        return self.timestamp
+
+    def receive(self, data, host):
+        text = data.decode('utf-8', errors='replace').rstrip('\r\n\0')
+        if not text:
+            return
+        self.received += 1
+
+        item = self.classifier.classify(syslog_message(text))
+        type = item.pop('type')
+        if type == self.a.unknown_type:
+            if self.args.skip_unknown:
+                return
+            fields = None
+        else:
+            fields = json.dumps(item)
+
+        peer = None
+        for field in self.a.EventIndex.peer_fields:
+            if field in item:
+                peer = item[field]
+                break
+
+        self.pending.append((self.now(), host, type, item.get('ap'), peer,
+                             fields, text))
+        if len(self.pending) >= self.args.batch_size:
+            self.full.set()
+
+    # Write the pending events.  Returns False if the write failed;
+    # then the events go back at the front of the queue, to be
+    # retried (in order) with the ones that came in meanwhile.
+    async def flush(self):
+        rows, self.pending = self.pending, list()
+        self.full.clear()
+        if not rows:
+            return True
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.store.write, rows)
+        except Exception as e:
+            self.pending[:0] = rows
+            self.log.error("Failed to write {n} events (will retry): {e}"
+                           .format(n=len(rows), e=e))
+
+            excess = len(self.pending) - max_pending_events
+            if excess > 0:
+                del self.pending[:excess]
+                self.dropped += excess
+                self.log.error("Dropped the {n} oldest unwritten events ({d} so far)"
+                               .format(n=excess, d=self.dropped))
+            return False
+
+        self.written += len(rows)
+        self.log.debug("Wrote {n} events ({r} received, {w} written so far)"
+                       .format(n=len(rows), r=self.received, w=self.written))
+        return True
+
+    # Write the pending events whenever there's a batch of them, or
+    # every --flush-interval seconds.  While a batch is being written,
+    # the next one keeps piling up (so under load, the batches get
+    # bigger instead of the writes falling behind).  After a failed
+    # write, wait (doubling the delay each time) before trying again.
+    async def flusher(self, stop):
+        delay = 0
+        while not stop.is_set():
+            try:
+                if delay:
+                    await asyncio.wait_for(stop.wait(), timeout=delay)
+                else:
+                    await asyncio.wait_for(self.full.wait(),
+                                           timeout=self.args.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            if await self.flush():
+                delay = 0
+            else:
+                delay = min(max(delay * 2, retry_delay_min), retry_delay_max)
+
+    # Write whatever is left, with a few quick retries
+    async def close(self):
+        delay = retry_delay_min
+        for attempt in range(3):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+            if await self.flush():
+                break
+        else:
+            self.dropped += len(self.pending)
+            self.log.error("Giving up on {n} unwritten events"
+                           .format(n=len(self.pending)))
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.store.close)
+        self.executor.shutdown()
+
+#---------------------------------------------------------------
+
+class SyslogUDP(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver.receive(data, addr[0])
+
+# A TCP connection's messages, framed either by octet counting
+# ("LENGTH message") or by newlines, message by message.  (Syslog
+# messages start with "<PRI>", so a leading digit means a length.)
+async def serve_tcp_connection(receiver, reader, writer):
+    host = writer.get_extra_info('peername')[0]
+    log  = receiver.log
+    log.debug("TCP connection from {host}".format(host=host))
+
+    try:
+        while True:
+            first = await reader.read(1)
+            if not first:
+                break
+
+            # Some senders put a newline after octet-counted messages too
+            if first in b'\r\n\0 ':
+                continue
+
+            if first.isdigit():
+                length = int(first + (await reader.readuntil(b' '))[:-1])
+                if length > max_tcp_message:
+                    log.warning("Message from {host} too long ({n} bytes); closing"
+                                .format(host=host, n=length))
+                    break
+                data = await reader.readexactly(length)
+            else:
+                try:
+                    data = first + await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    # The last message, without a newline
+                    data = first + e.partial
+
+            receiver.receive(data, host)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ValueError, ConnectionError) as e:
+        log.warning("Dropping TCP connection from {host}: {e}"
+                    .format(host=host, e=e))
+    finally:
+        writer.close()
+
+#---------------------------------------------------------------
+
+async def serve(a, classifier, store, args, log):
+    loop     = asyncio.get_running_loop()
+    stop     = asyncio.Event()
+    receiver = Receiver(a, classifier, store, args, log)
+
+    def _stop():
+        stop.set()
+        # Wake up the flusher
+        receiver.full.set()
+
+    for signum in [ signal.SIGTERM, signal.SIGINT ]:
+        loop.add_signal_handler(signum, _stop)
+
+    udp = None
+    tcp = None
+    if args.udp_port:
+        udp, _ = await loop.create_datagram_endpoint(lambda: SyslogUDP(receiver),
+                                                     local_addr=(args.address,
+                                                                 args.udp_port))
+        sock = udp.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udp_receive_buffer)
+        log.info("Listening for syslog on UDP {a}:{p}"
+                 .format(a=args.address, p=args.udp_port))
+    if args.tcp_port:
+        tcp = await asyncio.start_server(lambda r, w: serve_tcp_connection(receiver, r, w),
+                                         args.address, args.tcp_port,
+                                         limit=max_tcp_message)
+        log.info("Listening for syslog on TCP {a}:{p}"
+                 .format(a=args.address, p=args.tcp_port))
+
+    flusher = asyncio.create_task(receiver.flusher(stop))
+    await stop.wait()
+
+    log.info("Stopping")
+    if udp is not None:
+        udp.close()
+    if tcp is not None:
+        tcp.close()
+    await flusher
+    await receiver.close()
+
+    log.info("Received {r} messages, stored {w} events"
+             .format(r=receiver.received, w=receiver.written))
+    if receiver.dropped:
+        log.error("Dropped {d} events that could not be written"
+                  .format(d=receiver.dropped))
+
+################################################################
+
+def main():
+    g    = load_gatherer()
+    a    = load_analyzer()
+    args = setup_cli(g)
+    log  = setup_logging(args)
+
+    rules = list(a.default_rules)
+    if args.rules:
+        rules.extend(a.load_rules(args.rules))
+    classifier = a.Classifier(rules)
+
+    store = EventStore(g, args, log)
+    asyncio.run(serve(a, classifier, store, args, log))
+
+if __name__ == "__main__":
+    main()